@@ -4,32 +4,1931 @@
 """
 
 import streamlit as st
+from streamlit.logger import set_log_level as set_streamlit_log_level
 import geopandas as gpd
 import pandas as pd
 from shapely.geometry import Point, Polygon, MultiPolygon
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
+from xml.sax.saxutils import escape as escape_xml
 import zipfile
 import io
 import tempfile
 import os
 import requests
-from urllib.parse import urlparse, urljoin, urlunparse
+import pyproj
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlparse, urljoin, urlunparse, unquote
 import re
+import unicodedata
+import difflib
+from bisect import bisect_left
 from bs4 import BeautifulSoup
 import json
+import hashlib
+import uuid
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import multiprocessing
+import mmap
+import shutil
+import struct
+import sys
+import numpy as np
+import shapely
 
-# ページ設定
-st.set_page_config(
-    page_title="電子公図データ抽出ツール",
-    page_icon="🗺️",
-    layout="wide"
+# アプリで使用する属性列（これ以外の.dbf列は読み込まない）
+KOJI_ATTRIBUTE_COLUMNS = ['大字名', '丁目名', '小字名', '地番']
+
+# 繰り返しの多い所在の列（カテゴリ型で保持）
+ADDRESS_CATEGORY_COLUMNS = ['大字名', '丁目名', '小字名']
+
+# Shapefileを構成するファイルの拡張子
+SHAPEFILE_MEMBER_EXTENSIONS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+# 変換済みデータセット等のキャッシュ保存先（環境変数 KOJI_CACHE_DIR で変更可能）
+KOJI_CACHE_DIR = os.environ.get(
+    'KOJI_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'koji-data-extractor')
+)
+
+# データセットキャッシュの形式バージョン（読み込み列や変換処理を変更した場合に更新）
+DATASET_CACHE_VERSION = 1
+
+# HTTP通信の設定（全体の同時接続数, ホストごとの同時接続数, 再試行回数, 再試行間隔の基準秒）
+HTTP_MAX_CONCURRENCY = 8
+HTTP_MAX_CONNECTIONS_PER_HOST = 4
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5
+
+# ダウンロードのタイムアウト（接続, 受信間隔）秒とチャンクサイズ
+DOWNLOAD_TIMEOUT = (10, 60)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# HTTP Rangeによる部分取得の設定（初回に取得する末尾のサイズ, 先読みの初期値と上限, 保持する取得済み範囲の数）
+RANGE_TAIL_SIZE = 64 * 1024
+RANGE_MIN_READAHEAD = 256 * 1024
+RANGE_MAX_READAHEAD = 8 * 1024 * 1024
+RANGE_MAX_SEGMENTS = 4
+
+# 電子公図ファイル名（例: 47350_島尻郡南風原町_公共座標15系_筆R_2025.zip）の市区町村コード・名称・座標系
+KOJI_FILE_NAME_PATTERN = re.compile(r'^(\d{5})_(.+?)_公共座標(\d+)系')
+
+# 地番の（本番, 枝番）を1つの整数キーにまとめる際の枝番の桁（本番 × CHIBAN_BRANCH_BASE + 枝番）
+CHIBAN_BRANCH_BASE = 1000000
+
+# 地番の範囲指定（例: 1174〜1180-3）の区切り文字
+CHIBAN_RANGE_PATTERN = re.compile(r'\s*[〜～~]\s*')
+
+# 検索範囲の既定値（m）
+DEFAULT_RANGE_M = 61
+
+# 検索範囲の形（形 → 表示名）
+SEARCH_SHAPES = {
+    'square': '正方形（中心から東西南北）',
+    'circle': '円（中心から）',
+    'buffer': '筆の境界からの距離',
+    'polygon': '任意の多角形',
+    'nearest': '近い順（筆の数を指定）'
+}
+
+# 近い順の検索の既定値（筆の数, 最大距離m）と、候補を探す距離の初期値（m、見つからない場合は2倍ずつ広げる）
+DEFAULT_NEAREST_COUNT = 10
+DEFAULT_NEAREST_MAX_DISTANCE_M = 200
+NEAREST_INITIAL_DISTANCE_M = 30
+
+# 円・境界からの距離の検索範囲で、円弧の1/4を近似する線分の数
+SEARCH_QUAD_SEGMENTS = 16
+
+# 一括抽出の依頼一覧で受け付ける列名の別名
+BATCH_COLUMN_ALIASES = {
+    '大字': '大字名',
+    '丁目': '丁目名',
+    '小字': '小字名',
+    '範囲': '検索範囲',
+    '範囲(m)': '検索範囲',
+    'range': '検索範囲',
+    'range_m': '検索範囲',
+    '市区町村名': '市区町村',
+    '市区町村コード': '市区町村',
+    '市町村': '市区町村',
+    '市町村名': '市区町村',
+    '団体コード': '市区町村'
+}
+
+# 全国地方公共団体コード一覧（総務省）。市区町村コード・名称・カナ読みから該当ファイルを引くために使用
+MUNICIPALITY_CODE_LIST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '000925835.xlsx')
+
+# カナ読みの比較で無視する小書き文字の対応
+KANA_SMALL_TO_LARGE = str.maketrans('ァィゥェォッャュョヮヵヶ', 'アイウエオツヤユヨワカケ')
+
+# 所在（大字名・丁目名・小字名）の照合で同一視する文字（ヶ・ヵ → ケ、旧字体・異体字 → 新字体）
+ADDRESS_CHARACTER_FOLDING = str.maketrans(
+    'ヶヵ澤邊邉濱嶋嶌冨國與龍髙﨑德廣兒惠櫻藏壽當靜眞齋齊圓會舊縣鹽濵峯埜槇嵜',
+    'ケケ沢辺辺浜島島富国与竜高崎徳広児恵桜蔵寿当静真斎斉円会旧県塩浜峰野槙崎'
 )
 
+# 地番の照合で半角ハイフンに統一する文字（各種ハイフン・ダッシュ・マイナス・長音）
+CHIBAN_HYPHEN_FOLDING = str.maketrans({c: '-' for c in '‐‑‒–—―−ーｰ﹣'})
+
+# 類似検索で読みから除く市区町村の種別部分（正規化後のカナ、町・村・市・区）
+KANA_MUNICIPALITY_SUFFIXES = ('チヨウ', 'マチ', 'ソン', 'ムラ', 'シ', 'ク')
+
+# バックグラウンド先読みの同時実行数
+PREFETCH_MAX_WORKERS = int(os.environ.get('KOJI_PREFETCH_WORKERS', '4'))
+
+# 全セッションで共有するデータセットのメモリ上限（MB、環境変数 KOJI_DATASET_MEMORY_MB で変更可能）
+DATASET_MEMORY_LIMIT_MB = int(os.environ.get('KOJI_DATASET_MEMORY_MB', '2048'))
+
+# 全セッションで共有する抽出結果キャッシュのメモリ上限（MB）と有効期限（秒）
+RESULT_CACHE_MEMORY_MB = int(os.environ.get('KOJI_RESULT_CACHE_MB', '256'))
+RESULT_CACHE_TTL_SECONDS = int(os.environ.get('KOJI_RESULT_CACHE_TTL', '3600'))
+
+# 全セッションで共有するダウンロード用ファイル（KML/CSV）キャッシュのメモリ上限（MB）
+EXPORT_CACHE_MEMORY_MB = int(os.environ.get('KOJI_EXPORT_CACHE_MB', '512'))
+
+# KML書き出しで1回に座標変換・文字列化する筆数（メモリ使用量を一定に保つ）
+KML_CHUNK_SIZE = 2000
+
+# ダウンロード用ZIP（複数形式）を作成する際の同時書き出し数
+EXPORT_MAX_WORKERS = int(os.environ.get('KOJI_EXPORT_WORKERS', '4'))
+
+# 県全体の一括抽出のワーカープロセス数（既定はCPUコア数）
+BATCH_MAX_WORKERS = int(os.environ.get('KOJI_BATCH_WORKERS', str(os.cpu_count() or 1)))
+
+# 1つのワーカープロセスで処理する市区町村数の上限（超えるとプロセスを入れ替えてメモリを解放）
+BATCH_TASKS_PER_CHILD = int(os.environ.get('KOJI_BATCH_TASKS_PER_CHILD', '4'))
+
+def parse_koji_file_name(file_name):
+    """ファイル名から市区町村コード・市区町村名・座標系番号を取得（形式が異なる場合はNone）"""
+    match = KOJI_FILE_NAME_PATTERN.match(unquote(os.path.basename(file_name)))
+    if match is None:
+        return None
+    return {'code': match.group(1), 'name': match.group(2), 'zone': int(match.group(3))}
+
+def normalize_municipality_name(text):
+    """市区町村名の表記ゆれを吸収（全角・半角の統一、空白と郡名の除去）"""
+    text = unicodedata.normalize('NFKC', str(text)).replace(' ', '')
+    # 「島尻郡南風原町」のような郡名付きの表記は郡名を除く（「郡山市」等の先頭の郡は対象外）
+    index = text.find('郡')
+    if 0 < index < len(text) - 1:
+        text = text[index + 1:]
+    return text
+
+def normalize_kana(text):
+    """カナ読みの表記ゆれを吸収（半角→全角、ひらがな→カタカナ、濁点・半濁点・長音・小書き文字の違いを無視）"""
+    text = unicodedata.normalize('NFKC', str(text))
+    text = ''.join(chr(ord(c) + 0x60) if 'ぁ' <= c <= 'ゖ' else c for c in text)
+    text = ''.join(c for c in unicodedata.normalize('NFD', text) if c not in '\u3099\u309aー ')
+    return text.translate(KANA_SMALL_TO_LARGE)
+
+def normalize_address_key(text, chiban=False):
+    """所在の照合キーを作成（全角・半角の統一、空白の除去、ケ/ヶや旧字体の同一視、地番はハイフン・「番」の統一）
+    
+    例: "１１７４ー１" → "1174-1"、"1174番1" → "1174-1"、"霞ヶ関" → "霞ケ関"
+    """
+    text = re.sub(r'\s+', '', unicodedata.normalize('NFKC', str(text)))
+    if chiban:
+        text = text.translate(CHIBAN_HYPHEN_FOLDING)
+        text = re.sub(r'(\d)番地?(?=\d)', r'\1-', text)
+        return re.sub(r'(\d)番地?$', r'\1', text)
+    return text.translate(ADDRESS_CHARACTER_FOLDING)
+
+def normalize_address_column(values, chiban=False):
+    """列の値を照合キーのカテゴリ型に変換（異なる値ごとに1回だけ正規化、NULLはNULLのまま）"""
+    codes, uniques = pd.factorize(values)
+    key_codes, keys = pd.factorize(pd.Index([normalize_address_key(value, chiban) for value in uniques], dtype=object))
+    key_codes = np.append(key_codes, -1)[codes]
+    return pd.Series(
+        pd.Categorical.from_codes(key_codes, categories=pd.Index(keys, dtype=object)),
+        index=values.index, name=values.name
+    )
+
+def strip_kana_suffix(kana):
+    """正規化済みの読みから市区町村の種別部分を除く"""
+    for suffix in KANA_MUNICIPALITY_SUFFIXES:
+        if kana.endswith(suffix) and len(kana) > len(suffix):
+            return kana[:-len(suffix)]
+    return kana
+
+def compute_content_hash(file_obj):
+    """ファイル内容のハッシュを計算（GitHubのblob SHAと同じ方式）"""
+    file_obj.seek(0, os.SEEK_END)
+    size = file_obj.tell()
+    file_obj.seek(0)
+    
+    sha = hashlib.sha1(f"blob {size}\0".encode())
+    for chunk in iter(lambda: file_obj.read(DOWNLOAD_CHUNK_SIZE), b''):
+        sha.update(chunk)
+    
+    file_obj.seek(0)
+    return sha.hexdigest()
+
+class HttpClient:
+    """全ての通信で共有するHTTPクライアント（Keep-Alive接続プール・指数バックオフ再試行・同時接続数制御）"""
+    def __init__(self, max_concurrency=HTTP_MAX_CONCURRENCY, max_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+                 max_retries=HTTP_MAX_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR):
+        # 一時的なサーバーエラー・接続エラーは指数バックオフで再試行（403のレート制限は呼び出し側で処理）
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max_per_host, max_retries=retry)
+        
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        
+        self.max_per_host = max_per_host
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._host_semaphores = {}
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def _slot(self, url):
+        """全体とホストごとの同時接続数の枠を確保"""
+        host = urlparse(url).netloc
+        with self._lock:
+            host_semaphore = self._host_semaphores.setdefault(host, threading.BoundedSemaphore(self.max_per_host))
+        
+        with self._semaphore, host_semaphore:
+            yield
+    
+    def get(self, url, **kwargs):
+        """GETリクエスト（本文を読み込んでから接続をプールに返す）"""
+        with self._slot(url):
+            return self.session.get(url, **kwargs)
+    
+    @contextmanager
+    def stream(self, url, **kwargs):
+        """ストリーミングGETリクエスト（本文を読み終えるまで接続枠を保持）"""
+        with self._slot(url):
+            with self.session.get(url, stream=True, **kwargs) as response:
+                yield response
+
+@st.cache_resource
+def get_http_client():
+    """全セッションで共有するHTTPクライアントを取得"""
+    return HttpClient()
+
+class HttpDownloadCache:
+    """ダウンロードしたファイルをETag/Last-Modifiedと共に保存し、再検証・レジューム取得を行うディスクキャッシュ"""
+    def __init__(self, http_client, cache_dir=None):
+        self.http = http_client
+        self.cache_dir = os.path.join(cache_dir or KOJI_CACHE_DIR, 'downloads')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+    
+    def _paths(self, url):
+        """URLに対応する保存先（本体, 取得途中, 検証情報）のパスを取得"""
+        base = os.path.join(self.cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest())
+        # GDALが形式を判別できるよう元の拡張子を残す
+        extension = os.path.splitext(urlparse(url).path)[1].lower() or '.data'
+        return base + extension, base + '.part', base + '.json'
+    
+    def _lock_for(self, url):
+        """同じURLの同時ダウンロードを防ぐロックを取得"""
+        with self._locks_lock:
+            return self._locks.setdefault(url, threading.Lock())
+    
+    def _read_meta(self, meta_path):
+        """検証情報（ETag/Last-Modified）を読み込み"""
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def _write_meta(self, meta_path, meta):
+        """検証情報を保存"""
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+    
+    def contains(self, url):
+        """URLのファイル全体を取得済みか（再検証は行わない）"""
+        data_path, _, meta_path = self._paths(url)
+        return bool(self._read_meta(meta_path).get('complete')) and os.path.exists(data_path)
+    
+    def fetch(self, url):
+        """URLのファイルを取得して読み込み用に開く（変更がなければキャッシュ、途中までの取得はRangeで再開）"""
+        with self._lock_for(url):
+            for attempt in range(HTTP_MAX_RETRIES + 1):
+                try:
+                    return self._fetch_once(url)
+                except requests.exceptions.ChunkedEncodingError:
+                    # 転送途中の切断は取得済みの部分から再開する
+                    if attempt == HTTP_MAX_RETRIES:
+                        raise
+                    time.sleep(HTTP_BACKOFF_FACTOR * (2 ** attempt))
+    
+    def _fetch_once(self, url):
+        """1回分の取得処理（fetchからURLごとのロックを確保した状態で呼び出す）"""
+        data_path, part_path, meta_path = self._paths(url)
+        
+        meta = self._read_meta(meta_path)
+        complete = meta.get('complete') and os.path.exists(data_path)
+        validators = {key: meta.get(key) for key in ('etag', 'last_modified')}
+        
+        headers = {}
+        resume_from = 0
+        if complete:
+            # 取得済みファイルの再検証
+            if validators['etag']:
+                headers['If-None-Match'] = validators['etag']
+            if validators['last_modified']:
+                headers['If-Modified-Since'] = validators['last_modified']
+        elif os.path.exists(part_path) and (validators['etag'] or validators['last_modified']):
+            # 中断したダウンロードの再開（ファイルが変わっていた場合は全体が返される）
+            resume_from = os.path.getsize(part_path)
+            headers['Range'] = f"bytes={resume_from}-"
+            headers['If-Range'] = validators['etag'] or validators['last_modified']
+        
+        with self.http.stream(url, headers=headers, timeout=DOWNLOAD_TIMEOUT) as response:
+            if response.status_code == 304 and complete:
+                return open(data_path, 'rb')
+            
+            response.raise_for_status()
+            
+            mode = 'ab' if response.status_code == 206 and resume_from else 'wb'
+            meta = {
+                'url': url,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'complete': False
+            }
+            if mode == 'ab':
+                meta.update(validators)
+            self._write_meta(meta_path, meta)
+            
+            # チャンク単位でディスクに書き出し（全体をメモリに保持しない）
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+        
+        os.replace(part_path, data_path)
+        meta['complete'] = True
+        self._write_meta(meta_path, meta)
+        
+        return open(data_path, 'rb')
+
+@st.cache_resource
+def get_download_cache():
+    """全セッションで共有するダウンロードキャッシュを取得"""
+    return HttpDownloadCache(get_http_client())
+
+class HttpRangeFile(io.RawIOBase):
+    """HTTP Rangeリクエストで必要な範囲だけを取得する読み込み専用ファイル（zipfileから中央ディレクトリと必要なメンバーのみ読む）"""
+    def __init__(self, http_client, url, size, validator, tail):
+        self.http = http_client
+        self.url = url
+        self.size = size
+        self.validator = validator
+        self.position = 0
+        self.bytes_fetched = len(tail)
+        self.request_count = 1
+        self._segments = OrderedDict([(size - len(tail), tail)])
+        self._readahead = RANGE_MIN_READAHEAD
+        self._last_end = None
+    
+    @classmethod
+    def open(cls, http_client, url):
+        """末尾を取得してサイズと検証情報を確認（Range非対応のサーバーの場合はNoneを返す）"""
+        with http_client.stream(url, headers={'Range': f"bytes=-{RANGE_TAIL_SIZE}"}, timeout=DOWNLOAD_TIMEOUT) as response:
+            content_range = response.headers.get('Content-Range', '')
+            if response.status_code != 206 or '/' not in content_range:
+                return None
+            
+            size = int(content_range.rsplit('/', 1)[1])
+            validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+            return cls(http_client, url, size, validator, response.content)
+    
+    def content_key(self):
+        """URLと検証情報から内容を識別するキーを作成（ファイル全体をダウンロードせずに算出できる）"""
+        return hashlib.sha1(f"{self.url}\0{self.validator}\0{self.size}".encode('utf-8')).hexdigest()
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self.position
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+    
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+        
+        data = self._read_range(self.position, end)
+        buffer[:len(data)] = data
+        self.position = end
+        return len(data)
+    
+    def _read_range(self, start, end):
+        """取得済みの範囲を優先して使い、足りない部分だけをRangeリクエストで取得"""
+        pieces = []
+        while start < end:
+            segment = self._find_segment(start) or self._fetch_segment(start, end)
+            segment_start, data = segment
+            piece = data[start - segment_start:end - segment_start]
+            pieces.append(piece)
+            start += len(piece)
+        return b''.join(pieces)
+    
+    def _find_segment(self, position):
+        """位置を含む取得済みの範囲を探す"""
+        for segment_start, data in self._segments.items():
+            if segment_start <= position < segment_start + len(data):
+                self._segments.move_to_end(segment_start)
+                return segment_start, data
+        return None
+    
+    def _fetch_segment(self, start, end):
+        """指定範囲を取得（連続した読み込みでは先読み量を倍増させてリクエスト数を抑える）"""
+        if start == self._last_end:
+            self._readahead = min(self._readahead * 2, RANGE_MAX_READAHEAD)
+        else:
+            self._readahead = RANGE_MIN_READAHEAD
+        fetch_end = min(max(end, start + self._readahead), self.size)
+        
+        headers = {'Range': f"bytes={start}-{fetch_end - 1}"}
+        if self.validator:
+            # ファイルが更新されていた場合は全体が返されるため、途中で打ち切ってエラーにする
+            headers['If-Range'] = self.validator
+        
+        with self.http.stream(self.url, headers=headers, timeout=DOWNLOAD_TIMEOUT) as response:
+            if response.status_code != 206:
+                response.raise_for_status()
+                raise Exception("読み込み中にリモートファイルが更新されました")
+            data = response.content
+        
+        if not data:
+            raise Exception("リモートファイルの範囲取得に失敗しました")
+        
+        self.bytes_fetched += len(data)
+        self.request_count += 1
+        self._last_end = start + len(data)
+        
+        self._segments[start] = data
+        while len(self._segments) > RANGE_MAX_SEGMENTS:
+            self._segments.popitem(last=False)
+        return start, data
+
+class DatasetCache:
+    """Shapefileを一度だけGeoParquetに変換して保存するディスクキャッシュ（全セッション共通）"""
+    def __init__(self, cache_dir=None):
+        self.cache_dir = os.path.join(cache_dir or KOJI_CACHE_DIR, 'datasets')
+        os.makedirs(self.cache_dir, exist_ok=True)
+    
+    def path_for(self, key):
+        """キャッシュファイルのパスを取得"""
+        return os.path.join(self.cache_dir, f"{key}_v{DATASET_CACHE_VERSION}.parquet")
+    
+    def contains(self, key):
+        """キャッシュの有無を確認"""
+        return key is not None and os.path.exists(self.path_for(key))
+    
+    def load(self, key):
+        """キャッシュをメモリマップで読み込み"""
+        gdf = gpd.read_parquet(self.path_for(key), memory_map=True)
+        
+        # PROJJSONで復元された座標系をEPSGコード表記に戻す
+        epsg = gdf.crs.to_epsg() if gdf.crs else None
+        if epsg:
+            gdf = gdf.set_crs(epsg=epsg, allow_override=True)
+        
+        return gdf
+    
+    def shapefile_dir(self, key):
+        """ZIPから取り出したShapefile一式の保存先を取得"""
+        return os.path.join(self.cache_dir, f"{key}_v{DATASET_CACHE_VERSION}_shp")
+    
+    def shapefile_path(self, key):
+        """取り出し済み.shpのパスを取得"""
+        return os.path.join(self.shapefile_dir(key), 'data.shp')
+    
+    def has_shapefile(self, key):
+        """取り出し済みShapefileの有無を確認（属性の閲覧に必要な.dbf/.shxがあれば.shpは後から取得できる）"""
+        if key is None:
+            return False
+        base = os.path.splitext(self.shapefile_path(key))[0]
+        return os.path.exists(base + '.dbf') and os.path.exists(base + '.shx')
+    
+    def source_url(self, key):
+        """取り出し元のリモートZIPのURLを取得（.shpを後から取得する場合に使用）"""
+        try:
+            with open(os.path.join(self.shapefile_dir(key), 'source.json'), 'r', encoding='utf-8') as f:
+                return json.load(f).get('url')
+        except (OSError, ValueError):
+            return None
+    
+    def set_source_url(self, key, url):
+        """取り出し元のリモートZIPのURLを記録"""
+        os.makedirs(self.shapefile_dir(key), exist_ok=True)
+        with open(os.path.join(self.shapefile_dir(key), 'source.json'), 'w', encoding='utf-8') as f:
+            json.dump({'url': url}, f)
+    
+    def extract_shapefile(self, key, file_obj, extensions=SHAPEFILE_MEMBER_EXTENSIONS):
+        """ZIP内のShapefile構成ファイルのうち指定した拡張子で未取り出しのものだけを取り出し、.shpのパスを返す
+        
+        file_objにHttpRangeFileを渡した場合は、中央ディレクトリと対象メンバーの範囲だけが取得される。
+        """
+        target_dir = self.shapefile_dir(key)
+        base = os.path.join(target_dir, 'data')
+        missing = [extension for extension in extensions if not os.path.exists(base + extension)]
+        
+        if missing:
+            file_obj.seek(0)
+            os.makedirs(target_dir, exist_ok=True)
+            with zipfile.ZipFile(file_obj, 'r') as zip_ref:
+                shp_members = [name for name in zip_ref.namelist() if name.lower().endswith('.shp')]
+                if not shp_members:
+                    raise Exception("ZIPファイル内にSHPファイルが見つかりません")
+                
+                stem = os.path.splitext(shp_members[0])[0]
+                members = {}
+                for name in zip_ref.namelist():
+                    member_stem, extension = os.path.splitext(name)
+                    if member_stem == stem and extension.lower() in missing:
+                        members[extension.lower()] = name
+                
+                # .dbf/.shxの存在で取り出し済みと判定するため、.prj/.cpgを先に書き出す
+                for extension in reversed(SHAPEFILE_MEMBER_EXTENSIONS):
+                    if extension not in members:
+                        continue
+                    path = base + extension
+                    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    try:
+                        with zip_ref.open(members[extension]) as src, open(temp_path, 'wb') as dst:
+                            shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+                        os.replace(temp_path, path)
+                    finally:
+                        if os.path.exists(temp_path):
+                            os.remove(temp_path)
+            file_obj.seek(0)
+        
+        return self.shapefile_path(key)
+    
+    def prefecture_paths(self, key):
+        """統合データセットの保存先（属性, 区分情報）のパスを取得"""
+        base = os.path.join(self.cache_dir, f"prefecture_{key}_v{DATASET_CACHE_VERSION}")
+        return base + '.parquet', base + '.json'
+    
+    def load_prefecture(self, key):
+        """統合データセットを読み込み（未保存の場合はNone）"""
+        attributes_path, partitions_path = self.prefecture_paths(key)
+        if not (os.path.exists(attributes_path) and os.path.exists(partitions_path)):
+            return None
+        
+        with open(partitions_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        return PrefectureDataset(key, manifest['partitions'], pd.read_parquet(attributes_path), name=manifest.get('name'))
+    
+    def store_prefecture(self, prefecture):
+        """統合データセットを保存（書き込み途中のファイルは公開しない）"""
+        attributes_path, partitions_path = self.prefecture_paths(prefecture.key)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            prefecture.attributes.to_parquet(attributes_path + suffix)
+            with open(partitions_path + suffix, 'w', encoding='utf-8') as f:
+                json.dump({'name': prefecture.name, 'partitions': prefecture.partitions}, f, ensure_ascii=False)
+            os.replace(attributes_path + suffix, attributes_path)
+            os.replace(partitions_path + suffix, partitions_path)
+        finally:
+            for path in (attributes_path + suffix, partitions_path + suffix):
+                if os.path.exists(path):
+                    os.remove(path)
+    
+    def routes_path(self, folder_url):
+        """フォルダの経路表（市区町村コード → ファイル）の保存先を取得"""
+        return os.path.join(self.cache_dir, f"routes_{hashlib.sha1(folder_url.encode('utf-8')).hexdigest()}.json")
+    
+    def load_routes(self, folder_url):
+        """保存済みの経路表を読み込み（未保存の場合はNone）"""
+        try:
+            with open(self.routes_path(folder_url), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def store_routes(self, folder_url, routes):
+        """経路表を保存"""
+        path = self.routes_path(folder_url)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(routes, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+    
+    def store(self, key, gdf):
+        """GeoDataFrameをGeoParquetとして保存（書き込み途中のファイルは公開しない）"""
+        path = self.path_for(key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            gdf.to_parquet(temp_path, index=False)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+def estimate_frame_nbytes(frame):
+    """属性データのメモリ使用量（バイト）を推定（同じ文字列オブジェクトを共有している場合は1回だけ数える）"""
+    if isinstance(frame, gpd.GeoDataFrame):
+        frame = pd.DataFrame(frame.drop(columns=frame.geometry.name))
+    
+    total = int(frame.index.memory_usage(deep=True))
+    for column in frame.columns:
+        values = frame[column]
+        if values.dtype == object:
+            array = values.to_numpy()
+            objects = {id(value): value for value in array}
+            total += array.nbytes + sum(sys.getsizeof(value) for value in objects.values())
+        else:
+            total += int(values.memory_usage(index=False, deep=True))
+    return total
+
+def compact_attributes(frame, columns=KOJI_ATTRIBUTE_COLUMNS):
+    """属性データをメモリ効率の良い形に変換（使用しない列の削除、所在の列のカテゴリ型化、地番の文字列の共有、整数の縮小）
+    
+    戻り値は（変換後のデータ, {'before': 変換前のバイト数, 'after': 変換後のバイト数, 'notes': 省略した変換の説明}）。
+    GeoDataFrameの場合はジオメトリ列を残す。
+    """
+    before = estimate_frame_nbytes(frame)
+    geometry_column = frame.geometry.name if isinstance(frame, gpd.GeoDataFrame) else None
+    
+    notes = []
+    converted = {}
+    for column in frame.columns:
+        values = frame[column]
+        if column == geometry_column or column not in columns:
+            continue
+        if column in ADDRESS_CATEGORY_COLUMNS:
+            converted[column] = values if isinstance(values.dtype, pd.CategoricalDtype) else values.astype('category')
+        elif column == '地番' and isinstance(values.dtype, pd.StringDtype) and values.dtype.storage != 'python':
+            # Arrow文字列（pandas 3の既定のstr型等）は文字列オブジェクトを持たないため共有できない
+            notes.append(f"地番はArrow文字列（{values.dtype}）のため文字列の共有を省略")
+            converted[column] = values
+        elif column == '地番' and pd.api.types.is_string_dtype(values.dtype):
+            # 同じ地番は同じ文字列オブジェクトを参照させる（大字が異なると同じ地番が繰り返し現れる）
+            # Pythonオブジェクトで文字列を持つstring型も共有できるようobject型に揃える
+            codes, uniques = pd.factorize(values.astype(object))
+            interned = [sys.intern(value) if isinstance(value, str) else value for value in uniques]
+            converted[column] = pd.Series(
+                np.array(interned + [np.nan], dtype=object)[codes], index=values.index, name=column
+            )
+        elif pd.api.types.is_integer_dtype(values.dtype):
+            converted[column] = pd.to_numeric(values, downcast='integer')
+        else:
+            converted[column] = values
+    
+    keep = [column for column in frame.columns if column in converted or column == geometry_column]
+    compact = frame[keep].assign(**converted)
+    if pd.api.types.is_integer_dtype(compact.index.dtype) and not isinstance(compact.index, pd.RangeIndex):
+        compact.index = pd.Index(pd.to_numeric(compact.index.to_numpy(), downcast='integer'), name=compact.index.name)
+    
+    return compact, {'before': before, 'after': estimate_frame_nbytes(compact), 'notes': notes}
+
+def estimate_gdf_nbytes(gdf):
+    """GeoDataFrameのおおよそのメモリ使用量（バイト）を推定"""
+    attribute_bytes = estimate_frame_nbytes(gdf)
+    # ジオメトリは座標値（16バイト/点）と1オブジェクトあたりのオーバーヘッドで概算
+    coordinate_bytes = int(shapely.get_num_coordinates(gdf.geometry.values).sum()) * 16
+    return int(attribute_bytes) + coordinate_bytes + len(gdf) * 100
+
+class ShapefileGeometryStore:
+    """.shxのレコード位置を使い、メモリマップした.shpから指定レコードのジオメトリだけを復元
+    
+    fetch_shpを指定した場合、.shpは最初にジオメトリが必要になった時点でfetch_shpにより取得する。
+    """
+    def __init__(self, shp_path, crs=None, fetch_shp=None):
+        shx_path = os.path.splitext(shp_path)[0] + '.shx'
+        with open(shx_path, 'rb') as f:
+            shx_data = f.read()
+        
+        # .shxはヘッダ100バイトの後に（オフセット, 長さ）が16ビットワード単位のビッグエンディアンで並ぶ
+        index = np.frombuffer(shx_data, dtype='>i4', offset=100).reshape(-1, 2)
+        self.offsets = index[:, 0].astype(np.int64) * 2
+        self.crs = crs
+        self.shp_path = shp_path
+        self._fetch_shp = fetch_shp
+        self._mmap = None
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.offsets)
+    
+    def ensure_shp(self):
+        """.shpをメモリマップで開く（未取得の場合は先に取得）"""
+        if self._mmap is None:
+            with self._lock:
+                if self._mmap is None:
+                    if not os.path.exists(self.shp_path) and self._fetch_shp is not None:
+                        self._fetch_shp()
+                    with open(self.shp_path, 'rb') as f:
+                        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+    
+    def geometries(self, positions):
+        """レコード番号の配列に対応するジオメトリを復元"""
+        self.ensure_shp()
+        return np.array([self._read_record(int(position)) for position in positions], dtype=object)
+    
+    def bounds(self):
+        """全レコードの外接矩形（xmin, ymin, xmax, ymax）をレコードヘッダから取得（ジオメトリは復元しない）"""
+        data = np.frombuffer(self.ensure_shp(), dtype=np.uint8)
+        content = self.offsets + 8
+        shape_types = data[content[:, None] + np.arange(4)].view('<i4').ravel()
+        
+        boxes = np.full((len(content), 4), np.nan)
+        # ポイントは座標のみ、それ以外（ポリゴン等）は種別の直後に外接矩形が格納されている
+        points = np.isin(shape_types, (1, 11, 21))
+        others = (shape_types != 0) & ~points
+        boxes[others] = data[content[others, None] + 4 + np.arange(32)].view('<f8').reshape(-1, 4)
+        boxes[points, :2] = data[content[points, None] + 4 + np.arange(16)].view('<f8').reshape(-1, 2)
+        boxes[points, 2:] = boxes[points, :2]
+        return boxes
+    
+    def _read_record(self, position):
+        """1レコード分のジオメトリを復元（レコードヘッダ8バイトの後が本体）"""
+        offset = int(self.offsets[position]) + 8
+        shape_type = struct.unpack_from('<i', self._mmap, offset)[0]
+        
+        if shape_type == 0:
+            return None
+        
+        if shape_type in (1, 11, 21):
+            x, y = struct.unpack_from('<2d', self._mmap, offset + 4)
+            return Point(x, y)
+        
+        if shape_type in (5, 15, 25):
+            num_parts, num_points = struct.unpack_from('<2i', self._mmap, offset + 36)
+            parts = np.frombuffer(self._mmap, dtype='<i4', count=num_parts, offset=offset + 44)
+            points = np.frombuffer(
+                self._mmap, dtype='<f8', count=num_points * 2, offset=offset + 44 + 4 * num_parts
+            ).reshape(-1, 2)
+            return self._build_polygon(np.split(points, parts[1:]))
+        
+        raise Exception(f"未対応のジオメトリ種別です: {shape_type}")
+    
+    def _build_polygon(self, rings):
+        """リングの向き（時計回りが外環）からPolygon/MultiPolygonを組み立て"""
+        shells = []
+        holes = []
+        for ring in rings:
+            x, y = ring[:, 0], ring[:, 1]
+            signed_area = np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1])
+            (shells if signed_area <= 0 else holes).append(ring)
+        
+        if not shells:
+            shells, holes = holes, []
+        
+        if len(shells) == 1:
+            return Polygon(shells[0], holes)
+        
+        # 内環は最初に含まれる外環に割り当てる
+        shell_polygons = [Polygon(shell) for shell in shells]
+        shell_holes = [[] for _ in shells]
+        for hole in holes:
+            hole_point = Point(hole[0])
+            for i, shell_polygon in enumerate(shell_polygons):
+                if shell_polygon.covers(hole_point):
+                    shell_holes[i].append(hole)
+                    break
+        
+        return MultiPolygon([Polygon(shell, hs) for shell, hs in zip(shells, shell_holes)])
+
+class AddressIndex:
+    """所在（大字名, 丁目名, 小字名, 地番）から行位置を引く索引と、列ごとの件数（データセットごとに1回だけ作成）
+    
+    照合はnormalize_address_keyで正規化したキー同士で行う（全角数字・ハイフンの違い・ケ/ヶ・旧字体を同一視）。
+    行ごとの正規化キーはkeys（行位置順、列はカテゴリ型）として保持し、一括抽出の照合にも使用する。
+    """
+    def __init__(self, attributes):
+        self.columns = [column for column in KOJI_ATTRIBUTE_COLUMNS if column in attributes.columns]
+        self._position_of = {column: i for i, column in enumerate(self.columns)}
+        
+        # 列ごとの正規化キー（異なる値ごとに1回だけ正規化）
+        self.keys = pd.DataFrame({
+            column: normalize_address_column(attributes[column], chiban=column == '地番').reset_index(drop=True)
+            for column in self.columns
+        })
+        
+        # 列ごとに整数コード化した組み合わせを1つの整数キーにまとめる（文字列のまま集計するより高速）
+        # NULLは空文字として同じキーにまとめる（地番・大字名が空の筆は検索対象にならない）
+        key = np.zeros(len(attributes), dtype=np.int64)
+        column_codes = []
+        column_values = []
+        for column in self.columns:
+            codes = self.keys[column].cat.codes.to_numpy().astype(np.int64)
+            values = self.keys[column].cat.categories
+            column_codes.append(codes + 1)
+            column_values.append(np.concatenate([[''], np.asarray(values, dtype=object)]))
+            key, _ = pd.factorize(key * (len(values) + 1) + codes + 1)
+        
+        # キーの順に並べた行位置と、キーごとの範囲（_bounds[g]〜_bounds[g + 1]）
+        self._order = np.argsort(key, kind='stable')
+        sorted_key = key[self._order]
+        starts = np.flatnonzero(np.r_[True, sorted_key[1:] != sorted_key[:-1]])
+        self._bounds = np.append(starts, len(self._order))
+        
+        first_rows = self._order[starts]
+        self._groups = {
+            address: group
+            for group, address in enumerate(zip(*(values[codes[first_rows]] for codes, values in zip(column_codes, column_values))))
+        }
+        
+        # 丁目・小字を指定しない検索用に（大字名, 地番）から所在のキーを引けるようにする
+        self._keys_by_oaza_chiban = {}
+        oaza_position, chiban_position = self._position_of['大字名'], self._position_of['地番']
+        for address in self._groups:
+            self._keys_by_oaza_chiban.setdefault((address[oaza_position], address[chiban_position]), []).append(address)
+        
+        # 該当なしの場合の診断用の列ごとの件数（正規化キーごと）
+        self.counts = {column: self.keys[column].value_counts().to_dict() for column in self.columns}
+        self.null_counts = {column: int(self.keys[column].isna().sum()) for column in self.columns}
+    
+    def lookup(self, oaza, chiban, chome=None, koaza=None):
+        """所在に該当する行位置を取得（丁目・小字はNoneの場合は絞り込まない、条件は正規化して照合）"""
+        if not oaza or not chiban:
+            return np.array([], dtype=np.intp)
+        
+        oaza, chiban = normalize_address_key(oaza), normalize_address_key(chiban, chiban=True)
+        chome = normalize_address_key(chome) if chome is not None else None
+        koaza = normalize_address_key(koaza) if koaza is not None else None
+        conditions = [(self._position_of[column], value) for column, value in (('丁目名', chome), ('小字名', koaza))
+                      if value is not None and column in self._position_of]
+        groups = [
+            self._groups[address]
+            for address in self._keys_by_oaza_chiban.get((oaza, chiban), [])
+            if all(address[position] == value for position, value in conditions)
+        ]
+        positions = [self._order[self._bounds[group]:self._bounds[group + 1]] for group in groups]
+        if not positions:
+            return np.array([], dtype=np.intp)
+        return np.sort(np.concatenate(positions))
+    
+    def count(self, column, value):
+        """列の値ごとの件数（値は正規化して照合）"""
+        return self.counts.get(column, {}).get(normalize_address_key(value, chiban=column == '地番'), 0)
+    
+    @property
+    def nbytes(self):
+        """おおよそのメモリ使用量（バイト）"""
+        key_bytes = int(self.keys.memory_usage(deep=True).sum())
+        return len(self._groups) * 200 + self._order.nbytes + self._bounds.nbytes + key_bytes
+
+def parse_chiban_number(text):
+    """地番を（本番, 枝番）に分解（例: "1174-3" → (1174, 3)、"1174" → (1174, None)、数字で始まらない場合はNone）"""
+    match = re.match(r'^(\d+)(?:-(\d+))?', str(text).strip())
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2)) if match.group(2) is not None else None
+
+def parse_chiban_range(text):
+    """地番の範囲指定（例: "1174〜1180-3"）を（開始, 終了）の（本番, 枝番）に分解（範囲指定でない場合はNone）"""
+    parts = CHIBAN_RANGE_PATTERN.split(str(text).strip())
+    if len(parts) != 2:
+        return None
+    start, end = parse_chiban_number(parts[0]), parse_chiban_number(parts[1])
+    if start is None or end is None:
+        return None
+    return start, end
+
+class ChibanIndex:
+    """地番の検索索引（完全一致・前方一致・部分一致・本番-枝番の範囲、データセットごとに1回だけ作成）
+    
+    異なる地番ごとに行位置をまとめ、地番の名前順に並べておく。前方一致・完全一致は名前順の地番の二分探索、
+    部分一致は地番の2文字組の転置索引で候補を絞り込み、範囲は（本番, 枝番）の数値キーの二分探索で引く。
+    """
+    def __init__(self, chiban):
+        codes, uniques = pd.factorize(chiban)
+        keys = np.array([str(value) for value in uniques], dtype=object)
+        
+        # 地番を名前順に番号付けし直し、番号の順に並べた行位置と番号ごとの範囲（_bounds[k]〜_bounds[k + 1]）を作成
+        name_order = np.argsort(keys, kind='stable')
+        rank = np.empty(len(keys), dtype=np.int64)
+        rank[name_order] = np.arange(len(keys))
+        rows = np.flatnonzero(codes >= 0)
+        key_ids = rank[codes[rows]]
+        order = np.argsort(key_ids, kind='stable')
+        self._rows = rows[order]
+        self._bounds = np.searchsorted(key_ids[order], np.arange(len(keys) + 1))
+        self.keys = keys[name_order].tolist()
+        
+        # 部分一致用の2文字組 → 地番の番号の転置索引（1文字の地番は2文字以上の検索語を含まないため登録しない）
+        postings = {}
+        for key_id, key in enumerate(self.keys):
+            for gram in {key[i:i + 2] for i in range(len(key) - 1)}:
+                postings.setdefault(gram, []).append(key_id)
+        self._postings = {gram: np.array(ids, dtype=np.int32) for gram, ids in postings.items()}
+        
+        # 範囲検索用に数字で始まる地番の（本番, 枝番）を数値キーにして昇順に並べる（枝番なしは枝番0として扱う）
+        parsed = pd.Series(self.keys, dtype=object).str.extract(r'^(\d+)(?:-(\d+))?')
+        numeric = parsed[0].notna().to_numpy()
+        numbers = (
+            parsed.loc[numeric, 0].astype(np.int64).to_numpy() * CHIBAN_BRANCH_BASE
+            + parsed.loc[numeric, 1].fillna(0).astype(np.int64).to_numpy()
+        )
+        number_order = np.argsort(numbers, kind='stable')
+        self._numbers = numbers[number_order]
+        self._number_key_ids = np.flatnonzero(numeric)[number_order]
+    
+    def _positions(self, key_ids):
+        """地番の番号の一覧に該当する行位置（昇順）"""
+        if len(key_ids) == 0:
+            return np.array([], dtype=np.intp)
+        return np.sort(np.concatenate([self._rows[self._bounds[k]:self._bounds[k + 1]] for k in key_ids]))
+    
+    def exact(self, term):
+        """地番が完全一致する行位置"""
+        k = bisect_left(self.keys, term)
+        if k < len(self.keys) and self.keys[k] == term:
+            return np.sort(self._rows[self._bounds[k]:self._bounds[k + 1]])
+        return np.array([], dtype=np.intp)
+    
+    def prefix(self, term):
+        """地番が指定した文字列で始まる行位置（名前順で連続する範囲を二分探索で求める）"""
+        start = bisect_left(self.keys, term)
+        end = bisect_left(self.keys, term + '\U0010ffff')
+        return np.sort(self._rows[self._bounds[start]:self._bounds[end]])
+    
+    def substring(self, term):
+        """地番が指定した文字列を含む行位置（2文字組の転置索引で候補を絞り込んでから照合）"""
+        if not term:
+            return np.array([], dtype=np.intp)
+        if len(term) == 1:
+            candidates = range(len(self.keys))
+        else:
+            grams = sorted({term[i:i + 2] for i in range(len(term) - 1)}, key=lambda gram: len(self._postings.get(gram, ())))
+            candidates = self._postings.get(grams[0], np.array([], dtype=np.int32))
+            for gram in grams[1:]:
+                if len(candidates) == 0:
+                    break
+                candidates = np.intersect1d(candidates, self._postings.get(gram, np.array([], dtype=np.int32)), assume_unique=True)
+        return self._positions([k for k in candidates if term in self.keys[k]])
+    
+    def range(self, start, end):
+        """（本番, 枝番）がstart〜endの範囲の行位置（枝番がNoneの場合、開始は枝番なしから・終了はその本番の全枝番まで）"""
+        start_key = start[0] * CHIBAN_BRANCH_BASE + (start[1] or 0)
+        end_key = end[0] * CHIBAN_BRANCH_BASE + (end[1] if end[1] is not None else CHIBAN_BRANCH_BASE - 1)
+        low = np.searchsorted(self._numbers, start_key, side='left')
+        high = np.searchsorted(self._numbers, end_key, side='right')
+        return self._positions(self._number_key_ids[low:high])
+    
+    @property
+    def nbytes(self):
+        """おおよそのメモリ使用量（バイト）"""
+        posting_bytes = sum(ids.nbytes + 100 for ids in self._postings.values())
+        return self._rows.nbytes + self._bounds.nbytes + self._numbers.nbytes + len(self.keys) * 60 + posting_bytes
+
+class AddressHierarchy:
+    """大字名 → 丁目名・小字名の選択肢と筆数の階層索引（データセットごとに1回だけ作成）
+    
+    選択肢の絞り込みのたびに全件を走査しないよう、所在の組み合わせごとの筆数から
+    大字名ごとに並べ替え済みの丁目名・小字名の一覧と件数を作成しておく。
+    """
+    def __init__(self, attributes):
+        self.has_chome = '丁目名' in attributes.columns
+        self.has_koaza = '小字名' in attributes.columns
+        self._nodes = {}
+        if '大字名' not in attributes.columns:
+            self.oaza_list = []
+            return
+        
+        columns = [column for column in ('大字名', '丁目名', '小字名') if column in attributes.columns]
+        sizes = attributes.groupby(columns, dropna=False, sort=False, observed=True).size()
+        
+        # 所在の組み合わせ（大字名, 丁目名, 小字名）ごとの筆数を大字名ごとに集計（NULLの大字名は選択肢にしない）
+        counts = {}
+        for address, count in sizes.items():
+            address = address if isinstance(address, tuple) else (address,)
+            oaza = address[0]
+            chome = address[columns.index('丁目名')] if self.has_chome else None
+            koaza = address[columns.index('小字名')] if self.has_koaza else None
+            if pd.isna(oaza):
+                continue
+            node = counts.setdefault(oaza, {'count': 0, 'chome': {}, 'koaza': {}, 'koaza_by_chome': {}})
+            node['count'] += int(count)
+            if chome is not None and not pd.isna(chome):
+                node['chome'][chome] = node['chome'].get(chome, 0) + int(count)
+            if koaza is not None and not pd.isna(koaza):
+                node['koaza'][koaza] = node['koaza'].get(koaza, 0) + int(count)
+                if chome is not None and not pd.isna(chome):
+                    koaza_counts = node['koaza_by_chome'].setdefault(chome, {})
+                    koaza_counts[koaza] = koaza_counts.get(koaza, 0) + int(count)
+        
+        # 選択肢は名前順に並べた辞書として保持（キーの順がそのまま選択肢の順）
+        def sort_counts(value_counts):
+            return {value: value_counts[value] for value in sorted(value_counts)}
+        
+        self.oaza_list = sorted(counts)
+        for oaza in self.oaza_list:
+            node = counts[oaza]
+            self._nodes[oaza] = {
+                'count': node['count'],
+                'chome': sort_counts(node['chome']),
+                'koaza': sort_counts(node['koaza']),
+                'koaza_by_chome': {chome: sort_counts(value_counts) for chome, value_counts in node['koaza_by_chome'].items()}
+            }
+    
+    def chome_list(self, oaza):
+        """大字名に対応する丁目名の一覧（名前順）"""
+        return list(self._nodes.get(oaza, {}).get('chome', {}))
+    
+    def koaza_list(self, oaza, chome=None):
+        """大字名（丁目名を指定した場合は丁目名も）に対応する小字名の一覧（名前順）"""
+        node = self._nodes.get(oaza, {})
+        if chome is None:
+            return list(node.get('koaza', {}))
+        return list(node.get('koaza_by_chome', {}).get(chome, {}))
+    
+    def count(self, oaza, chome=None, koaza=None):
+        """大字名・丁目名・小字名の組み合わせに該当する筆数"""
+        node = self._nodes.get(oaza)
+        if node is None:
+            return 0
+        if chome is None and koaza is None:
+            return node['count']
+        if koaza is None:
+            return node['chome'].get(chome, 0)
+        if chome is None:
+            return node['koaza'].get(koaza, 0)
+        return node['koaza_by_chome'].get(chome, {}).get(koaza, 0)
+    
+    @property
+    def nbytes(self):
+        """おおよそのメモリ使用量（バイト）"""
+        return sum(
+            200 + (len(node['chome']) + len(node['koaza']) + sum(len(v) for v in node['koaza_by_chome'].values())) * 150
+            for node in self._nodes.values()
+        )
+
+class SpatialIndex:
+    """筆の外接矩形によるSTRtree空間索引（データセットごとに1回だけ作成）"""
+    def __init__(self, bounds):
+        boxes = shapely.box(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3])
+        boxes[np.isnan(bounds).any(axis=1)] = None
+        self.tree = shapely.STRtree(boxes)
+    
+    def query(self, window):
+        """外接矩形が検索範囲と交差する行位置（昇順）"""
+        return np.sort(self.tree.query(window))
+    
+    def query_within(self, geometry, distance):
+        """外接矩形がジオメトリから指定距離以内にある行位置（昇順、筆そのものとの距離が指定距離以内の筆を必ず含む）"""
+        return np.sort(self.tree.query(geometry, predicate='dwithin', distance=distance))
+    
+    def query_bulk(self, windows):
+        """複数の検索範囲をまとめて検索し、（検索範囲の番号, 行位置）の組を番号・行位置の順で返す"""
+        window_indices, positions = self.tree.query(windows)
+        order = np.lexsort((positions, window_indices))
+        return window_indices[order], positions[order]
+    
+    @property
+    def nbytes(self):
+        """おおよそのメモリ使用量（バイト）"""
+        return len(self.tree) * 150
+
+def extract_polygonal(geometries):
+    """ジオメトリ配列のポリゴン部分のみを取り出す（GeometryCollectionはポリゴン部分を結合、ポリゴン以外はNone）"""
+    geometries = np.array(geometries, dtype=object)
+    for i in np.flatnonzero(shapely.get_type_id(geometries) == 7):
+        parts = [part for part in shapely.get_parts(geometries[i]) if shapely.get_type_id(part) in (3, 6)]
+        geometries[i] = shapely.union_all(parts) if parts else None
+    geometries[~np.isin(shapely.get_type_id(geometries), (3, 6))] = None
+    return geometries
+
+def repair_polygons(geometries):
+    """不正なポリゴンをmake_validで修正し、ポリゴン部分のみを残す（GeoDataFrame.overlayの入力の修正と同じ）"""
+    geometries = np.array(geometries, dtype=object)
+    polygonal = np.isin(shapely.get_type_id(geometries), (3, 6))
+    invalid = polygonal & ~shapely.is_valid(geometries)
+    if invalid.any():
+        geometries[invalid] = extract_polygonal(shapely.make_valid(geometries[invalid]))
+    return geometries
+
+def clip_to_window(geometries, window):
+    """ポリゴンを検索範囲で切り抜く（GeoDataFrame.overlayのintersectionと同じく結果はポリゴンのみ）
+    
+    geometriesはrepair_polygonsで修正済みのもの。windowにジオメトリと同じ長さの配列を渡すと、
+    それぞれ対応する検索範囲で切り抜く。
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    window = np.broadcast_to(np.asarray(window, dtype=object), geometries.shape)
+    
+    clipped = np.full(len(geometries), None, dtype=object)
+    hits = shapely.intersects(geometries, window)
+    clipped[hits] = shapely.intersection(window[hits], geometries[hits])
+    
+    # 切り抜き結果のうち不正なポリゴンのみ修正（有効なポリゴンはmake_validでも変わらないため省略）
+    polygonal = np.isin(shapely.get_type_id(clipped), (3, 6))
+    polygonal[polygonal] = ~shapely.is_valid(clipped[polygonal])
+    clipped[polygonal] = shapely.make_valid(clipped[polygonal])
+    return extract_polygonal(clipped)
+
+def build_search_window(shape, geometry, range_m, polygon=None):
+    """対象筆のジオメトリ（配列の場合は筆ごと）から検索範囲を作成（shapeはSEARCH_SHAPESのいずれか、polygonの場合は指定した多角形）"""
+    if shape == 'square':
+        # 中心から東西南北にrange_mの正方形（頂点の並びは従来の4点の凸包と同じ時計回り）
+        center = shapely.centroid(geometry)
+        cx, cy = shapely.get_x(center), shapely.get_y(center)
+        return shapely.box(cx - range_m, cy - range_m, cx + range_m, cy + range_m, ccw=False)
+    if shape == 'circle':
+        return shapely.buffer(shapely.centroid(geometry), range_m, quad_segs=SEARCH_QUAD_SEGMENTS)
+    if shape == 'buffer':
+        return shapely.buffer(geometry, range_m, quad_segs=SEARCH_QUAD_SEGMENTS)
+    if shape == 'polygon':
+        if polygon is None:
+            raise Exception("検索範囲の多角形が指定されていません")
+        return polygon
+    raise Exception(f"未対応の検索範囲の形です: {shape}")
+
+def parse_search_polygon(text, crs):
+    """緯度経度（WGS84）のGeoJSONまたはWKTで入力された多角形を、データセットの座標系の検索範囲に変換"""
+    text = text.strip()
+    try:
+        if text.startswith('{'):
+            geojson = json.loads(text)
+            # FeatureCollection・Featureの場合はジオメトリを取り出す
+            if geojson.get('type') == 'FeatureCollection':
+                geojson = geojson['features'][0]
+            if geojson.get('type') == 'Feature':
+                geojson = geojson['geometry']
+            polygon = shapely.geometry.shape(geojson)
+        else:
+            polygon = shapely.from_wkt(text)
+    except Exception as e:
+        raise Exception(f"多角形を読み取れません（GeoJSONまたはWKTで入力してください）: {str(e)}")
+    
+    if shapely.get_type_id(polygon) not in (3, 6) or polygon.is_empty:
+        raise Exception("検索範囲にはPolygonまたはMultiPolygonを指定してください")
+    polygon = repair_polygons([polygon])[0]
+    return gpd.GeoSeries([polygon], crs='EPSG:4326').to_crs(crs).iloc[0]
+
+def format_range_tier(range_m):
+    """検索範囲の距離の表示（例: 61.0 → "61m"）"""
+    return f"{float(range_m):g}m"
+
+def iter_kml(gdf, name="地番データ", pretty=False, chunk_size=KML_CHUNK_SIZE):
+    """GeoDataFrameをWGS84（緯度経度）のKMLとして少しずつ生成（文字列の断片を返すジェネレーター）
+    
+    chunk_size件ごとに座標変換し、座標文字列はジオメトリ配列からまとめて作成する。
+    pretty=Trueの場合は要素ごとに改行して2文字ずつ字下げする。
+    """
+    def line(level, text):
+        return "  " * level + text + "\n" if pretty else text
+    
+    yield '<?xml version="1.0" ?>\n' if pretty else '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield "".join([
+        line(0, '<kml xmlns="http://www.opengis.net/kml/2.2">'),
+        line(1, '<Document>'),
+        line(2, f'<name>{escape_xml(str(name))}</name>'),
+        line(2, '<Style id="PolygonStyle">'),
+        line(3, '<LineStyle>'),
+        line(4, '<color>ff0000ff</color>'),  # 赤色
+        line(4, '<width>2</width>'),
+        line(3, '</LineStyle>'),
+        line(3, '<PolyStyle>'),
+        line(4, '<color>3300ff00</color>'),  # 半透明緑
+        line(3, '</PolyStyle>'),
+        line(2, '</Style>')
+    ])
+    
+    description_columns = [col for col in gdf.columns if col != gdf.geometry.name]
+    for start in range(0, len(gdf), chunk_size):
+        chunk = gdf.iloc[start:start + chunk_size].to_crs(epsg=4326)
+        geometries = np.asarray(chunk.geometry.values, dtype=object)
+        type_ids = shapely.get_type_id(geometries)
+        
+        # ポリゴン → 環 → 座標の順に配列で分解し、環ごとの座標文字列をまとめて作成
+        polygonal = np.flatnonzero(np.isin(type_ids, (3, 6)))
+        parts, part_rows = shapely.get_parts(geometries[polygonal], return_index=True)
+        rings, ring_parts = shapely.get_rings(parts, return_index=True)
+        coordinates, coordinate_rings = shapely.get_coordinates(rings, return_index=True)
+        tokens = np.char.add(
+            np.char.add(np.char.add(coordinates[:, 0].astype(str), ','), coordinates[:, 1].astype(str)), ',0'
+        ).tolist()
+        coordinate_offsets = np.searchsorted(coordinate_rings, np.arange(len(rings) + 1)).tolist()
+        ring_texts = [" ".join(tokens[coordinate_offsets[i]:coordinate_offsets[i + 1]]) for i in range(len(rings))]
+        ring_offsets = np.searchsorted(ring_parts, np.arange(len(parts) + 1)).tolist()
+        part_offsets = np.searchsorted(part_rows, np.arange(len(polygonal) + 1)).tolist()
+        polygon_numbers = dict(zip(polygonal.tolist(), range(len(polygonal))))
+        
+        names = chunk['地番'].tolist() if '地番' in chunk.columns else [f"地番_{idx}" for idx in chunk.index]
+        values = [chunk[col].tolist() for col in description_columns]
+        
+        pieces = []
+        for row in range(len(chunk)):
+            description = "".join(f"{col}: {column_values[row]}<br/>" for col, column_values in zip(description_columns, values))
+            pieces.append(line(2, '<Placemark>'))
+            pieces.append(line(3, f'<name>{escape_xml(str(names[row]))}</name>'))
+            pieces.append(line(3, f'<description>{escape_xml(description)}</description>' if description else '<description/>'))
+            pieces.append(line(3, '<styleUrl>#PolygonStyle</styleUrl>'))
+            
+            if row in polygon_numbers:
+                number = polygon_numbers[row]
+                pieces.append(line(3, '<MultiGeometry>'))
+                for part in range(part_offsets[number], part_offsets[number + 1]):
+                    pieces.append(line(4, '<Polygon>'))
+                    for ring in range(ring_offsets[part], ring_offsets[part + 1]):
+                        boundary = 'outerBoundaryIs' if ring == ring_offsets[part] else 'innerBoundaryIs'
+                        pieces.append(line(5, f'<{boundary}>'))
+                        pieces.append(line(6, '<LinearRing>'))
+                        pieces.append(line(7, f'<coordinates>{ring_texts[ring]}</coordinates>'))
+                        pieces.append(line(6, '</LinearRing>'))
+                        pieces.append(line(5, f'</{boundary}>'))
+                    pieces.append(line(4, '</Polygon>'))
+                pieces.append(line(3, '</MultiGeometry>'))
+            elif type_ids[row] == 0:
+                point = geometries[row]
+                pieces.append(line(3, '<Point>'))
+                pieces.append(line(4, f'<coordinates>{shapely.get_x(point)},{shapely.get_y(point)},0</coordinates>'))
+                pieces.append(line(3, '</Point>'))
+            
+            pieces.append(line(2, '</Placemark>'))
+        yield "".join(pieces)
+    
+    yield line(1, '</Document>') + line(0, '</kml>')
+
+def write_kml(gdf, file_obj, name="地番データ", pretty=False):
+    """GeoDataFrameをKMLとしてファイル（バイナリ）に順次書き出し（全体を文字列として保持しない）"""
+    for piece in iter_kml(gdf, name, pretty=pretty):
+        file_obj.write(piece.encode('utf-8'))
+
+def write_kml_file(gdf, path, name):
+    """KMLファイルに書き出し"""
+    with open(path, 'wb') as f:
+        write_kml(gdf, f, name)
+
+def write_kmz_file(gdf, path, name):
+    """KMZ（KMLを圧縮したZIP）に書き出し（KMLは圧縮しながら順次書き込む）"""
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as kmz:
+        with kmz.open('doc.kml', 'w') as f:
+            write_kml(gdf, f, name)
+
+def write_geojson_file(gdf, path, name):
+    """GeoJSONに書き出し（RFC 7946に従いWGS84の緯度経度に変換）"""
+    gdf.to_crs(epsg=4326).to_file(path, driver='GeoJSON', layer=name, engine='pyogrio', use_arrow=True, RFC7946='YES')
+
+def write_gpkg_file(gdf, path, name):
+    """GeoPackageに書き出し（座標系は元のまま）"""
+    gdf.to_file(path, driver='GPKG', layer=name, engine='pyogrio', use_arrow=True)
+
+def write_flatgeobuf_file(gdf, path, name):
+    """FlatGeobufに書き出し（座標系は元のまま、空間索引付き）"""
+    gdf.to_file(path, driver='FlatGeobuf', layer=name, engine='pyogrio', use_arrow=True)
+
+def write_geoparquet_file(gdf, path, name):
+    """GeoParquetに書き出し（座標系は元のまま）"""
+    gdf.to_parquet(path, index=False)
+
+def write_csv_file(gdf, path, name):
+    """座標情報（中心座標）付きCSVに書き出し（Shift-JIS）"""
+    with open(path, 'wb') as f:
+        f.write(create_centroid_csv(gdf).encode('cp932', errors='replace'))
+
+# ダウンロード形式（形式 → 表示名・拡張子・MIMEタイプ・書き出し関数・ZIPに入れる際に圧縮するか）
+EXPORT_FORMATS = {
+    'kml': {'label': 'KML', 'extension': 'kml', 'mime': 'application/vnd.google-earth.kml+xml',
+            'writer': write_kml_file, 'compress': True},
+    'kmz': {'label': 'KMZ（圧縮KML）', 'extension': 'kmz', 'mime': 'application/vnd.google-earth.kmz',
+            'writer': write_kmz_file, 'compress': False},
+    'geojson': {'label': 'GeoJSON', 'extension': 'geojson', 'mime': 'application/geo+json',
+                'writer': write_geojson_file, 'compress': True},
+    'gpkg': {'label': 'GeoPackage', 'extension': 'gpkg', 'mime': 'application/geopackage+sqlite3',
+             'writer': write_gpkg_file, 'compress': True},
+    'fgb': {'label': 'FlatGeobuf', 'extension': 'fgb', 'mime': 'application/octet-stream',
+            'writer': write_flatgeobuf_file, 'compress': True},
+    'parquet': {'label': 'GeoParquet', 'extension': 'parquet', 'mime': 'application/vnd.apache.parquet',
+                'writer': write_geoparquet_file, 'compress': False},
+    'csv': {'label': 'CSV（中心座標付き）', 'extension': 'csv', 'mime': 'text/csv',
+            'writer': write_csv_file, 'compress': True}
+}
+
+def create_export_bundle(layers, export_formats, base_name):
+    """複数のレイヤー（名前 → GeoDataFrame）を複数の形式で書き出し、1つのZIPにまとめる
+    
+    各ファイルは一時フォルダに並列に書き出し（GDAL・Arrowの書き出し中はGILが解放される）、
+    圧縮済みの形式（KMZ・GeoParquet）はZIPで再圧縮しない。空のレイヤーは含めない。
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        targets = []
+        for layer_name, gdf in layers.items():
+            if gdf is None or gdf.empty:
+                continue
+            # カテゴリ型の列は書き出し先（GDAL）に合わせて文字列に戻す
+            gdf = gdf.astype({column: object for column in gdf.select_dtypes('category').columns})
+            for export_format in export_formats:
+                file_name = f"{base_name}_{layer_name}.{EXPORT_FORMATS[export_format]['extension']}"
+                targets.append((export_format, gdf, f"{base_name}_{layer_name}", os.path.join(temp_dir, file_name)))
+        
+        if not targets:
+            raise Exception("出力できるデータがありません")
+        
+        with ThreadPoolExecutor(max_workers=EXPORT_MAX_WORKERS, thread_name_prefix='koji-export') as executor:
+            futures = [
+                executor.submit(EXPORT_FORMATS[export_format]['writer'], gdf, path, name)
+                for export_format, gdf, name, path in targets
+            ]
+            for future in futures:
+                future.result()
+        
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as bundle:
+            for export_format, _, _, path in targets:
+                compression = zipfile.ZIP_DEFLATED if EXPORT_FORMATS[export_format]['compress'] else zipfile.ZIP_STORED
+                bundle.write(path, os.path.basename(path), compress_type=compression)
+        return buffer.getvalue()
+
+def read_batch_requests(file_obj, file_name):
+    """一括抽出の依頼一覧（CSV/Excel）を読み込み"""
+    if file_name.lower().endswith(('.xlsx', '.xls')):
+        return normalize_batch_requests(pd.read_excel(file_obj, dtype=str))
+    
+    raw = file_obj.read()
+    for encoding in ('utf-8-sig', 'cp932'):
+        try:
+            return normalize_batch_requests(pd.read_csv(io.BytesIO(raw), dtype=str, encoding=encoding))
+        except UnicodeDecodeError:
+            continue
+    raise Exception("CSVの文字コードを判別できません（UTF-8またはShift-JISで保存してください）")
+
+def normalize_batch_requests(df, default_range_m=DEFAULT_RANGE_M):
+    """依頼一覧の列名（別名）と値（前後の空白・空欄・「選択なし」）を揃え、依頼番号と検索範囲（m）を付与"""
+    df = df.rename(columns=lambda column: BATCH_COLUMN_ALIASES.get(str(column).strip(), str(column).strip()))
+    
+    missing_columns = [column for column in ('大字名', '地番') if column not in df.columns]
+    if missing_columns:
+        raise Exception(f"依頼一覧に必要な列が見つかりません: {missing_columns}")
+    
+    requests_df = pd.DataFrame({'依頼番号': np.arange(1, len(df) + 1)})
+    
+    # 市区町村（コード・名称）は県全体の一括抽出での振り分けに使用するため、指定がある場合のみ残す
+    for column in ['市区町村'] + KOJI_ATTRIBUTE_COLUMNS:
+        if column == '市区町村' and column not in df.columns:
+            continue
+        values = df[column].tolist() if column in df.columns else [None] * len(df)
+        requests_df[column] = [
+            value.strip() if isinstance(value, str) and value.strip() not in ('', '選択なし') else None
+            for value in values
+        ]
+    
+    # 検索範囲は空欄なら既定値、数値でない・0以下の場合はNaN（入力不備）
+    if '検索範囲' in df.columns:
+        range_values = pd.to_numeric(df['検索範囲'], errors='coerce').to_numpy(dtype=float, copy=True)
+        range_values[df['検索範囲'].isna().to_numpy()] = default_range_m
+        range_values[range_values <= 0] = np.nan
+    else:
+        range_values = np.full(len(df), float(default_range_m))
+    requests_df['検索範囲'] = range_values
+    
+    return requests_df
+
+class KojiDataset:
+    """読み込み済みデータセット（全セッションで共有するため読み取り専用として扱う）
+    
+    属性のみで読み込んだ場合（geometry_store指定時）は、ジオメトリを必要な筆だけ.shpから読み込み、
+    全件のジオメトリはgdfに初めてアクセスした時点で読み込む。
+    """
+    def __init__(self, key, gdf=None, attributes=None, geometry_store=None, shp_path=None,
+                 on_geometry_loaded=None, compact=True):
+        self.key = key
+        # 読み込んだ属性はcompact_attributesで縮小して保持（memory_reportに変換前後のバイト数）
+        self.memory_report = None
+        if compact and gdf is not None:
+            gdf, self.memory_report = compact_attributes(gdf)
+        elif compact and attributes is not None:
+            attributes, self.memory_report = compact_attributes(attributes)
+        self._gdf = gdf
+        self._attributes = attributes
+        self._frame_nbytes = None
+        self.geometry_store = geometry_store
+        self._shp_path = shp_path
+        self._on_geometry_loaded = on_geometry_loaded
+        self._address_index = None
+        self._address_hierarchy = None
+        self._chiban_index = None
+        self._spatial_index = None
+        self._lock = threading.Lock()
+    
+    @property
+    def address_index(self):
+        """所在の索引（初回参照時に作成）"""
+        if self._address_index is None:
+            with self._lock:
+                if self._address_index is None:
+                    self._address_index = AddressIndex(self.attributes)
+        return self._address_index
+    
+    @property
+    def address_hierarchy(self):
+        """大字名 → 丁目名・小字名の選択肢の階層索引（初回参照時に作成）"""
+        if self._address_hierarchy is None:
+            with self._lock:
+                if self._address_hierarchy is None:
+                    self._address_hierarchy = AddressHierarchy(self.attributes)
+        return self._address_hierarchy
+    
+    @property
+    def chiban_index(self):
+        """地番の検索索引（初回参照時に所在の索引の正規化キーから作成）"""
+        if self._chiban_index is None:
+            chiban_keys = self.address_index.keys['地番']
+            with self._lock:
+                if self._chiban_index is None:
+                    self._chiban_index = ChibanIndex(chiban_keys)
+        return self._chiban_index
+    
+    @property
+    def spatial_index(self):
+        """筆の外接矩形による空間索引（初回参照時に作成、全件未読込の場合は.shpのレコードヘッダから作成）"""
+        if self._spatial_index is None:
+            with self._lock:
+                if self._spatial_index is None:
+                    if self._gdf is not None:
+                        bounds = shapely.bounds(np.asarray(self._gdf.geometry.values))
+                    else:
+                        bounds = self.geometry_store.bounds()
+                    self._spatial_index = SpatialIndex(bounds)
+        return self._spatial_index
+    
+    @property
+    def attributes(self):
+        """属性データ（ジオメトリの読み込みを待たずに参照可能）"""
+        return self._gdf if self._gdf is not None else self._attributes
+    
+    @property
+    def crs(self):
+        """座標参照系"""
+        return self._gdf.crs if self._gdf is not None else self.geometry_store.crs
+    
+    @property
+    def is_geometry_loaded(self):
+        """全件のジオメトリが読み込み済みか"""
+        return self._gdf is not None
+    
+    @property
+    def gdf(self):
+        """全件のGeoDataFrame（属性のみで読み込んだ場合はここで初めてジオメトリを読み込む）"""
+        if self._gdf is None:
+            with self._lock:
+                if self._gdf is None:
+                    self.geometry_store.ensure_shp()
+                    geometry = gpd.read_file(
+                        self._shp_path, columns=[], fid_as_index=True, engine='pyogrio', use_arrow=True
+                    ).geometry
+                    self._gdf = gpd.GeoDataFrame(self._attributes, geometry=geometry.values, crs=self.crs)
+                    self._attributes = None
+                    
+                    if self._on_geometry_loaded is not None:
+                        self._on_geometry_loaded(self._gdf)
+        return self._gdf
+    
+    def geometries(self, index):
+        """指定した行のジオメトリを取得（全件未読込の場合は該当レコードのみ.shpから読み込み）"""
+        if self._gdf is not None:
+            return self._gdf.geometry.loc[index]
+        return gpd.GeoSeries(self.geometry_store.geometries(index), index=index, crs=self.crs)
+    
+    @property
+    def nbytes(self):
+        """おおよそのメモリ使用量（バイト）"""
+        index_bytes = sum(
+            index.nbytes
+            for index in (self._address_index, self._address_hierarchy, self._chiban_index, self._spatial_index)
+            if index is not None
+        )
+        # データの推定は全件を走査するため、参照しているデータが変わった場合のみ再計算
+        frame = self._gdf if self._gdf is not None else self._attributes
+        if self._frame_nbytes is None or self._frame_nbytes[0] is not frame:
+            frame_bytes = estimate_gdf_nbytes(frame) if self._gdf is not None else estimate_frame_nbytes(frame)
+            self._frame_nbytes = (frame, frame_bytes)
+        return self._frame_nbytes[1] + index_bytes
+
+class DatasetRegistry:
+    """プロセス内の全セッションで共有するデータセット登録簿（メモリ上限付きLRU）"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._datasets = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+    
+    def get(self, key):
+        """データセットを取得（最近使用したものとして記録）"""
+        with self._lock:
+            dataset = self._datasets.get(key)
+            if dataset is not None:
+                self._datasets.move_to_end(key)
+            return dataset
+    
+    def get_or_load(self, key, loader):
+        """未登録の場合のみloaderでKojiDatasetを読み込み（同じデータセットの同時読み込みは1回にまとめる）"""
+        dataset = self.get(key)
+        if dataset is not None:
+            return dataset
+        
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        
+        with load_lock:
+            dataset = self.get(key)
+            if dataset is None:
+                dataset = loader()
+                self.add(dataset)
+        
+        with self._lock:
+            self._load_locks.pop(key, None)
+        
+        return dataset
+    
+    def add(self, dataset):
+        """データセットを登録し、上限を超えた分を最も古く使われたものから解放"""
+        with self._lock:
+            self._datasets[dataset.key] = dataset
+            self._datasets.move_to_end(dataset.key)
+            self._evict()
+    
+    def enforce_budget(self, key):
+        """登録後にメモリ使用量が増えたデータセットについて上限を再確認（keyのデータセットは使用中のため残す）"""
+        with self._lock:
+            if key in self._datasets:
+                self._datasets.move_to_end(key)
+            self._evict()
+    
+    def _evict(self):
+        """上限を超えた分を最も古く使われたものから解放（呼び出し側でロックを取得済みであること）"""
+        while len(self._datasets) > 1 and self.total_bytes() > self.max_bytes:
+            self._datasets.popitem(last=False)
+    
+    def total_bytes(self):
+        """登録済みデータセットの合計メモリ使用量"""
+        return sum(dataset.nbytes for dataset in self._datasets.values())
+    
+    def summary(self):
+        """登録状況の一覧（最近使用した順）"""
+        with self._lock:
+            return [
+                {'key': dataset.key, 'nbytes': dataset.nbytes}
+                for dataset in reversed(self._datasets.values())
+            ]
+
+@st.cache_resource
+def get_dataset_registry():
+    """全セッションで共有するデータセット登録簿を取得"""
+    return DatasetRegistry(DATASET_MEMORY_LIMIT_MB * 1024 * 1024)
+
+class ExtractionResultCache:
+    """抽出結果のキャッシュ（全セッション共通、有効期限とメモリ上限付きLRU）
+    
+    同じデータセット・所在・検索範囲の抽出結果を再利用する。結果のGeoDataFrameは複数のセッションで
+    共有するため読み取り専用として扱う。
+    """
+    def __init__(self, max_bytes, ttl_seconds):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        # キー → （有効期限, メモリ使用量, 抽出結果）
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def get(self, key, count=True):
+        """抽出結果を取得（無い場合・有効期限切れの場合はNone、count=Falseの場合はヒット・ミスに数えない）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            
+            if entry is None:
+                self.misses += count
+                return None
+            
+            self._entries.move_to_end(key)
+            self.hits += count
+            return entry[2]
+    
+    def put(self, key, result):
+        """抽出結果を登録し、上限を超えた分を最も古く使われたものから削除"""
+        nbytes = self._estimate_nbytes(result)
+        if nbytes > self.max_bytes:
+            return
+        
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, nbytes, result)
+            self._total_bytes += nbytes
+            
+            while self._total_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+    
+    def _estimate_nbytes(self, result):
+        """抽出結果のおおよそのメモリ使用量"""
+        return sum(estimate_gdf_nbytes(gdf) for gdf in result if isinstance(gdf, gpd.GeoDataFrame))
+    
+    def _remove(self, key):
+        """登録を削除（ロック取得済みで呼び出す）"""
+        _, nbytes, _ = self._entries.pop(key)
+        self._total_bytes -= nbytes
+    
+    def stats(self):
+        """ヒット・ミス等の件数とメモリ使用量"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'entries': len(self._entries),
+                'nbytes': self._total_bytes
+            }
+
+@st.cache_resource
+def get_result_cache():
+    """全セッションで共有する抽出結果キャッシュを取得"""
+    return ExtractionResultCache(RESULT_CACHE_MEMORY_MB * 1024 * 1024, RESULT_CACHE_TTL_SECONDS)
+
+class ExportCache(ExtractionResultCache):
+    """ダウンロード用ファイル（KML/CSV）のキャッシュ（全セッション共通、抽出結果・形式ごとに1回だけ作成）"""
+    def __init__(self, max_bytes, ttl_seconds):
+        super().__init__(max_bytes, ttl_seconds)
+        self._build_locks = {}
+    
+    def get_or_create(self, key, builder):
+        """作成済みのファイルを取得し、無い場合はbuilderで作成（同じファイルの同時作成は1回にまとめる）"""
+        data = self.get(key)
+        if data is not None:
+            return data
+        
+        with self._lock:
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+        
+        with build_lock:
+            # 待っている間に他のセッションが作成した場合はそれを使用
+            data = self.get(key, count=False)
+            if data is None:
+                data = builder()
+                self.put(key, data)
+        
+        with self._lock:
+            self._build_locks.pop(key, None)
+        
+        return data
+    
+    def _estimate_nbytes(self, data):
+        """ファイルの大きさ"""
+        return len(data)
+
+@st.cache_resource
+def get_export_cache():
+    """全セッションで共有するダウンロード用ファイルキャッシュを取得"""
+    return ExportCache(EXPORT_CACHE_MEMORY_MB * 1024 * 1024, RESULT_CACHE_TTL_SECONDS)
+
+class DatasetPrefetcher:
+    """フォルダ内のファイルをバックグラウンドで並列にダウンロード・変換するプリフェッチャー（全セッション共通）
+    
+    先読みはフォルダURLごとに管理し、別のフォルダの先読みを開始・中止しても他のフォルダの先読みには影響しない。
+    同時実行数は全フォルダで共有するスレッドプールで制限する。
+    """
+    def __init__(self, max_workers=PREFETCH_MAX_WORKERS):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='koji-prefetch')
+    
+    def start(self, folder_url, files, task):
+        """フォルダの先読みを開始（同じフォルダを実行中の場合は何もしない）"""
+        with self._lock:
+            job = self._jobs.get(folder_url)
+            if job is not None and job['done'] < job['total']:
+                return
+            
+            job = {
+                'folder_url': folder_url,
+                'total': len(files),
+                'done': 0,
+                'errors': [],
+                'cancelled': False,
+                'cancel_event': threading.Event(),
+                'futures': []
+            }
+            self._jobs[folder_url] = job
+        
+        job['futures'] = [self._executor.submit(self._run, job, task, file_info) for file_info in files]
+    
+    def _run(self, job, task, file_info):
+        """1ファイル分の先読み（中止済みの場合はスキップ）"""
+        try:
+            if not job['cancel_event'].is_set():
+                task(file_info)
+        except Exception as e:
+            with self._lock:
+                job['errors'].append(f"{file_info['name']}: {str(e)}")
+        finally:
+            with self._lock:
+                job['done'] += 1
+    
+    def cancel(self, folder_url):
+        """フォルダの実行中の先読みを中止（処理中のファイルは完了まで続行）"""
+        with self._lock:
+            job = self._jobs.get(folder_url)
+            if job is None or job['done'] >= job['total']:
+                return
+            job['cancelled'] = True
+        
+        job['cancel_event'].set()
+        for future in job['futures']:
+            if future.cancel():
+                with self._lock:
+                    job['done'] += 1
+    
+    def status(self, folder_url):
+        """フォルダの先読みの進捗状況を取得（未開始の場合はNone）"""
+        with self._lock:
+            job = self._jobs.get(folder_url)
+            if job is None:
+                return None
+            return {key: value for key, value in job.items() if key not in ('cancel_event', 'futures')}
+
+@st.cache_resource
+def get_dataset_prefetcher():
+    """全セッションで共有するプリフェッチャーを取得"""
+    return DatasetPrefetcher()
+
+class MunicipalityIndex:
+    """全国地方公共団体コード一覧から作成した、市区町村コード・名称・カナ読みの索引"""
+    def __init__(self, entries):
+        # 市区町村コード（5桁）→ {'code', 'prefecture', 'name', 'kana'}
+        self.entries = entries
+        self._by_name = {}
+        self._by_kana = {}
+        self._by_kana_stem = {}
+        for code, entry in entries.items():
+            for name in (entry['name'], entry['prefecture'] + entry['name']):
+                self._by_name.setdefault(normalize_municipality_name(name), []).append(code)
+            kana = normalize_kana(entry['kana'])
+            self._by_kana.setdefault(kana, []).append(code)
+            self._by_kana_stem.setdefault(strip_kana_suffix(kana), []).append(code)
+        
+        # 前方一致検索用に正規化済みのキーを整列しておく
+        self._name_keys = sorted(self._by_name)
+        self._kana_keys = sorted(self._by_kana)
+        self._kana_stem_keys = sorted(self._by_kana_stem)
+    
+    @classmethod
+    def from_excel(cls, path=MUNICIPALITY_CODE_LIST_PATH):
+        """団体コード一覧（Excel）から作成（政令指定都市の区のシートも含める）"""
+        entries = {}
+        for sheet in pd.read_excel(path, sheet_name=None, dtype=str).values():
+            # 列名はシートごとに表記が異なるため位置で参照（団体コード, 都道府県名, 市区町村名, 都道府県名カナ, 市区町村名カナ）
+            for code, prefecture, name, _, kana in sheet.iloc[:, :5].itertuples(index=False):
+                if pd.isna(code) or pd.isna(name):
+                    continue
+                # 団体コードは末尾1桁が検査数字のため、電子公図のファイル名と同じ5桁に揃える
+                code = str(code).strip()[:5]
+                entries.setdefault(code, {
+                    'code': code,
+                    'prefecture': str(prefecture).strip(),
+                    'name': str(name).strip(),
+                    'kana': '' if pd.isna(kana) else str(kana).strip()
+                })
+        return cls(entries)
+    
+    @classmethod
+    def load(cls, path=MUNICIPALITY_CODE_LIST_PATH, cache_dir=None):
+        """変換済みの索引があれば読み込み、無い場合や一覧が更新された場合はExcelから作成して保存"""
+        cache_path = os.path.join(cache_dir or KOJI_CACHE_DIR, 'municipality_index.json')
+        stat = os.stat(path)
+        source = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached.get('source') == source:
+                return cls(cached['entries'])
+        except (OSError, ValueError):
+            pass
+        
+        index = cls.from_excel(path)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'source': source, 'entries': index.entries}, f, ensure_ascii=False)
+        os.replace(temp_path, cache_path)
+        return index
+    
+    def lookup(self, query, limit=10):
+        """コード（5桁/6桁）・名称・カナ読みから市区町村を検索（完全一致→前方一致→類似の順）"""
+        query = unicodedata.normalize('NFKC', str(query)).strip()
+        if not query:
+            return []
+        
+        if query.isdigit():
+            entry = self.entries.get(query[:5]) if len(query) in (5, 6) else None
+            return [entry] if entry else []
+        
+        name = normalize_municipality_name(query)
+        kana = normalize_kana(query)
+        candidates = ((self._name_keys, self._by_name, name), (self._kana_keys, self._by_kana, kana))
+        
+        for _, index, key in candidates:
+            if key in index:
+                return [self.entries[code] for code in index[key]][:limit]
+        
+        codes = []
+        for keys, index, key in candidates:
+            position = bisect_left(keys, key)
+            while position < len(keys) and keys[position].startswith(key) and len(codes) < limit:
+                codes.extend(index[keys[position]])
+                position += 1
+        
+        if not codes:
+            # 入力の誤りは類似度で補う（完全一致・前方一致で見つからない場合のみ、読みは種別部分を除いて比較）
+            fuzzy_candidates = (
+                (self._name_keys, self._by_name, name),
+                (self._kana_stem_keys, self._by_kana_stem, strip_kana_suffix(kana))
+            )
+            for keys, index, key in fuzzy_candidates:
+                for match in difflib.get_close_matches(key, keys, n=limit, cutoff=0.75):
+                    codes.extend(index[match])
+        
+        return [self.entries[code] for code in dict.fromkeys(codes)][:limit]
+
+@st.cache_resource
+def get_municipality_index():
+    """全セッションで共有する市区町村索引を取得"""
+    return MunicipalityIndex.load()
+
+class PrefectureDataset:
+    """複数の市区町村データセットを市区町村コードで区分して束ねた統合データセット
+    
+    属性は全区分を1つの表にまとめて県全体を一度に検索できるようにし、ジオメトリは各区分の
+    データセット（座標系は公共座標系ごとの元のまま）から必要な筆だけ取得する。
+    """
+    def __init__(self, key, partitions, attributes, name=None):
+        self.key = key
+        self.name = name
+        # 市区町村コード → 区分情報（市区町村名・座標系・データセットキー・URL等）
+        self.partitions = partitions
+        # 全区分の属性（市区町村コード・区分データセット内の行番号fid付き）
+        self.attributes, self.memory_report = compact_attributes(
+            attributes, columns=['市区町村コード'] + KOJI_ATTRIBUTE_COLUMNS + ['fid']
+        )
+        # 検索・依頼の振り分け用の正規化キー（大字名・地番、行は属性と同じ順）
+        self.address_keys = pd.DataFrame({
+            '市区町村コード': self.attributes['市区町村コード'],
+            '大字名': normalize_address_column(self.attributes['大字名']),
+            '地番': normalize_address_column(self.attributes['地番'], chiban=True)
+        })
+    
+    def search(self, oaza=None, chiban=None, codes=None):
+        """県全体から大字名（部分一致）・地番（完全一致）で検索（条件・属性とも正規化して照合）"""
+        attributes = self.attributes
+        keys = self.address_keys
+        mask = pd.Series(True, index=attributes.index)
+        if codes:
+            mask &= attributes['市区町村コード'].isin(codes)
+        if oaza:
+            mask &= keys['大字名'].str.contains(normalize_address_key(oaza), regex=False, na=False)
+        if chiban:
+            mask &= keys['地番'] == normalize_address_key(chiban, chiban=True)
+        return attributes[mask]
+    
+    @property
+    def nbytes(self):
+        """おおよそのメモリ使用量（バイト）"""
+        return self.memory_report['after'] + int(self.address_keys.memory_usage(deep=True).sum())
+
 class KojiWebExtractor:
     def __init__(self):
-        if 'gdf' not in st.session_state:
-            st.session_state.gdf = None
+        self.dataset_cache = DatasetCache()
+        self.registry = get_dataset_registry()
+        self.http = get_http_client()
+        self.download_cache = get_download_cache()
+        self.result_cache = get_result_cache()
+        self.export_cache = get_export_cache()
+        if 'dataset_key' not in st.session_state:
+            st.session_state.dataset_key = None
         if 'web_files_cache' not in st.session_state:
             st.session_state.web_files_cache = {}
     
@@ -88,7 +1987,7 @@ class KojiWebExtractor:
                 if github_token:
                     headers['Authorization'] = f'token {github_token}'
                 
-                response = requests.get(api_url, headers=headers, timeout=30)
+                response = self.http.get(api_url, headers=headers, timeout=30)
                 
                 if response.status_code == 403:
                     # レート制限の場合、代替方法を使用
@@ -110,6 +2009,7 @@ class KojiWebExtractor:
                                 'name': file_name,
                                 'url': raw_url,
                                 'size': item.get('size', 0),
+                                'sha': item.get('sha'),
                                 'description': f"GitHubファイル ({item.get('size', 0)} bytes)"
                             })
                 
@@ -140,7 +2040,7 @@ class KojiWebExtractor:
             # GitHub Webページから情報を取得
             web_url = f"https://github.com/{user}/{repo}/tree/{branch}/{path}"
             
-            response = requests.get(web_url, timeout=30)
+            response = self.http.get(web_url, timeout=30)
             response.raise_for_status()
             
             soup = BeautifulSoup(response.content, 'html.parser')
@@ -232,7 +2132,7 @@ class KojiWebExtractor:
     def _get_generic_web_folder_files(self, folder_url, file_extensions):
         """一般的なWebフォルダからファイル一覧を取得（HTMLパース）"""
         try:
-            response = requests.get(folder_url, timeout=30)
+            response = self.http.get(folder_url, timeout=30)
             response.raise_for_status()
             
             soup = BeautifulSoup(response.content, 'html.parser')
@@ -282,168 +2182,797 @@ class KojiWebExtractor:
         except Exception as e:
             raise Exception(f"Webフォルダ処理エラー: {str(e)}")
     
+    def _resolve_download_url(self, url):
+        """GitHubのファイル表示URLを生ファイルURLに変換"""
+        if 'github.com' in url and '/blob/' in url:
+            url = url.replace('github.com', 'raw.githubusercontent.com').replace('/blob/', '/')
+        return url
+    
     def download_file_from_url(self, url):
-        """URLからファイルをダウンロード"""
+        """URLからファイルをダウンロード（ディスクキャッシュ経由、読み込み用に開いたファイルを返す）"""
         try:
-            # GitHubの生ファイルURLに変換
-            if 'github.com' in url and '/blob/' in url:
-                url = url.replace('github.com', 'raw.githubusercontent.com').replace('/blob/', '/')
+            return self.download_cache.fetch(self._resolve_download_url(url))
             
-            response = requests.get(url, timeout=30)
-            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"ファイルのダウンロードに失敗しました: {str(e)}")
+    
+    def load_shapefile_from_url(self, url, content_key=None):
+        """URLからShapefileを読み込み"""
+        return self.load_dataset_from_url(url, content_key=content_key).gdf
+    
+    def load_dataset_from_url(self, url, content_key=None):
+        """URLから共有データセットを読み込み（content_keyにGitHubのblob SHAを渡すとダウンロード前にキャッシュを参照）"""
+        try:
+            if content_key is not None:
+                dataset = self.registry.get(content_key)
+                if dataset is not None:
+                    return dataset
+                if self.dataset_cache.contains(content_key) or self.dataset_cache.has_shapefile(content_key):
+                    return self.load_cached_dataset(content_key)
             
-            return io.BytesIO(response.content)
+            # ZIPファイルはRange対応のサーバーであれば中央ディレクトリと必要なメンバーだけを取得
+            # （先読み等で全体を取得済みの場合は、内容ハッシュで変換済みキャッシュを引けるよう通常の取得を使う）
+            if urlparse(url).path.lower().endswith('.zip') and not self.download_cache.contains(self._resolve_download_url(url)):
+                dataset = self.load_remote_zip_dataset(url, content_key=content_key)
+                if dataset is not None:
+                    return dataset
             
+            with self.download_file_from_url(url) as file_obj:
+                # ZIPファイルの場合はディスクに展開せずそのまま読み込み
+                if zipfile.is_zipfile(file_obj):
+                    return self.load_dataset_from_zip(file_obj)
+                
+                # ZIPファイルでない場合、直接SHPファイルとして読み込みを試行
+                key = compute_content_hash(file_obj)
+                return self.registry.get_or_load(
+                    key,
+                    lambda: self._convert_to_cache(key, lambda: self._read_single_shapefile(file_obj, url))
+                )
+                        
+        except Exception as e:
+            raise Exception(f"Shapefileの読み込みに失敗しました: {str(e)}")
+    
+    def load_remote_zip_dataset(self, url, content_key=None):
+        """リモートZIPをHTTP Rangeで部分的に読み込み（Range非対応のサーバーの場合はNoneを返す）"""
+        try:
+            remote_file = HttpRangeFile.open(self.http, self._resolve_download_url(url))
         except requests.exceptions.RequestException as e:
             raise Exception(f"ファイルのダウンロードに失敗しました: {str(e)}")
+        
+        if remote_file is None:
+            return None
+        
+        key = content_key or remote_file.content_key()
+        return self.registry.get_or_load(key, lambda: self._open_remote_zip_dataset(key, remote_file))
+    
+    def _open_remote_zip_dataset(self, key, remote_file):
+        """属性の閲覧に必要な.dbf/.shx/.prj/.cpgだけを取得して開く（.shpはジオメトリが必要になった時点で取得）"""
+        if not self.dataset_cache.contains(key):
+            self.dataset_cache.set_source_url(key, remote_file.url)
+            self.dataset_cache.extract_shapefile(key, remote_file, extensions=('.dbf', '.shx', '.prj', '.cpg'))
+        return self._open_cached_dataset(key)
+    
+    def _fetch_remote_shp(self, key):
+        """属性のみ取得済みのデータセットの.shpをリモートZIPから取得
+        
+        共有データセットにHttpRangeFile（先読みしたデータを保持）を持たせ続けないよう、取得元のURLから開き直す。
+        """
+        url = self.dataset_cache.source_url(key)
+        remote_file = HttpRangeFile.open(self.http, url) if url else None
+        if remote_file is None:
+            raise Exception("ジオメトリ（.shp）の取得元が見つかりません。再度読み込んでください。")
+        
+        self.dataset_cache.extract_shapefile(key, remote_file, extensions=('.shp',))
+    
+    def _read_single_shapefile(self, file_obj, url):
+        """ZIP以外のファイルを一時ファイル経由で読み込み"""
+        file_obj.seek(0)  # ファイルポインタをリセット
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # 一時的にファイルを保存
+            temp_file = os.path.join(temp_dir, "temp_file")
+            with open(temp_file, 'wb') as f:
+                f.write(file_obj.read())
+            
+            # 拡張子を推測してリネーム
+            if url.lower().endswith('.shp'):
+                shp_file = temp_file + '.shp'
+                os.rename(temp_file, shp_file)
+                temp_file = shp_file
+            
+            return gpd.read_file(temp_file, columns=KOJI_ATTRIBUTE_COLUMNS, engine='pyogrio', use_arrow=True)
+    
+    def load_cached_dataset(self, key):
+        """変換済みキャッシュから共有データセットを取得"""
+        return self.registry.get_or_load(key, lambda: self._open_cached_dataset(key))
+    
+    def _open_cached_dataset(self, key):
+        """GeoParquetがあれば全件、取り出し済みShapefileのみの場合は属性のみで開く"""
+        if self.dataset_cache.contains(key):
+            return KojiDataset(key, gdf=self.dataset_cache.load(key))
+        return self._open_attributes_first(
+            key,
+            self.dataset_cache.shapefile_path(key),
+            fetch_shp=lambda: self._fetch_remote_shp(key)
+        )
+    
+    def load_dataset_from_zip(self, file_obj):
+        """ZIPファイルを内容ハッシュで照合し、共有データセットまたは変換済みキャッシュがあればそこから読み込み"""
+        key = compute_content_hash(file_obj)
+        return self.registry.get_or_load(key, lambda: self._open_zip_dataset(key, file_obj))
+    
+    def _open_zip_dataset(self, key, file_obj):
+        """ZIPファイルを開く（変換済みでなければ属性のみ先に読み込み、ジオメトリは必要になった時点で読み込む）"""
+        if self.dataset_cache.contains(key):
+            return KojiDataset(key, gdf=self.dataset_cache.load(key))
+        
+        shp_path = self.dataset_cache.extract_shapefile(key, file_obj)
+        return self._open_attributes_first(key, shp_path)
+    
+    def _open_attributes_first(self, key, shp_path, fetch_shp=None):
+        """.dbfの属性列だけを読み込み、ジオメトリは.shx/.shpから必要な筆だけ参照するデータセットを作成"""
+        base = os.path.splitext(shp_path)[0]
+        
+        # .shpが未取得でも開けるよう.dbfと.prjを直接読み込む
+        attributes = gpd.read_file(
+            base + '.dbf', read_geometry=False, columns=KOJI_ATTRIBUTE_COLUMNS,
+            fid_as_index=True, engine='pyogrio', use_arrow=True
+        )
+        crs = None
+        if os.path.exists(base + '.prj'):
+            with open(base + '.prj', 'r', encoding='utf-8', errors='ignore') as f:
+                crs = pyproj.CRS.from_wkt(f.read())
+            epsg = crs.to_epsg()
+            if epsg:
+                crs = f"EPSG:{epsg}"
+        
+        geometry_store = ShapefileGeometryStore(shp_path, crs=crs, fetch_shp=fetch_shp)
+        
+        return KojiDataset(
+            key,
+            attributes=attributes,
+            geometry_store=geometry_store,
+            shp_path=shp_path,
+            on_geometry_loaded=lambda gdf: self._on_geometry_loaded(key, gdf)
+        )
+    
+    def _on_geometry_loaded(self, key, gdf):
+        """全件のジオメトリを読み込んだデータセットをキャッシュに保存し、増えた分を含めてメモリ上限を再確認"""
+        self._store_dataset_cache(key, gdf)
+        self.registry.enforce_budget(key)
+    
+    def _convert_to_cache(self, key, reader):
+        """Shapefileを読み込み、GeoParquetキャッシュに保存（変換済みの場合はキャッシュを使用）"""
+        if self.dataset_cache.contains(key):
+            return KojiDataset(key, gdf=self.dataset_cache.load(key))
+        
+        gdf = reader()
+        self._store_dataset_cache(key, gdf)
+        
+        return KojiDataset(key, gdf=gdf)
+    
+    def _store_dataset_cache(self, key, gdf):
+        """GeoParquetキャッシュに保存（失敗しても読み込み処理は継続）"""
+        try:
+            self.dataset_cache.store(key, gdf)
+        except Exception as e:
+            st.warning(f"⚠️ データセットキャッシュの保存に失敗しました: {str(e)}")
+    
+    def prefetch_dataset(self, file_info):
+        """ファイルをダウンロードしてGeoParquetキャッシュに変換（バックグラウンド実行用、画面出力なし）"""
+        if self.dataset_cache.contains(file_info.get('sha')):
+            return
+        
+        with self.download_file_from_url(file_info['url']) as file_obj:
+            if not zipfile.is_zipfile(file_obj):
+                return
+            
+            key = compute_content_hash(file_obj)
+            if not self.dataset_cache.contains(key):
+                self.dataset_cache.store(key, self.load_shapefile_from_zip(file_obj))
+    
+    def set_current_dataset(self, dataset, name=None):
+        """このセッションで使用するデータセットを設定（セッションにはキーと表示名のみ保持）
+        
+        データセットは全セッションで共有するため、表示名はデータセットではなくセッション側に保持する。
+        """
+        st.session_state.dataset_key = dataset.key
+        st.session_state.dataset_name = name or dataset.key
+    
+    def get_current_dataset(self):
+        """このセッションのデータセットを取得（メモリ上限で解放済みの場合はキャッシュから再読み込み）"""
+        key = st.session_state.get('dataset_key')
+        if key is None:
+            return None
+        
+        dataset = self.registry.get(key)
+        if dataset is not None:
+            return dataset
+        
+        if self.dataset_cache.contains(key) or self.dataset_cache.has_shapefile(key):
+            return self.load_cached_dataset(key)
+        
+        st.session_state.dataset_key = None
+        st.warning("⚠️ メモリ上限によりデータセットが解放されました。再度読み込んでください。")
+        return None
+    
+    def store_folder_routes(self, folder_url, files):
+        """ファイル一覧から市区町村コード → ファイルの経路表を作成して保存"""
+        routes = {}
+        for file_info in files:
+            parsed = parse_koji_file_name(file_info['name'])
+            if parsed is not None:
+                routes[parsed['code']] = file_info
+        
+        if routes:
+            self.dataset_cache.store_routes(folder_url, routes)
+        return routes
+    
+    def get_folder_routes(self, folder_url):
+        """フォルダの経路表を取得（保存済みの場合はフォルダ一覧を取得しない）"""
+        routes = self.dataset_cache.load_routes(folder_url)
+        if routes is None:
+            routes = self.store_folder_routes(folder_url, self.get_files_from_web_folder(folder_url))
+        return routes
+    
+    def resolve_municipality(self, folder_url, query):
+        """市区町村コード・名称・カナ読みからフォルダ内の該当ファイルを検索"""
+        routes = self.get_folder_routes(folder_url)
+        matches = []
+        for entry in get_municipality_index().lookup(query):
+            if entry['code'] in routes:
+                matches.append(dict(entry, file=routes[entry['code']]))
+        return matches
+    
+    def build_prefecture_dataset(self, folder_url, files, progress_callback=None):
+        """フォルダ内の全市区町村ファイルを並列に読み込み、市区町村コードで区分した統合データセットを作成
+        
+        戻り値は（統合データセット, エラーメッセージの一覧）。全ファイルにGitHubのblob SHAがある場合は
+        保存済みの統合データセットを再利用する。
+        """
+        targets = []
+        errors = []
+        for file_info in files:
+            parsed = parse_koji_file_name(file_info['name'])
+            if parsed is None:
+                errors.append(f"{file_info['name']}: ファイル名から市区町村コードを取得できません")
+            else:
+                targets.append((parsed, file_info))
+        
+        if not targets:
+            raise Exception("統合できる市区町村ファイルが見つかりません")
+        
+        # 構成ファイル（名前とblob SHA、無い場合はURL）から統合データセットのキーを作成
+        source_ids = sorted(f"{file_info['name']}\0{file_info.get('sha') or file_info['url']}" for _, file_info in targets)
+        key = 'pref_' + hashlib.sha1('\n'.join(source_ids).encode('utf-8')).hexdigest()
+        reusable = all(file_info.get('sha') for _, file_info in targets)
+        
+        prefecture = self.registry.get(key) if reusable else None
+        if prefecture is None and reusable:
+            prefecture = self.dataset_cache.load_prefecture(key)
+            if prefecture is not None:
+                self.registry.add(prefecture)
+        if prefecture is not None:
+            return prefecture, errors
+        
+        def load_partition(parsed, file_info):
+            dataset = self.load_dataset_from_url(file_info['url'], content_key=file_info.get('sha'))
+            # 丁目名・小字名の無いファイルもあるため、無い列は空欄で揃える
+            attributes = pd.DataFrame(dataset.attributes.reindex(columns=KOJI_ATTRIBUTE_COLUMNS))
+            attributes.insert(0, '市区町村コード', parsed['code'])
+            attributes['fid'] = attributes.index
+            partition = dict(parsed, file_name=file_info['name'], url=file_info['url'], key=dataset.key,
+                             crs=str(dataset.crs), count=len(attributes))
+            return partition, attributes
+        
+        partitions = {}
+        frames = []
+        with ThreadPoolExecutor(max_workers=PREFETCH_MAX_WORKERS, thread_name_prefix='koji-prefecture') as executor:
+            futures = {executor.submit(load_partition, parsed, file_info): file_info for parsed, file_info in targets}
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    partition, attributes = future.result()
+                    partitions[partition['code']] = partition
+                    frames.append(attributes)
+                except Exception as e:
+                    errors.append(f"{futures[future]['name']}: {str(e)}")
+                
+                if progress_callback is not None:
+                    progress_callback(done, len(targets))
+        
+        if not frames:
+            raise Exception("市区町村ファイルを1件も読み込めませんでした")
+        
+        # 市区町村コード順に並べ、コードは繰り返しが多いためカテゴリ型で保持
+        attributes = pd.concat(sorted(frames, key=lambda frame: frame['市区町村コード'].iloc[0]), ignore_index=True)
+        attributes['市区町村コード'] = attributes['市区町村コード'].astype('category')
+        partitions = dict(sorted(partitions.items()))
+        
+        prefecture = PrefectureDataset(key, partitions, attributes, name=folder_url)
+        if reusable and not errors:
+            try:
+                self.dataset_cache.store_prefecture(prefecture)
+            except Exception as e:
+                errors.append(f"統合データセットの保存に失敗しました: {str(e)}")
+        self.registry.add(prefecture)
+        
+        return prefecture, errors
+    
+    def get_current_prefecture(self):
+        """このセッションで構築した統合データセットを取得（解放済みの場合は保存済みのものを再読み込み）"""
+        key = st.session_state.get('prefecture_key')
+        if key is None:
+            return None
+        
+        prefecture = self.registry.get(key)
+        if prefecture is None:
+            prefecture = self.dataset_cache.load_prefecture(key)
+            if prefecture is None:
+                st.session_state.prefecture_key = None
+                return None
+            self.registry.add(prefecture)
+        return prefecture
+    
+    def load_partition_dataset(self, prefecture, code):
+        """統合データセットの区分（市区町村）をデータセットとして開く（座標系は元のまま）"""
+        partition = prefecture.partitions[code]
+        return self.load_dataset_from_url(partition['url'], content_key=partition['key'])
+    
+    def load_shapefile_from_zip(self, file_obj, columns=None):
+        """ZIP内のShapefileを展開せずメモリ上から直接読み込み（必要な列のみデコード）"""
+        if columns is None:
+            columns = KOJI_ATTRIBUTE_COLUMNS
+        
+        file_obj.seek(0)
+        
+        # 中央ディレクトリのみを参照してSHPファイルを探す
+        with zipfile.ZipFile(file_obj, 'r') as zip_ref:
+            shp_members = [name for name in zip_ref.namelist() if name.lower().endswith('.shp')]
+        
+        if not shp_members:
+            raise Exception("ZIPファイル内にSHPファイルが見つかりません")
+        
+        # .shp/.shx/.dbf/.prj/.cpg はGDALがZIPから直接読み込む（Arrow経由の列指向読み込み）
+        layer = os.path.splitext(os.path.basename(shp_members[0]))[0]
+        file_obj.seek(0)
+        
+        # ディスク上のファイルはパスで渡し、メモリに読み込まずにGDALから参照させる
+        source = f"/vsizip/{file_obj.name}" if isinstance(file_obj, io.BufferedReader) else file_obj
+        return gpd.read_file(source, layer=layer, columns=columns, engine='pyogrio', use_arrow=True)
     
-    def load_shapefile_from_url(self, url):
-        """URLからShapefileを読み込み"""
+    def create_kml_from_geodataframe(self, gdf, name="地番データ", pretty=False):
+        """GeoPandasデータフレームからKMLファイルを作成（座標変換付き、pretty=Trueで字下げ）"""
         try:
-            file_obj = self.download_file_from_url(url)
+            return "".join(iter_kml(gdf, name, pretty=pretty))
             
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # ZIPファイルとして展開を試行
-                try:
-                    with zipfile.ZipFile(file_obj, 'r') as zip_ref:
-                        zip_ref.extractall(temp_dir)
-                    
-                    # SHPファイルを探す
-                    shp_files = [f for f in os.listdir(temp_dir) if f.endswith('.shp')]
-                    
-                    if shp_files:
-                        shp_path = os.path.join(temp_dir, shp_files[0])
-                        return gpd.read_file(shp_path)
-                    else:
-                        raise Exception("ZIPファイル内にSHPファイルが見つかりません")
-                        
-                except zipfile.BadZipFile:
-                    # ZIPファイルでない場合、直接SHPファイルとして読み込みを試行
-                    file_obj.seek(0)  # ファイルポインタをリセット
-                    
-                    # 一時的にファイルを保存
-                    temp_file = os.path.join(temp_dir, "temp_file")
-                    with open(temp_file, 'wb') as f:
-                        f.write(file_obj.read())
-                    
-                    # 拡張子を推測してリネーム
-                    if url.lower().endswith('.shp'):
-                        shp_file = temp_file + '.shp'
-                        os.rename(temp_file, shp_file)
-                        return gpd.read_file(shp_file)
-                    else:
-                        return gpd.read_file(temp_file)
-                        
         except Exception as e:
-            raise Exception(f"Shapefileの読み込みに失敗しました: {str(e)}")
+            st.error(f"KML作成エラー: {str(e)}")
+            return None
     
-    def create_kml_from_geodataframe(self, gdf, name="地番データ"):
-        """GeoPandasデータフレームからKMLファイルを作成（座標変換付き）"""
-        try:
-            # WGS84（緯度経度）に座標変換
-            gdf_wgs84 = gdf.to_crs(epsg=4326)
-            
-            # KMLのルート要素を作成
-            kml = ET.Element("kml", xmlns="http://www.opengis.net/kml/2.2")
-            document = ET.SubElement(kml, "Document")
-            doc_name = ET.SubElement(document, "name")
-            doc_name.text = name
-            
-            # スタイルを定義
-            style = ET.SubElement(document, "Style", id="PolygonStyle")
-            line_style = ET.SubElement(style, "LineStyle")
-            line_color = ET.SubElement(line_style, "color")
-            line_color.text = "ff0000ff"  # 赤色
-            line_width = ET.SubElement(line_style, "width")
-            line_width.text = "2"
-            
-            poly_style = ET.SubElement(style, "PolyStyle")
-            poly_color = ET.SubElement(poly_style, "color")
-            poly_color.text = "3300ff00"  # 半透明緑
-            
-            # 各レコードに対してPlacemarkを作成
-            for idx, row in gdf_wgs84.iterrows():
-                placemark = ET.SubElement(document, "Placemark")
+    def _extract_neighbours(self, dataset, windows, tiers=None, sources=None, groups=None):
+        """検索範囲にかかる周辺筆を切り抜いて取得（全件とのoverlayと同じ列・行順で、候補の筆だけを処理）
+        
+        windowsは検索範囲の配列で、全範囲をまとめて空間検索し、複数の範囲にかかる筆は1行にまとめる
+        （切り抜き結果は範囲ごとの切り抜きを結合したもの）。sourcesに範囲ごとの表示名を指定した場合は、
+        筆にかかる範囲の表示名をカンマ区切りで対象筆番号列に付ける。tiersに（表示名, 範囲の配列）の一覧を
+        内側から順に指定した場合、windowsは最も外側の範囲とし、筆にかかる最も内側の表示名を検索範囲列に付ける。
+        groupsに範囲ごとの依頼番号を指定した場合は、依頼ごとに筆を1行にまとめて依頼番号列を付ける（一括抽出用）。
+        """
+        attributes = dataset.attributes
+        windows = np.asarray(windows, dtype=object)
+        window_indices, positions = dataset.spatial_index.query_bulk(windows)
+        
+        # 不正なポリゴンの修正は重複を除いた候補の筆ごとに1回だけ行う
+        unique_positions, inverse = np.unique(positions, return_inverse=True)
+        rows = attributes.iloc[unique_positions]
+        geometries = np.asarray(dataset.geometries(rows.index).values, dtype=object)
+        
+        # 地番とgeometryが両方とも有効なデータのみを使用
+        candidate_valid = rows['地番'].notna().to_numpy() & ~shapely.is_missing(geometries)
+        candidates = np.full(len(geometries), None, dtype=object)
+        candidates[candidate_valid] = repair_polygons(geometries[candidate_valid])
+        valid = candidate_valid[inverse]
+        pair_candidates = inverse[valid]
+        pair_windows = window_indices[valid]
+        clipped = clip_to_window(candidates[pair_candidates], windows[pair_windows])
+        
+        kept = ~shapely.is_missing(clipped)
+        pair_candidates, pair_windows, clipped = pair_candidates[kept], pair_windows[kept], clipped[kept]
+        
+        # （依頼,）筆（行位置）ごとに並べ、複数の範囲にかかる筆は切り抜き結果を結合して1行にまとめる
+        pair_groups = np.asarray(groups)[pair_windows] if groups is not None else np.zeros(len(pair_windows), dtype=np.int64)
+        order = np.lexsort((pair_windows, pair_candidates, pair_groups))
+        pair_candidates, pair_windows, pair_groups, clipped = (
+            pair_candidates[order], pair_windows[order], pair_groups[order], clipped[order]
+        )
+        starts = np.flatnonzero(np.r_[
+            True, (pair_candidates[1:] != pair_candidates[:-1]) | (pair_groups[1:] != pair_groups[:-1])
+        ]) if len(order) else np.array([], dtype=np.intp)
+        ends = np.append(starts[1:], len(order))
+        merged = clipped[starts]
+        for i in np.flatnonzero(ends - starts > 1):
+            merged[i] = shapely.union_all(clipped[starts[i]:ends[i]])
+        
+        # 周辺筆抽出用の列（利用可能な列のみ使用）
+        overlay_columns = [col for col in ['大字名', '地番', '丁目名', '小字名'] if col in attributes.columns]
+        
+        neighbours = pd.DataFrame(rows[overlay_columns]).iloc[pair_candidates[starts]].reset_index(drop=True)
+        
+        if sources is not None:
+            neighbours.insert(0, '対象筆番号', [
+                ",".join(sources[w] for w in pair_windows[start:end]) for start, end in zip(starts, ends)
+            ])
+        if groups is not None:
+            neighbours.insert(0, '依頼番号', pair_groups[starts])
+        
+        if tiers:
+            # 範囲ごとに最も内側の段階を求め、筆ごとにその最小値を取る
+            candidate_geometries = candidates[pair_candidates]
+            tier_numbers = np.full(len(pair_candidates), len(tiers) - 1)
+            for number, (_, tier_windows) in enumerate(tiers[:-1]):
+                hits = (tier_numbers == len(tiers) - 1) & shapely.intersects(
+                    candidate_geometries, np.asarray(tier_windows, dtype=object)[pair_windows]
+                )
+                tier_numbers[hits] = number
+            tier_labels = np.array([label for label, _ in tiers], dtype=object)
+            neighbours['検索範囲'] = tier_labels[np.minimum.reduceat(tier_numbers, starts)] if len(starts) else []
+        
+        return gpd.GeoDataFrame(neighbours, geometry=list(merged), crs=dataset.crs)
+    
+    def _extract_nearest(self, dataset, target_geometries, target_positions, k, max_distance):
+        """対象筆ごとに境界間の距離が近い順にk筆（max_distanceまで）を取得（対象筆自身は除く）
+        
+        空間索引で外接矩形が一定距離以内の筆を候補とし、候補との実際の距離がk筆に満たない場合は
+        距離を2倍ずつmax_distanceまで広げる（距離を計算済みの筆は再計算しない）。
+        対象筆が複数ある場合は筆ごとに最も近い対象筆との距離を使い、対象筆番号列を付ける。
+        """
+        attributes = dataset.attributes
+        chiban_valid = attributes['地番'].notna().to_numpy()
+        
+        found_positions, found_distances, found_sources = [], [], []
+        for number, geometry in enumerate(target_geometries, 1):
+            known_positions = np.array([], dtype=np.intp)
+            known_distances = np.array([], dtype=float)
+            distance = min(NEAREST_INITIAL_DISTANCE_M, max_distance)
+            while True:
+                positions = dataset.spatial_index.query_within(geometry, distance)
+                positions = positions[~np.isin(positions, target_positions) & chiban_valid[positions]]
+                new_positions = np.setdiff1d(positions, known_positions, assume_unique=True)
+                if len(new_positions):
+                    new_geometries = np.asarray(dataset.geometries(attributes.index[new_positions]).values, dtype=object)
+                    known_positions = np.concatenate([known_positions, new_positions])
+                    known_distances = np.concatenate([known_distances, shapely.distance(geometry, new_geometries)])
                 
-                # 名前を設定
-                pm_name = ET.SubElement(placemark, "name")
-                if '地番' in row:
-                    pm_name.text = str(row['地番'])
+                within = known_distances <= distance
+                if within.sum() >= k or distance >= max_distance:
+                    break
+                distance = min(distance * 2, max_distance)
+            
+            nearest = np.argsort(np.where(within, known_distances, np.inf), kind='stable')[:min(k, int(within.sum()))]
+            found_positions.append(known_positions[nearest])
+            found_distances.append(known_distances[nearest])
+            found_sources.append(np.full(len(nearest), number))
+        
+        found = pd.DataFrame({
+            '_position': np.concatenate(found_positions),
+            '距離(m)': np.concatenate(found_distances),
+            '対象筆番号': np.concatenate(found_sources)
+        })
+        
+        # 複数の対象筆の近くにある筆は1行にまとめ、最も近い距離を使う
+        grouped = found.groupby('_position', sort=False)
+        nearest = grouped['距離(m)'].min().sort_values(kind='stable')
+        
+        overlay_columns = [col for col in ['大字名', '地番', '丁目名', '小字名'] if col in attributes.columns]
+        neighbours = pd.DataFrame(attributes[overlay_columns]).iloc[nearest.index.to_numpy()].reset_index(drop=True)
+        if len(target_geometries) > 1:
+            sources = grouped['対象筆番号'].apply(lambda numbers: ",".join(str(n) for n in sorted(numbers)))
+            neighbours.insert(0, '対象筆番号', sources.loc[nearest.index].to_numpy())
+        neighbours['距離(m)'] = nearest.round(2).to_numpy()
+        neighbours['順位'] = np.arange(1, len(neighbours) + 1)
+        
+        geometries = repair_polygons(dataset.geometries(attributes.index[nearest.index.to_numpy()]).values)
+        return gpd.GeoDataFrame(neighbours, geometry=list(geometries), crs=dataset.crs)
+    
+    def _new_batch_status(self, requests_df):
+        """一括抽出の依頼ごとの状態を初期化（大字名・地番・検索範囲が不足する依頼は入力不備）"""
+        status = requests_df.copy()
+        status['状態'] = '該当なし'
+        status['対象筆件数'] = 0
+        status['周辺筆件数'] = 0
+        status['メッセージ'] = "該当する筆が見つかりませんでした"
+        
+        invalid = status['大字名'].isna() | status['地番'].isna() | status['検索範囲'].isna()
+        status.loc[invalid, '状態'] = '入力不備'
+        status.loc[invalid, 'メッセージ'] = "大字名・地番・検索範囲（正の数値）を確認してください"
+        return status
+    
+    def extract_batch(self, dataset, requests_df):
+        """一括抽出（所在の照合・検索範囲の作成・空間検索・切り抜きを全依頼分まとめて実行）
+        
+        requests_dfはnormalize_batch_requestsで正規化した依頼一覧。戻り値は（依頼ごとの状態, 対象筆, 周辺筆）で、
+        対象筆・周辺筆には依頼番号列と対象筆番号列（依頼内の対象筆の番号、周辺筆はかかる対象筆のカンマ区切り）を付ける。
+        検索範囲は対象筆ごとにその中心から作成し、同じ依頼で複数の対象筆の範囲にかかる周辺筆は1行にまとめる（extract_dataと同じ）。
+        """
+        if isinstance(dataset, gpd.GeoDataFrame):
+            dataset = KojiDataset(None, gdf=dataset, compact=False)
+        
+        attributes = dataset.attributes
+        attribute_columns = [col for col in KOJI_ATTRIBUTE_COLUMNS if col in attributes.columns]
+        
+        status = self._new_batch_status(requests_df)
+        invalid = status['状態'] == '入力不備'
+        
+        # 所在の照合（全依頼を属性の正規化キーとまとめて結合し、丁目・小字は指定された依頼のみ絞り込む）
+        parcels = dataset.address_index.keys[attribute_columns].astype(object).assign(_position=np.arange(len(attributes)))
+        request_keys = status.loc[~invalid, ['依頼番号'] + KOJI_ATTRIBUTE_COLUMNS].assign(**{
+            column: normalize_address_column(status.loc[~invalid, column], chiban=column == '地番').astype(object)
+            for column in KOJI_ATTRIBUTE_COLUMNS
+        })
+        matches = request_keys.merge(parcels, on=['大字名', '地番'], suffixes=('', '_筆'))
+        for column in ('丁目名', '小字名'):
+            if column in attribute_columns:
+                matches = matches[matches[column].isna() | (matches[column] == matches[f"{column}_筆"])]
+        matches = matches.sort_values(['依頼番号', '_position'])
+        
+        target_positions = matches['_position'].to_numpy()
+        target_geometries = np.asarray(
+            dataset.geometries(attributes.index[target_positions]).values, dtype=object
+        ) if len(matches) else np.array([], dtype=object)
+        
+        # ジオメトリが無い対象筆を含む依頼は抽出しない
+        missing_geometry = pd.Series(shapely.is_missing(target_geometries), index=matches.index)
+        broken_requests = set(matches.loc[missing_geometry, '依頼番号'])
+        request_ids = status['依頼番号'].isin(broken_requests)
+        status.loc[request_ids, '状態'] = 'エラー'
+        status.loc[request_ids, 'メッセージ'] = "geometry列にNULL値が含まれています"
+        
+        keep = ~matches['依頼番号'].isin(broken_requests).to_numpy()
+        matches, target_positions, target_geometries = matches[keep], target_positions[keep], target_geometries[keep]
+        
+        targets = pd.DataFrame(attributes[[col for col in ['大字名', '丁目名', '小字名', '地番'] if col in attributes.columns]]).iloc[target_positions]
+        targets.insert(0, '依頼番号', matches['依頼番号'].to_numpy())
+        targets.insert(1, '対象筆番号', (matches.groupby('依頼番号').cumcount().to_numpy() + 1).astype(str))
+        target_gdf = gpd.GeoDataFrame(targets.reset_index(drop=True), geometry=list(target_geometries), crs=dataset.crs)
+        
+        # 検索範囲（対象筆ごとにその中心から東西南北に依頼の検索範囲の正方形）を配列でまとめて作成
+        range_m = status.set_index('依頼番号').loc[target_gdf['依頼番号'], '検索範囲'].to_numpy()
+        windows = build_search_window('square', target_geometries, range_m)
+        
+        # 全検索範囲をまとめて空間検索し、候補の筆だけを切り抜く（依頼ごとに筆を1行にまとめる）
+        overlay_gdf = self._extract_neighbours(
+            dataset, windows,
+            sources=target_gdf['対象筆番号'].tolist(),
+            groups=target_gdf['依頼番号'].to_numpy()
+        )
+        
+        # 依頼ごとの件数と状態
+        target_counts = target_gdf['依頼番号'].value_counts()
+        overlay_counts = overlay_gdf['依頼番号'].value_counts()
+        found = status['依頼番号'].isin(target_counts.index)
+        status.loc[found, '状態'] = '抽出完了'
+        status['対象筆件数'] = status['依頼番号'].map(target_counts).fillna(0).astype(int)
+        status['周辺筆件数'] = status['依頼番号'].map(overlay_counts).fillna(0).astype(int)
+        status.loc[found, 'メッセージ'] = [
+            f"対象筆: {target_count}件, 周辺筆: {overlay_count}件"
+            for target_count, overlay_count in zip(status.loc[found, '対象筆件数'], status.loc[found, '周辺筆件数'])
+        ]
+        
+        return status, target_gdf, overlay_gdf
+    
+    def route_batch_requests(self, prefecture, requests_df):
+        """一括抽出の依頼を統合データセットの市区町村に振り分け
+        
+        市区町村列の指定（コード・名称・カナ読み）を優先し、空欄の依頼は大字名・地番が一致する市区町村に振り分ける。
+        戻り値は依頼ごとの（市区町村コード, 振り分けられない理由）で、該当する筆が無い依頼はどちらもNone。
+        """
+        codes = pd.Series(None, index=requests_df.index, dtype=object)
+        reasons = pd.Series(None, index=requests_df.index, dtype=object)
+        
+        specified = requests_df['市区町村'].notna() if '市区町村' in requests_df.columns else pd.Series(False, index=requests_df.index)
+        if specified.any():
+            municipality_index = get_municipality_index()
+            for value in requests_df.loc[specified, '市区町村'].unique():
+                query = unicodedata.normalize('NFKC', value).strip()
+                if query.isdigit():
+                    matched = [query[:5]] if query[:5] in prefecture.partitions else []
                 else:
-                    pm_name.text = f"地番_{idx}"
+                    matched = list(dict.fromkeys(
+                        entry['code'] for entry in municipality_index.lookup(query) if entry['code'] in prefecture.partitions
+                    ))
                 
-                # 説明を設定
-                description = ET.SubElement(placemark, "description")
-                desc_text = ""
-                for col in gdf_wgs84.columns:
-                    if col != 'geometry':
-                        desc_text += f"{col}: {row[col]}<br/>"
-                description.text = desc_text
-                
-                # スタイルを適用
-                style_url = ET.SubElement(placemark, "styleUrl")
-                style_url.text = "#PolygonStyle"
-                
-                # ジオメトリを処理
-                geom = row['geometry']
-                if geom.geom_type == 'Polygon':
-                    self._add_polygon_to_placemark(placemark, geom)
-                elif geom.geom_type == 'MultiPolygon':
-                    for poly in geom.geoms:
-                        self._add_polygon_to_placemark(placemark, poly)
-                elif geom.geom_type == 'Point':
-                    self._add_point_to_placemark(placemark, geom)
-            
-            # XMLを整形して文字列として返す
-            rough_string = ET.tostring(kml, 'unicode')
-            reparsed = minidom.parseString(rough_string)
-            pretty_xml = reparsed.toprettyxml(indent="  ")
-            
-            return pretty_xml
+                rows = specified & (requests_df['市区町村'] == value)
+                if len(matched) == 1:
+                    codes[rows] = matched[0]
+                elif matched:
+                    names = "、".join(prefecture.partitions[code]['name'] for code in matched)
+                    reasons[rows] = f"市区町村「{value}」が複数の市区町村（{names}）に該当します"
+                else:
+                    reasons[rows] = f"市区町村「{value}」のファイルが統合データセットにありません"
+        
+        unspecified = ~specified & requests_df['大字名'].notna() & requests_df['地番'].notna()
+        if unspecified.any():
+            candidates = prefecture.address_keys.astype(object).drop_duplicates()
+            matches = pd.DataFrame({
+                column: normalize_address_column(requests_df.loc[unspecified, column], chiban=column == '地番').astype(object)
+                for column in ('大字名', '地番')
+            }).assign(_row=requests_df.index[unspecified]).merge(candidates, on=['大字名', '地番'])
+            matched_codes = matches.groupby('_row')['市区町村コード'].unique()
             
-        except Exception as e:
-            st.error(f"KML作成エラー: {str(e)}")
+            single = matched_codes.str.len() == 1
+            codes[matched_codes.index[single]] = matched_codes[single].str[0]
+            for row, matched in matched_codes[~single].items():
+                names = "、".join(prefecture.partitions[code]['name'] for code in sorted(matched))
+                reasons[row] = f"複数の市区町村（{names}）に該当します。市区町村列で指定してください"
+        
+        return codes, reasons
+    
+    def extract_prefecture_batch(self, prefecture, requests_df, max_workers=None):
+        """県全体の一括抽出（依頼を市区町村ごとにまとめ、ワーカープロセスで並列に抽出）
+        
+        各ワーカーは担当する市区町村のデータセットを一度だけ開き、その市区町村の依頼をまとめて抽出する。
+        市区町村の抽出が終わるたびに（市区町村コード, 依頼ごとの状態, 対象筆, 周辺筆）を返すジェネレーターで、
+        振り分けられない依頼は最初に市区町村コードNone・状態のみで返す。
+        """
+        codes, reasons = self.route_batch_requests(prefecture, requests_df)
+        
+        unrouted = codes.isna()
+        if unrouted.any():
+            status = self._new_batch_status(requests_df[unrouted])
+            has_reason = (status['状態'] != '入力不備') & reasons[unrouted].notna()
+            status.loc[has_reason, '状態'] = '入力不備'
+            status.loc[has_reason, 'メッセージ'] = reasons[unrouted][has_reason]
+            yield None, status, None, None
+        
+        # 依頼の多い市区町村から投入し、大きな市区町村が最後に1つだけ残らないようにする
+        groups = [(code, requests_df[codes == code]) for code in codes[~unrouted].unique()]
+        groups.sort(key=lambda group: len(group[1]), reverse=True)
+        
+        # ワーカーはディスクキャッシュから開くため、キャッシュに無い市区町村はこのプロセスで抽出
+        cached = lambda code: (
+            self.dataset_cache.contains(prefecture.partitions[code]['key'])
+            or self.dataset_cache.has_shapefile(prefecture.partitions[code]['key'])
+        )
+        worker_groups = [(code, group) for code, group in groups if cached(code)]
+        local_groups = [(code, group) for code, group in groups if not cached(code)]
+        
+        workers = min(max_workers or BATCH_MAX_WORKERS, len(worker_groups))
+        if workers <= 1:
+            local_groups = groups
+            worker_groups = []
+        
+        if worker_groups:
+            # Streamlitのスレッドを含むプロセスをforkしないようspawnで起動し、市区町村を一定数処理したプロセスは入れ替える
+            # （ProcessPoolExecutorのmax_tasks_per_childはPython 3.11ではプロセスの入れ替え時に停止することがあるためPoolを使用）
+            pool = multiprocessing.get_context('spawn').Pool(
+                workers, initializer=init_batch_worker, maxtasksperchild=BATCH_TASKS_PER_CHILD
+            )
+            try:
+                groups_by_code = dict(worker_groups)
+                tasks = [(code, prefecture.partitions[code]['key'], group) for code, group in worker_groups]
+                for code, result, error in pool.imap_unordered(run_batch_group, tasks):
+                    if error is None:
+                        yield (code,) + result
+                    else:
+                        yield code, self._batch_error_status(groups_by_code[code], error), None, None
+            finally:
+                # 途中で中止された場合は処理中の市区町村も打ち切る
+                pool.terminate()
+        
+        for code, group in local_groups:
+            try:
+                yield (code,) + self.extract_batch(self.load_partition_dataset(prefecture, code), group)
+            except Exception as e:
+                yield code, self._batch_error_status(group, e), None, None
+    
+    def _batch_error_status(self, requests_df, error):
+        """市区町村単位の抽出に失敗した依頼の状態（入力不備の依頼はそのまま）"""
+        status = self._new_batch_status(requests_df)
+        failed = status['状態'] != '入力不備'
+        status.loc[failed, '状態'] = 'エラー'
+        status.loc[failed, 'メッセージ'] = f"データ抽出エラー: {error}"
+        return status
+    
+    def combine_batch_results(self, prefecture, results):
+        """市区町村ごとの一括抽出結果を依頼番号順にまとめる（市区町村コード・市区町村名の列を付与）
+        
+        市区町村によって座標系（公共座標系）が異なる場合は、対象筆・周辺筆を緯度経度（JGD2011）に変換してまとめる。
+        """
+        names = {code: partition['name'] for code, partition in prefecture.partitions.items()}
+        
+        statuses, targets, overlays = [], [], []
+        for code, status, target_gdf, overlay_gdf in results:
+            status = status.copy()
+            status.insert(1, '市区町村コード', code)
+            status.insert(2, '市区町村名', names.get(code))
+            statuses.append(status)
+            
+            for gdf, frames in ((target_gdf, targets), (overlay_gdf, overlays)):
+                if gdf is not None and not gdf.empty:
+                    gdf = gdf.copy()
+                    gdf.insert(1, '市区町村コード', code)
+                    gdf.insert(2, '市区町村名', names.get(code))
+                    frames.append(gdf)
+        
+        status = pd.concat(statuses, ignore_index=True).sort_values('依頼番号', kind='stable', ignore_index=True)
+        
+        crs_list = {str(gdf.crs) for gdf in targets + overlays}
+        combined = []
+        for frames in (targets, overlays):
+            if len(crs_list) > 1:
+                frames = [gdf.to_crs(epsg=6668) for gdf in frames]
+            if frames:
+                gdf = pd.concat(frames, ignore_index=True).sort_values('依頼番号', kind='stable', ignore_index=True)
+            else:
+                gdf = gpd.GeoDataFrame(columns=['依頼番号', '市区町村コード', '市区町村名', 'geometry'], geometry='geometry')
+            combined.append(gdf)
+        
+        return status, combined[0], combined[1]
+    
+    def extract_data(self, dataset, oaza, chome, koaza, chiban, range_m, shape='square', polygon=None, k=None):
+        """データ抽出処理（丁目・小字対応、同じ条件で抽出済みの場合は全セッション共通のキャッシュから返す）
+        
+        range_mに複数の距離（例: [30, 61, 100]）を指定すると、周辺筆に最も内側の範囲を示す検索範囲列を付ける。
+        shapeは検索範囲の形（SEARCH_SHAPES）で、'polygon'の場合はpolygon（データセットの座標系）を検索範囲とする。
+        'nearest'の場合は対象筆ごとに境界間の距離が近い順にk筆（range_mの距離まで）を距離(m)列付きで返す（切り抜かない）。
+        """
+        # GeoDataFrameが渡された場合もデータセットとして扱う
+        if isinstance(dataset, gpd.GeoDataFrame):
+            dataset = KojiDataset(None, gdf=dataset, compact=False)
+        
+        cache_key = self._result_cache_key(dataset, oaza, chome, koaza, chiban, range_m, shape, polygon, k)
+        if cache_key is not None:
+            result = self.result_cache.get(cache_key)
+            if result is not None:
+                return result
+        
+        result = self._extract_data(dataset, oaza, chome, koaza, chiban, range_m, shape, polygon, k)
+        
+        # 該当なし・エラーは索引の参照だけで済むか再試行すべきものなのでキャッシュしない
+        if cache_key is not None and result[0] is not None:
+            self.result_cache.put(cache_key, result)
+        return result
+    
+    def _result_cache_key(self, dataset, oaza, chome, koaza, chiban, range_m, shape='square', polygon=None, k=None):
+        """抽出結果キャッシュのキー（データセットのキーは内容ハッシュのため、キーが同じであれば同じ結果になる）
+        
+        キーの無いデータセット（GeoDataFrameを直接渡した場合等）はキャッシュしないためNone。
+        """
+        if isinstance(dataset, gpd.GeoDataFrame) or dataset.key is None:
             return None
+        # 条件は照合と同じく正規化し、表記ゆれのある同じ条件で結果を共有する
+        return (
+            dataset.key,
+            normalize_address_key(oaza),
+            normalize_address_key(chome) if chome is not None and chome != "選択なし" else None,
+            normalize_address_key(koaza) if koaza is not None and koaza != "選択なし" else None,
+            normalize_address_key(chiban, chiban=True),
+            tuple(sorted({float(r) for r in np.atleast_1d(range_m)})) if shape != 'polygon' else None,
+            shape,
+            shapely.to_wkb(polygon, hex=True) if shape == 'polygon' else None,
+            int(k) if shape == 'nearest' else None
+        )
+    
+    def result_id(self, dataset, oaza, chome, koaza, chiban, range_m, shape='square', polygon=None, k=None):
+        """抽出結果の識別子（同じ条件の抽出結果はセッションをまたいで同じ識別子、キャッシュしない結果は毎回新しい識別子）"""
+        cache_key = self._result_cache_key(dataset, oaza, chome, koaza, chiban, range_m, shape, polygon, k)
+        if cache_key is None:
+            return uuid.uuid4().hex
+        return hashlib.sha1(repr(cache_key).encode('utf-8')).hexdigest()
+    
+    def create_kml_export(self, gdf, name):
+        """ダウンロード用のKMLを作成（失敗した場合は例外を送出）"""
+        kml = self.create_kml_from_geodataframe(gdf, name)
+        if kml is None:
+            raise Exception("KMLの作成に失敗しました")
+        return kml
     
-    def _add_polygon_to_placemark(self, placemark, polygon):
-        """PolygonをPlacemarkに追加"""
-        multigeometry = placemark.find("MultiGeometry")
-        if multigeometry is None:
-            multigeometry = ET.SubElement(placemark, "MultiGeometry")
-        
-        kml_polygon = ET.SubElement(multigeometry, "Polygon")
-        
-        # 外環を追加
-        outer_boundary = ET.SubElement(kml_polygon, "outerBoundaryIs")
-        linear_ring = ET.SubElement(outer_boundary, "LinearRing")
-        coordinates = ET.SubElement(linear_ring, "coordinates")
-        
-        # 座標を文字列に変換
-        coord_str = ""
-        for x, y in polygon.exterior.coords:
-            coord_str += f"{x},{y},0 "
-        coordinates.text = coord_str.strip()
-        
-        # 内環がある場合は追加
-        for interior in polygon.interiors:
-            inner_boundary = ET.SubElement(kml_polygon, "innerBoundaryIs")
-            inner_ring = ET.SubElement(inner_boundary, "LinearRing")
-            inner_coordinates = ET.SubElement(inner_ring, "coordinates")
-            
-            inner_coord_str = ""
-            for x, y in interior.coords:
-                inner_coord_str += f"{x},{y},0 "
-            inner_coordinates.text = inner_coord_str.strip()
-    
-    def _add_point_to_placemark(self, placemark, point):
-        """PointをPlacemarkに追加"""
-        kml_point = ET.SubElement(placemark, "Point")
-        coordinates = ET.SubElement(kml_point, "coordinates")
-        coordinates.text = f"{point.x},{point.y},0"
-    
-    def extract_data(self, gdf, oaza, chome, koaza, chiban, range_m):
-        """データ抽出処理（丁目・小字対応）"""
+    def _extract_data(self, dataset, oaza, chome, koaza, chiban, range_m, shape='square', polygon=None, k=None):
+        """データ抽出処理の本体（対象筆の検索・検索範囲の作成・周辺筆の切り抜き）"""
         try:
+            # 検索は属性データのみで行う
+            gdf = dataset.attributes
+            
             # 必要な列の存在確認
             required_columns = ['大字名', '地番']
             missing_columns = [col for col in required_columns if col not in gdf.columns]
@@ -451,50 +2980,49 @@ class KojiWebExtractor:
             if missing_columns:
                 return None, None, f"必要な列が見つかりません: {missing_columns}"
             
+            # 所在の索引（データセットごとに1回だけ作成し、以降の検索は全件を走査しない）
+            address_index = dataset.address_index
+            
             # NULL値をチェック
-            null_check = {}
-            for col in required_columns:
-                null_count = gdf[col].isnull().sum()
-                if null_count > 0:
-                    null_check[col] = null_count
+            null_check = {col: address_index.null_counts[col] for col in required_columns if address_index.null_counts[col] > 0}
             
             if null_check:
                 warning_msg = "警告: NULL値が含まれています - " + ", ".join([f"{k}: {v}件" for k, v in null_check.items()])
                 st.warning(warning_msg)
             
-            # 検索条件を構築（丁目・小字の有無に応じて）
-            search_condition = (
-                (gdf['大字名'] == oaza) & 
-                (gdf['地番'] == chiban) &
-                (gdf['大字名'].notna()) &
-                (gdf['地番'].notna())
+            # 検索条件を構築（丁目・小字は指定されている場合のみ条件に追加）
+            positions = address_index.lookup(
+                oaza,
+                chiban,
+                chome=chome if chome is not None and chome != "選択なし" else None,
+                koaza=koaza if koaza is not None and koaza != "選択なし" else None
             )
             
-            # 丁目が指定されている場合は条件に追加
-            if chome is not None and chome != "選択なし" and '丁目名' in gdf.columns:
-                search_condition = search_condition & (gdf['丁目名'] == chome) & (gdf['丁目名'].notna())
+            df = gdf.iloc[positions]
             
-            # 小字が指定されている場合は条件に追加
-            if koaza is not None and koaza != "選択なし" and '小字名' in gdf.columns:
-                search_condition = search_condition & (gdf['小字名'] == koaza) & (gdf['小字名'].notna())
-            
-            df = gdf[search_condition]
+            if not df.empty:
+                # 対象筆のジオメトリのみ取得（属性のみ読み込み済みの場合は該当レコードだけ.shpから読み込み）
+                df = gpd.GeoDataFrame(
+                    df.drop(columns=['geometry'], errors='ignore'),
+                    geometry=dataset.geometries(df.index),
+                    crs=dataset.crs
+                )
             
             if df.empty:
                 # デバッグ情報を提供
                 debug_info = []
-                oaza_matches = gdf[gdf['大字名'] == oaza]['大字名'].count()
-                chiban_matches = gdf[gdf['地番'] == chiban]['地番'].count()
+                oaza_matches = address_index.count('大字名', oaza)
+                chiban_matches = address_index.count('地番', chiban)
                 
                 debug_info.append(f"大字名'{oaza}'の該当件数: {oaza_matches}")
                 debug_info.append(f"地番'{chiban}'の該当件数: {chiban_matches}")
                 
                 if chome and chome != "選択なし" and '丁目名' in gdf.columns:
-                    chome_matches = gdf[gdf['丁目名'] == chome]['丁目名'].count()
+                    chome_matches = address_index.count('丁目名', chome)
                     debug_info.append(f"丁目名'{chome}'の該当件数: {chome_matches}")
                 
                 if koaza and koaza != "選択なし" and '小字名' in gdf.columns:
-                    koaza_matches = gdf[gdf['小字名'] == koaza]['小字名'].count()
+                    koaza_matches = address_index.count('小字名', koaza)
                     debug_info.append(f"小字名'{koaza}'の該当件数: {koaza_matches}")
                 
                 return None, None, f"該当する筆が見つかりませんでした。{' / '.join(debug_info)}"
@@ -518,123 +3046,311 @@ class KojiWebExtractor:
             if df_summary['geometry'].isnull().any():
                 return None, None, "geometry列にNULL値が含まれています"
             
-            # 中心点計算と周辺筆抽出
-            cen = df_summary.geometry.centroid
-            
-            cen_gdf = gpd.GeoDataFrame(geometry=cen)
-            cen_gdf['x'] = cen_gdf.geometry.x
-            cen_gdf['y'] = cen_gdf.geometry.y
-            
-            # 検索範囲の4角ポイント計算
-            i1 = cen_gdf['x'] + range_m
-            i2 = cen_gdf['x'] - range_m
-            i3 = cen_gdf['y'] + range_m
-            i4 = cen_gdf['y'] - range_m
-            
-            x1, y1 = i3.iloc[0], i1.iloc[0]
-            x2, y2 = i4.iloc[0], i2.iloc[0]
-            
-            # 4つのポイントを定義
-            top_right = [x1, y1]
-            lower_left = [x2, y2]
-            lower_right = [x1, y2]
-            top_left = [x2, y1]
-            
-            points = pd.DataFrame([top_right, lower_left, lower_right, top_left],
-                                index=["top_right", "lower_left", "lower_right", "top_left"],
-                                columns=["lon", "lat"])
-            
-            # ジオメトリ作成
-            geometry = [Point(xy) for xy in zip(points.lat, points.lon)]
-            four_points_gdf = gpd.GeoDataFrame(points, geometry=geometry)
-            
-            # 検索範囲のポリゴン作成
-            sq = four_points_gdf.dissolve().convex_hull
-            
-            # オーバーレイ処理（NULL値を除外したデータで）
-            df1 = gpd.GeoDataFrame({'geometry': sq})
-            df1 = df1.set_crs(gdf.crs)
-            
-            # 地番とgeometryが両方とも有効なデータのみを使用
-            valid_data = gdf[(gdf['地番'].notna()) & (gdf['geometry'].notna())].copy()
+            # 検索範囲（対象筆ごとに配列で作成、複数の距離は内側から順に並べ、最も外側の範囲で候補を取得）
+            target_geometries = np.asarray(df_summary.geometry.values, dtype=object)
+            if shape == 'nearest':
+                if len(df_summary) > 1:
+                    df_summary.insert(0, '対象筆番号', np.arange(1, len(df_summary) + 1).astype(str))
+                overlay_gdf = self._extract_nearest(
+                    dataset, target_geometries, positions, int(k or DEFAULT_NEAREST_COUNT), max(np.atleast_1d(range_m))
+                )
+                return df_summary, overlay_gdf, f"対象筆: {len(df_summary)}件, 周辺筆（近い順）: {len(overlay_gdf)}件"
             
-            # 周辺筆抽出用のデータフレーム作成（利用可能な列のみ使用）
-            overlay_columns = ['地番', 'geometry']
-            if '大字名' in valid_data.columns:
-                overlay_columns.insert(0, '大字名')
-            if '丁目名' in valid_data.columns:
-                overlay_columns.insert(-1, '丁目名')
-            if '小字名' in valid_data.columns:
-                overlay_columns.insert(-1, '小字名')
+            if shape == 'polygon':
+                tiers = None
+                windows = np.array([build_search_window(shape, None, None, polygon)], dtype=object)
+            else:
+                distances = sorted({float(r) for r in np.atleast_1d(range_m)})
+                tiers = [
+                    (format_range_tier(distance), np.asarray(build_search_window(shape, target_geometries, distance), dtype=object))
+                    for distance in distances
+                ]
+                windows = tiers[-1][1]
+                tiers = tiers if len(tiers) > 1 else None
             
-            existing_overlay_columns = [col for col in overlay_columns if col in valid_data.columns]
-            df2 = gpd.GeoDataFrame(valid_data[existing_overlay_columns])
+            # 対象筆が複数ある場合は対象筆番号を付け、周辺筆にはどの対象筆の範囲にかかるかを付ける
+            # （周辺筆の対象筆番号は複数の番号のカンマ区切りになるため、対象筆側も文字列で揃える）
+            sources = None
+            if len(df_summary) > 1:
+                df_summary.insert(0, '対象筆番号', np.arange(1, len(df_summary) + 1).astype(str))
+                if len(windows) > 1:
+                    sources = df_summary['対象筆番号'].tolist()
             
-            overlay_gdf = df1.overlay(df2, how='intersection')
+            # 空間索引で外接矩形が全対象筆の検索範囲にかかる筆だけをまとめて取り出し、その筆だけを切り抜く
+            overlay_gdf = self._extract_neighbours(dataset, windows, tiers=tiers, sources=sources)
             
             return df_summary, overlay_gdf, f"対象筆: {len(df_summary)}件, 周辺筆: {len(overlay_gdf)}件"
             
         except Exception as e:
             return None, None, f"エラー: {str(e)}"
 
-def get_chome_options(gdf, selected_oaza):
-    """指定された大字名に対応する丁目の選択肢を取得"""
+def init_batch_worker():
+    """一括抽出のワーカープロセスの初期化（画面の無い実行によるStreamlitの警告を抑制）"""
+    set_streamlit_log_level('error')
+
+def run_batch_group(task):
+    """一括抽出のワーカー処理（1市区町村分のデータセットをキャッシュから開き、その依頼をまとめて抽出）
+    
+    taskは（市区町村コード, データセットキー, 依頼一覧）。データセットは登録簿に保持せず、抽出が終われば解放する。
+    他の市区町村の抽出を止めないよう、失敗した場合は例外を送出せずにメッセージを返す。
+    """
+    code, key, requests_df = task
     try:
-        if '丁目名' not in gdf.columns:
-            return None
-        
-        # 指定された大字名でフィルタリング
-        filtered_gdf = gdf[
-            (gdf['大字名'] == selected_oaza) & 
-            (gdf['大字名'].notna()) &
-            (gdf['丁目名'].notna())
-        ]
-        
-        if len(filtered_gdf) == 0:
-            return None
-        
-        # 丁目名のユニークな値を取得してソート
-        chome_list = sorted(filtered_gdf['丁目名'].unique())
-        
-        return chome_list
-        
+        extractor = KojiWebExtractor()
+        return code, extractor.extract_batch(extractor._open_cached_dataset(key), requests_df), None
     except Exception as e:
-        st.error(f"丁目名取得エラー: {str(e)}")
+        return code, None, str(e)
+
+def get_chome_options(hierarchy, selected_oaza):
+    """指定された大字名に対応する丁目の選択肢を取得（階層索引から引くため全件は走査しない）"""
+    if not hierarchy.has_chome:
         return None
+    
+    chome_list = hierarchy.chome_list(selected_oaza)
+    return chome_list if chome_list else None
 
-def get_koaza_options(gdf, selected_oaza, selected_chome=None):
-    """指定された大字名（及び丁目名）に対応する小字の選択肢を取得"""
-    try:
-        if '小字名' not in gdf.columns:
-            return None
-        
-        # フィルタ条件を構築
-        filter_condition = (
-            (gdf['大字名'] == selected_oaza) & 
-            (gdf['大字名'].notna()) &
-            (gdf['小字名'].notna())
+def get_koaza_options(hierarchy, selected_oaza, selected_chome=None):
+    """指定された大字名（及び丁目名）に対応する小字の選択肢を取得（階層索引から引くため全件は走査しない）"""
+    if not hierarchy.has_koaza:
+        return None
+    
+    # 丁目が指定されている場合は丁目内の小字に絞り込む
+    if not selected_chome or selected_chome == "選択なし" or not hierarchy.has_chome:
+        selected_chome = None
+    
+    koaza_list = hierarchy.koaza_list(selected_oaza, selected_chome)
+    return koaza_list if koaza_list else None
+
+def show_loaded_dataset_info(dataset, message="✅ ファイル読み込み完了!"):
+    """読み込んだデータセットの概要をサイドバーに表示"""
+    gdf = dataset.attributes
+    
+    st.sidebar.success(message)
+    st.sidebar.info(f"📊 レコード数: {len(gdf):,}件")
+    
+    # 座標参照系の確認
+    if dataset.crs:
+        st.sidebar.info(f"🗺️ 座標系: {dataset.crs}")
+    
+    # 丁目名・小字名列の存在確認
+    if '丁目名' in gdf.columns:
+        chome_count = gdf['丁目名'].notna().sum()
+        st.sidebar.info(f"🏘️ 丁目データ: {chome_count}件")
+    
+    if '小字名' in gdf.columns:
+        koaza_count = gdf['小字名'].notna().sum()
+        st.sidebar.info(f"🏞️ 小字データ: {koaza_count}件")
+    
+    # 属性データの縮小（カテゴリ型化・文字列の共有等）前後のメモリ使用量
+    if dataset.memory_report is not None:
+        st.sidebar.info(
+            f"💾 属性メモリ: {dataset.memory_report['before'] / 1024 / 1024:.1f}MB → "
+            f"{dataset.memory_report['after'] / 1024 / 1024:.1f}MB"
         )
+        for note in dataset.memory_report['notes']:
+            st.sidebar.caption(f"ℹ️ {note}")
+
+def show_prefecture_search(extractor, prefecture, expanded=False):
+    """統合データセットから県全体の大字名・地番を検索し、該当する市区町村を読み込む画面を表示"""
+    with st.expander(
+        f"🗾 県全体検索（{len(prefecture.partitions)}市区町村, {len(prefecture.attributes):,}筆）", expanded=expanded
+    ):
+        partition_labels = {
+            code: f"{code} {partition['name']}（公共座標{partition['zone']}系）"
+            for code, partition in prefecture.partitions.items()
+        }
         
-        # 丁目が指定されている場合は条件に追加
-        if selected_chome and selected_chome != "選択なし" and '丁目名' in gdf.columns:
-            filter_condition = filter_condition & (gdf['丁目名'] == selected_chome) & (gdf['丁目名'].notna())
+        col_oaza, col_chiban, col_codes = st.columns([1, 1, 2])
+        with col_oaza:
+            oaza = st.text_input("大字名（部分一致）", key="prefecture_oaza")
+        with col_chiban:
+            chiban = st.text_input("地番（完全一致）", key="prefecture_chiban")
+        with col_codes:
+            codes = st.multiselect(
+                "市区町村（未選択の場合は全て）",
+                list(partition_labels),
+                format_func=partition_labels.get,
+                key="prefecture_codes"
+            )
         
-        # 指定された条件でフィルタリング
-        filtered_gdf = gdf[filter_condition]
+        if not (oaza.strip() or chiban.strip()):
+            st.info("大字名または地番を入力してください")
+            return
         
-        if len(filtered_gdf) == 0:
-            return None
+        results = prefecture.search(oaza=oaza.strip(), chiban=chiban.strip(), codes=codes)
+        st.write(f"検索結果: {len(results):,}件（{results['市区町村コード'].nunique()}市区町村）")
+        if len(results) == 0:
+            return
         
-        # 小字名のユニークな値を取得してソート
-        koaza_list = sorted(filtered_gdf['小字名'].unique())
+        display = results[['市区町村コード'] + KOJI_ATTRIBUTE_COLUMNS].copy()
+        display.insert(1, '市区町村名', display['市区町村コード'].map(
+            lambda code: prefecture.partitions[code]['name']
+        ).astype(str))
+        st.dataframe(display.head(1000), use_container_width=True, hide_index=True)
+        if len(results) > 1000:
+            st.caption("※ 先頭1,000件を表示しています")
         
-        return koaza_list
+        # 検索結果の市区町村を読み込んで通常の抽出に進む
+        result_codes = [code for code in prefecture.partitions if code in set(results['市区町村コード'])]
+        col_select, col_load = st.columns([2, 1])
+        with col_select:
+            selected_code = st.selectbox(
+                "読み込む市区町村", result_codes, format_func=partition_labels.get, key="prefecture_open_code"
+            )
+        with col_load:
+            st.write("")
+            if st.button("📥 この市区町村を読み込み", key="prefecture_open"):
+                try:
+                    with st.spinner(f"{partition_labels[selected_code]}を読み込み中..."):
+                        dataset = extractor.load_partition_dataset(prefecture, selected_code)
+                    file_name = prefecture.partitions[selected_code]['file_name']
+                    extractor.set_current_dataset(dataset, name=file_name)
+                    st.session_state.data_source = "県全体検索"
+                    st.session_state.current_preset = file_name
+                    st.session_state.file_info = prefecture.partitions[selected_code]['url']
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"❌ ファイル読み込みエラー: {str(e)}")
+
+def create_centroid_csv(gdf):
+    """座標情報（中心座標）付きCSVを作成（緯度経度の場合は中心経度・中心緯度）"""
+    csv_data = pd.DataFrame(gdf.drop(columns=['geometry']))
+    centroids = shapely.centroid(np.asarray(gdf.geometry.values))
+    is_geographic = gdf.crs is not None and gdf.crs.is_geographic
+    csv_data['中心経度' if is_geographic else '中心X座標'] = shapely.get_x(centroids)
+    csv_data['中心緯度' if is_geographic else '中心Y座標'] = shapely.get_y(centroids)
+    return csv_data.to_csv(index=False, encoding='shift-jis')
+
+def lazy_download_button(extractor, export_key, label, builder, file_name, mime, key):
+    """押された時点でファイルを作成するダウンロードボタン（作成したファイルはexport_keyごとに全セッションで再利用）
+    
+    まず作成ボタンを表示し、押された時点で作成（作成済みの場合は共有キャッシュから取得）したファイルを
+    セッションに保持してダウンロードボタンに切り替える。保持するのは共有キャッシュと同じオブジェクトへの参照。
+    """
+    prepared = st.session_state.setdefault('prepared_exports', {})
+    entry = prepared.get(key)
+    if entry is not None and entry[0] == export_key:
+        st.download_button(label, data=entry[1], file_name=file_name, mime=mime, use_container_width=True, key=key)
+        return
+    
+    if st.button(f"⚙️ {label}（作成）", use_container_width=True, key=f"{key}_prepare"):
+        try:
+            with st.spinner(f"{file_name}を作成中..."):
+                data = extractor.export_cache.get_or_create(export_key, builder)
+        except Exception as e:
+            st.error(f"❌ ファイル作成エラー: {str(e)}")
+            return
+        prepared[key] = (export_key, data)
+        st.rerun()
+
+def build_batch_downloads(extractor, batch_name, status, target_gdf, overlay_gdf):
+    """一括抽出結果のダウンロード（処理結果CSV・対象筆KML・周辺筆KML/CSV）の一覧を作成（ファイルは押された時点で作成）"""
+    batch_files = [(
+        "📊 処理結果CSVダウンロード",
+        lambda: status.to_csv(index=False, encoding='shift-jis'),
+        f"{batch_name}_処理結果.csv", "text/csv"
+    )]
+    if not target_gdf.empty:
+        batch_files.append((
+            "📄 対象筆KMLダウンロード（一括）",
+            lambda: extractor.create_kml_export(target_gdf, f"{batch_name}_対象筆"),
+            f"{batch_name}_対象筆.kml", "application/vnd.google-earth.kml+xml"
+        ))
+    if not overlay_gdf.empty:
+        batch_files.append((
+            "📄 周辺筆KMLダウンロード（一括）",
+            lambda: extractor.create_kml_export(overlay_gdf, f"{batch_name}_周辺筆"),
+            f"{batch_name}_周辺筆.kml", "application/vnd.google-earth.kml+xml"
+        ))
+        # 座標情報付きCSV（市区町村をまたいで緯度経度にまとめた場合は経度・緯度）
+        batch_files.append((
+            "📊 周辺筆CSVダウンロード（一括）",
+            lambda: create_centroid_csv(overlay_gdf),
+            f"{batch_name}_周辺筆.csv", "text/csv"
+        ))
+    return batch_files
+
+def show_batch_result(extractor, batch_result, key):
+    """一括抽出の処理結果（状態ごとの件数・依頼ごとの状態・ダウンロード）を表示"""
+    batch_status = batch_result['status']
+    status_counts = batch_status['状態'].value_counts()
+    st.success("✅ " + ", ".join(f"{state}: {count}件" for state, count in status_counts.items()))
+    st.dataframe(batch_status, use_container_width=True)
+    
+    for label, builder, file_name, mime in batch_result['files']:
+        lazy_download_button(
+            extractor, (batch_result['id'], file_name), label, builder, file_name, mime, key=f"{key}_{file_name}"
+        )
+    
+    show_export_bundle(extractor, batch_result['id'], batch_result['layers'], batch_result['name'], key=key)
+
+def show_export_bundle(extractor, result_id, layers, base_name, key):
+    """選択した形式（KMZ・GeoJSON・GeoPackage等）でまとめたZIPのダウンロードを表示"""
+    export_formats = st.multiselect(
+        "ZIPに含める形式",
+        list(EXPORT_FORMATS),
+        default=['kmz', 'geojson', 'gpkg'],
+        format_func=lambda export_format: EXPORT_FORMATS[export_format]['label'],
+        key=f"{key}_export_formats"
+    )
+    if export_formats:
+        lazy_download_button(
+            extractor, (result_id, 'bundle', tuple(export_formats)),
+            "📦 選択した形式をZIPでダウンロード",
+            lambda: create_export_bundle(layers, export_formats, base_name),
+            file_name=f"{base_name}.zip",
+            mime="application/zip",
+            key=f"{key}_download_bundle"
+        )
+
+def show_prefecture_batch(extractor, prefecture):
+    """統合データセットの全市区町村を対象に、依頼一覧を市区町村ごとに並列で一括抽出する画面を表示"""
+    with st.expander("📑 県全体の一括抽出（CSV/Excel）"):
+        st.write(
+            "市区町村列（コード・名称）で依頼を振り分け、市区町村ごとにワーカープロセスで並列に抽出します。"
+            "市区町村が空欄の依頼は、大字名・地番が一致する市区町村で抽出します。"
+        )
+        batch_file = st.file_uploader("依頼一覧ファイル", type=['csv', 'xlsx', 'xls'], key="prefecture_batch_file")
         
-    except Exception as e:
-        st.error(f"小字名取得エラー: {str(e)}")
-        return None
+        if batch_file is not None and st.button("📑 県全体で一括抽出を実行", key="prefecture_batch_run"):
+            try:
+                requests_df = read_batch_requests(batch_file, batch_file.name)
+                batch_name = os.path.splitext(batch_file.name)[0]
+                
+                # 市区町村ごとの抽出結果を終わった順に受け取り、進捗を表示
+                progress_bar = st.progress(0.0)
+                progress_text = st.empty()
+                results = []
+                done = 0
+                for code, status, target_gdf, overlay_gdf in extractor.extract_prefecture_batch(prefecture, requests_df):
+                    results.append((code, status, target_gdf, overlay_gdf))
+                    done += len(status)
+                    progress_bar.progress(done / len(requests_df))
+                    label = prefecture.partitions[code]['name'] if code is not None else "市区町村の振り分け"
+                    progress_text.write(f"{done:,}/{len(requests_df):,}件 処理済み（{label}）")
+                
+                batch_status, batch_target_gdf, batch_overlay_gdf = extractor.combine_batch_results(prefecture, results)
+                st.session_state.prefecture_batch_result = {
+                    'id': uuid.uuid4().hex,
+                    'status': batch_status,
+                    'files': build_batch_downloads(extractor, batch_name, batch_status, batch_target_gdf, batch_overlay_gdf),
+                    'layers': {'対象筆': batch_target_gdf, '周辺筆': batch_overlay_gdf},
+                    'name': batch_name
+                }
+            except Exception as e:
+                st.error(f"❌ 一括抽出エラー: {str(e)}")
+        
+        if 'prefecture_batch_result' in st.session_state:
+            show_batch_result(extractor, st.session_state.prefecture_batch_result, key="prefecture_batch")
 
 def main():
+    # ページ設定（一括抽出のワーカープロセスがこのファイルを読み込んでも画面出力しないようmain内で実行）
+    st.set_page_config(
+        page_title="電子公図データ抽出ツール",
+        page_icon="🗺️",
+        layout="wide"
+    )
+    
     st.title("🗺️ 電子公図データ抽出ツール")
     st.markdown("---")
     
@@ -692,9 +3408,46 @@ def main():
                 st.sidebar.success(f"✅ {len(web_files)}個のファイルが見つかりました")
                 st.session_state.current_web_files = web_files
                 st.session_state.current_folder_url = folder_url
+                extractor.store_folder_routes(folder_url, web_files)
             else:
                 st.sidebar.warning("❌ 対応ファイルが見つかりませんでした")
     
+    # 市区町村コード・名称・カナ読みから該当ファイルだけを読み込み（フォルダ一覧の取得は初回のみ）
+    if folder_url:
+        municipality_query = st.sidebar.text_input(
+            "🔎 市区町村で開く",
+            placeholder="47350 / 南風原町 / はえばる",
+            help="市区町村コード・名称・読み（カナ/ひらがな）から該当するファイルを直接読み込みます"
+        )
+        if municipality_query.strip():
+            try:
+                matches = extractor.resolve_municipality(folder_url, municipality_query)
+            except Exception as e:
+                st.sidebar.error(f"❌ 市区町村の検索エラー: {str(e)}")
+                matches = []
+            
+            if matches:
+                match_labels = [f"{match['code']} {match['prefecture']}{match['name']}" for match in matches]
+                selected_label = st.sidebar.selectbox("該当する市区町村", match_labels)
+                selected_match = matches[match_labels.index(selected_label)]
+                
+                if st.sidebar.button("📥 市区町村のファイルを読み込み", type="primary"):
+                    file_info = selected_match['file']
+                    try:
+                        with st.spinner(f"{selected_match['name']}のファイルを読み込み中..."):
+                            dataset = extractor.load_dataset_from_url(file_info['url'], content_key=file_info.get('sha'))
+                        
+                        extractor.set_current_dataset(dataset, name=unquote(file_info['name']))
+                        show_loaded_dataset_info(dataset, "✅ ファイル読み込み完了!")
+                        
+                        st.session_state.data_source = "市区町村検索"
+                        st.session_state.current_preset = unquote(file_info['name'])
+                        st.session_state.file_info = file_info['url']
+                    except Exception as e:
+                        st.sidebar.error(f"❌ ファイル読み込みエラー: {str(e)}")
+            else:
+                st.sidebar.warning("該当する市区町村のファイルが見つかりません")
+    
     # キャッシュされたファイル一覧を使用
     if 'current_web_files' in st.session_state:
         web_files = st.session_state.current_web_files
@@ -703,6 +3456,67 @@ def main():
             st.sidebar.write(f"**📁 {st.session_state.current_folder_url}**")
             st.sidebar.write(f"利用可能ファイル: {len(web_files)}個")
             
+            # バックグラウンド先読み（全ファイルを並列にダウンロード・変換しておく）
+            prefetcher = get_dataset_prefetcher()
+            if st.sidebar.button(
+                "⚡ 全ファイルをバックグラウンドで先読み",
+                help="一覧の全ファイルを並列にダウンロード・変換し、切り替えを即座に行えるようにします"
+            ):
+                prefetcher.start(st.session_state.current_folder_url, web_files, extractor.prefetch_dataset)
+            
+            prefetch_status = prefetcher.status(st.session_state.current_folder_url)
+            if prefetch_status:
+                done, total = prefetch_status['done'], prefetch_status['total']
+                if prefetch_status['cancelled']:
+                    progress_text = f"⏹ 先読み中止: {done}/{total}件"
+                elif done < total:
+                    progress_text = f"⚡ 先読み中: {done}/{total}件"
+                else:
+                    progress_text = f"✅ 先読み完了: {total}件"
+                st.sidebar.progress(done / total if total else 1.0, text=progress_text)
+                
+                if done < total:
+                    col_refresh, col_cancel = st.sidebar.columns(2)
+                    with col_refresh:
+                        st.button("🔄 進捗を更新", key="prefetch_refresh")
+                    with col_cancel:
+                        if st.button("⏹ 先読みを中止", key="prefetch_cancel"):
+                            prefetcher.cancel(st.session_state.current_folder_url)
+                            st.rerun()
+                
+                if prefetch_status['errors']:
+                    with st.sidebar.expander(f"⚠️ 先読みエラー ({len(prefetch_status['errors'])}件)"):
+                        for error in prefetch_status['errors']:
+                            st.write(error)
+            
+            # 県全体の統合データセット（全ファイルを市区町村コードで区分して1つにまとめる）
+            if st.sidebar.button(
+                "🗾 全ファイルを統合して県全体で検索",
+                help="一覧の全ファイルを並列に読み込み、市区町村をまたいで大字名・地番を検索できるようにします"
+            ):
+                progress_bar = st.sidebar.progress(0.0, text="🗾 統合データセットを構築中...")
+                try:
+                    prefecture, build_errors = extractor.build_prefecture_dataset(
+                        st.session_state.current_folder_url,
+                        web_files,
+                        progress_callback=lambda done, total: progress_bar.progress(
+                            done / total, text=f"🗾 統合データセットを構築中: {done}/{total}件"
+                        )
+                    )
+                    st.session_state.prefecture_key = prefecture.key
+                    st.session_state.prefecture_errors = build_errors
+                    progress_bar.progress(
+                        1.0, text=f"✅ 統合完了: {len(prefecture.partitions)}市区町村, {len(prefecture.attributes):,}筆"
+                    )
+                except Exception as e:
+                    progress_bar.empty()
+                    st.sidebar.error(f"❌ 統合データセットの構築エラー: {str(e)}")
+            
+            if st.session_state.get('prefecture_errors'):
+                with st.sidebar.expander(f"⚠️ 統合時のエラー ({len(st.session_state.prefecture_errors)}件)"):
+                    for error in st.session_state.prefecture_errors:
+                        st.write(error)
+            
             # ファイル選択
             file_options = ["選択なし"] + [f["name"] for f in web_files]
             selected_file = st.sidebar.selectbox(
@@ -720,22 +3534,12 @@ def main():
                     if st.sidebar.button("📥 選択ファイルを読み込み", type="primary"):
                         try:
                             with st.spinner(f"ファイル「{selected_file}」を読み込み中..."):
-                                st.session_state.gdf = extractor.load_shapefile_from_url(selected_file_info['url'])
-                            
-                            st.sidebar.success("✅ ファイル読み込み完了!")
-                            st.sidebar.info(f"📊 レコード数: {len(st.session_state.gdf):,}件")
-                            
-                            if st.session_state.gdf.crs:
-                                st.sidebar.info(f"🗺️ 座標系: {st.session_state.gdf.crs}")
-                            
-                            # 丁目名・小字名列の存在確認
-                            if '丁目名' in st.session_state.gdf.columns:
-                                chome_count = st.session_state.gdf['丁目名'].notna().sum()
-                                st.sidebar.info(f"🏘️ 丁目データ: {chome_count}件")
+                                dataset = extractor.load_dataset_from_url(
+                                    selected_file_info['url'], content_key=selected_file_info.get('sha')
+                                )
                             
-                            if '小字名' in st.session_state.gdf.columns:
-                                koaza_count = st.session_state.gdf['小字名'].notna().sum()
-                                st.sidebar.info(f"🏞️ 小字データ: {koaza_count}件")
+                            extractor.set_current_dataset(dataset, name=selected_file)
+                            show_loaded_dataset_info(dataset, "✅ ファイル読み込み完了!")
                             
                             # データソース情報を記録
                             st.session_state.data_source = "Webフォルダ"
@@ -782,22 +3586,10 @@ def main():
         if st.sidebar.button("📋 固定プリセットを読み込み", type="secondary"):
             try:
                 with st.spinner(f"プリセット「{selected_preset}」を読み込み中..."):
-                    st.session_state.gdf = extractor.load_shapefile_from_url(preset_info['url'])
+                    dataset = extractor.load_dataset_from_url(preset_info['url'])
                 
-                st.sidebar.success("✅ プリセット読み込み完了!")
-                st.sidebar.info(f"📊 レコード数: {len(st.session_state.gdf):,}件")
-                
-                if st.session_state.gdf.crs:
-                    st.sidebar.info(f"🗺️ 座標系: {st.session_state.gdf.crs}")
-                
-                # 丁目名・小字名列の存在確認
-                if '丁目名' in st.session_state.gdf.columns:
-                    chome_count = st.session_state.gdf['丁目名'].notna().sum()
-                    st.sidebar.info(f"🏘️ 丁目データ: {chome_count}件")
-                
-                if '小字名' in st.session_state.gdf.columns:
-                    koaza_count = st.session_state.gdf['小字名'].notna().sum()
-                    st.sidebar.info(f"🏞️ 小字データ: {koaza_count}件")
+                extractor.set_current_dataset(dataset, name=preset_info['name'])
+                show_loaded_dataset_info(dataset, "✅ プリセット読み込み完了!")
                 
                 # データソース情報を記録
                 st.session_state.data_source = "固定プリセット"
@@ -827,41 +3619,17 @@ def main():
         
         if uploaded_file is not None:
             try:
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    # ZIPファイルを展開
-                    with zipfile.ZipFile(uploaded_file, 'r') as zip_ref:
-                        zip_ref.extractall(temp_dir)
-                    
-                    # SHPファイルを探す
-                    shp_files = [f for f in os.listdir(temp_dir) if f.endswith('.shp')]
-                    
-                    if shp_files:
-                        shp_path = os.path.join(temp_dir, shp_files[0])
-                        st.session_state.gdf = gpd.read_file(shp_path)
-                        
-                        st.sidebar.success("✅ ファイル読み込み完了!")
-                        st.sidebar.info(f"📊 レコード数: {len(st.session_state.gdf):,}件")
-                        
-                        # 座標参照系の確認
-                        if st.session_state.gdf.crs:
-                            st.sidebar.info(f"🗺️ 座標系: {st.session_state.gdf.crs}")
-                        
-                        # 丁目名・小字名列の存在確認
-                        if '丁目名' in st.session_state.gdf.columns:
-                            chome_count = st.session_state.gdf['丁目名'].notna().sum()
-                            st.sidebar.info(f"🏘️ 丁目データ: {chome_count}件")
-                        
-                        if '小字名' in st.session_state.gdf.columns:
-                            koaza_count = st.session_state.gdf['小字名'].notna().sum()
-                            st.sidebar.info(f"🏞️ 小字データ: {koaza_count}件")
-                        
-                        # データソース情報を記録
-                        st.session_state.data_source = "ローカルファイル"
-                        st.session_state.file_info = uploaded_file.name
-                        if 'current_preset' in st.session_state:
-                            del st.session_state.current_preset
-                    else:
-                        st.sidebar.error("❌ SHPファイルが見つかりません")
+                # ZIPファイルを展開せずメモリ上から読み込み（変換済みキャッシュがあれば使用）
+                dataset = extractor.load_dataset_from_zip(uploaded_file)
+                
+                extractor.set_current_dataset(dataset, name=uploaded_file.name)
+                show_loaded_dataset_info(dataset, "✅ ファイル読み込み完了!")
+                
+                # データソース情報を記録
+                st.session_state.data_source = "ローカルファイル"
+                st.session_state.file_info = uploaded_file.name
+                if 'current_preset' in st.session_state:
+                    del st.session_state.current_preset
                         
             except Exception as e:
                 st.sidebar.error(f"❌ ファイル読み込みエラー: {str(e)}")
@@ -878,22 +3646,10 @@ def main():
             if web_url:
                 try:
                     with st.spinner("URLからファイルを読み込み中..."):
-                        st.session_state.gdf = extractor.load_shapefile_from_url(web_url)
-                    
-                    st.sidebar.success("✅ ファイル読み込み完了!")
-                    st.sidebar.info(f"📊 レコード数: {len(st.session_state.gdf):,}件")
-                    
-                    if st.session_state.gdf.crs:
-                        st.sidebar.info(f"🗺️ 座標系: {st.session_state.gdf.crs}")
+                        dataset = extractor.load_dataset_from_url(web_url)
                     
-                    # 丁目名・小字名列の存在確認
-                    if '丁目名' in st.session_state.gdf.columns:
-                        chome_count = st.session_state.gdf['丁目名'].notna().sum()
-                        st.sidebar.info(f"🏘️ 丁目データ: {chome_count}件")
-                    
-                    if '小字名' in st.session_state.gdf.columns:
-                        koaza_count = st.session_state.gdf['小字名'].notna().sum()
-                        st.sidebar.info(f"🏞️ 小字データ: {koaza_count}件")
+                    extractor.set_current_dataset(dataset, name=web_url)
+                    show_loaded_dataset_info(dataset, "✅ ファイル読み込み完了!")
                     
                     # データソース情報を記録
                     st.session_state.data_source = "Web URL"
@@ -928,22 +3684,10 @@ def main():
                     github_url = f"https://github.com/{github_owner}/{github_repo}/blob/{github_branch}/{github_path}"
                     
                     with st.spinner("GitHubからファイルを読み込み中..."):
-                        st.session_state.gdf = extractor.load_shapefile_from_url(github_url)
-                    
-                    st.sidebar.success("✅ ファイル読み込み完了!")
-                    st.sidebar.info(f"📊 レコード数: {len(st.session_state.gdf):,}件")
-                    
-                    if st.session_state.gdf.crs:
-                        st.sidebar.info(f"🗺️ 座標系: {st.session_state.gdf.crs}")
-                    
-                    # 丁目名・小字名列の存在確認
-                    if '丁目名' in st.session_state.gdf.columns:
-                        chome_count = st.session_state.gdf['丁目名'].notna().sum()
-                        st.sidebar.info(f"🏘️ 丁目データ: {chome_count}件")
+                        dataset = extractor.load_dataset_from_url(github_url)
                     
-                    if '小字名' in st.session_state.gdf.columns:
-                        koaza_count = st.session_state.gdf['小字名'].notna().sum()
-                        st.sidebar.info(f"🏞️ 小字データ: {koaza_count}件")
+                    extractor.set_current_dataset(dataset, name=github_path)
+                    show_loaded_dataset_info(dataset, "✅ ファイル読み込み完了!")
                     
                     # データソース情報を記録
                     st.session_state.data_source = "GitHub"
@@ -956,8 +3700,18 @@ def main():
             else:
                 st.sidebar.error("GitHubの情報をすべて入力してください")
     
-    # メインエリア
-    if st.session_state.gdf is not None:
+    # メインエリア（共有データセットを参照し、セッションごとのコピーは持たない）
+    # 画面操作は属性データのみで行い、ジオメトリは抽出時に必要な分だけ読み込む
+    dataset = extractor.get_current_dataset()
+    gdf = dataset.attributes if dataset is not None else None
+    
+    # 県全体の統合データセットを構築済みの場合は市区町村をまたいだ検索を表示
+    prefecture = extractor.get_current_prefecture()
+    if prefecture is not None:
+        show_prefecture_search(extractor, prefecture, expanded=gdf is None)
+        show_prefecture_batch(extractor, prefecture)
+    
+    if gdf is not None:
         col1, col2 = st.columns([1, 1])
         
         with col1:
@@ -965,19 +3719,23 @@ def main():
             
             # 大字名選択（データが存在する場合のみ）
             selected_oaza = None
+            # 大字名・丁目名・小字名の選択肢は読み込み時に作成した階層索引から引く（再描画のたびに全件を走査しない）
+            hierarchy = dataset.address_hierarchy
             try:
-                if '大字名' in st.session_state.gdf.columns:
-                    # NULL値を除外してソート
-                    oaza_series = st.session_state.gdf['大字名'].dropna()
-                    if len(oaza_series) > 0:
-                        oaza_list = sorted(oaza_series.unique())
-                        selected_oaza = st.selectbox("大字名を選択", oaza_list)
+                if '大字名' in gdf.columns:
+                    # NULL値を除外して名前順に並べた一覧
+                    oaza_list = hierarchy.oaza_list
+                    if len(oaza_list) > 0:
+                        selected_oaza = st.selectbox(
+                            "大字名を選択", oaza_list,
+                            format_func=lambda oaza: f"{oaza}（{hierarchy.count(oaza):,}筆）"
+                        )
                     else:
                         st.error("❌ 大字名データがすべてNULLです")
                         selected_oaza = None
                 else:
                     st.error("❌ '大字名'列が見つかりません。データの形式を確認してください。")
-                    st.write("**利用可能な列:**", list(st.session_state.gdf.columns))
+                    st.write("**利用可能な列:**", list(gdf.columns))
                     selected_oaza = None
             except Exception as e:
                 st.error(f"❌ データ読み込みエラー: {str(e)}")
@@ -986,7 +3744,7 @@ def main():
             # 丁目名選択（大字名が選択されている場合のみ）
             selected_chome = None
             if selected_oaza is not None:
-                chome_options = get_chome_options(st.session_state.gdf, selected_oaza)
+                chome_options = get_chome_options(hierarchy, selected_oaza)
                 
                 if chome_options is not None and len(chome_options) > 0:
                     # 丁目選択肢がある場合
@@ -994,6 +3752,7 @@ def main():
                     selected_chome = st.selectbox(
                         "丁目名を選択（任意）", 
                         chome_list_with_none,
+                        format_func=lambda chome: chome if chome == "選択なし" else f"{chome}（{hierarchy.count(selected_oaza, chome):,}筆）",
                         help="丁目を指定する場合は選択してください。指定しない場合は「選択なし」のままにしてください。"
                     )
                     
@@ -1002,7 +3761,7 @@ def main():
                     else:
                         st.success(f"✅ 丁目「{selected_chome}」を指定しました")
                         
-                elif '丁目名' in st.session_state.gdf.columns:
+                elif '丁目名' in gdf.columns:
                     # 丁目名列は存在するが、この大字名には丁目データがない
                     st.info("ℹ️ この大字名には丁目データがありません")
                 else:
@@ -1012,7 +3771,8 @@ def main():
             # 小字名選択（大字名が選択されている場合のみ）
             selected_koaza = None
             if selected_oaza is not None:
-                koaza_options = get_koaza_options(st.session_state.gdf, selected_oaza, selected_chome)
+                koaza_options = get_koaza_options(hierarchy, selected_oaza, selected_chome)
+                koaza_chome = selected_chome if selected_chome and selected_chome != "選択なし" else None
                 
                 if koaza_options is not None and len(koaza_options) > 0:
                     # 小字選択肢がある場合
@@ -1020,6 +3780,7 @@ def main():
                     selected_koaza = st.selectbox(
                         "小字名を選択（任意）", 
                         koaza_list_with_none,
+                        format_func=lambda koaza: koaza if koaza == "選択なし" else f"{koaza}（{hierarchy.count(selected_oaza, koaza_chome, koaza):,}筆）",
                         help="小字を指定する場合は選択してください。指定しない場合は「選択なし」のままにしてください。"
                     )
                     
@@ -1028,7 +3789,7 @@ def main():
                     else:
                         st.success(f"✅ 小字「{selected_koaza}」を指定しました")
                         
-                elif '小字名' in st.session_state.gdf.columns:
+                elif '小字名' in gdf.columns:
                     # 小字名列は存在するが、この大字名（丁目名）には小字データがない
                     condition_text = f"大字名「{selected_oaza}」"
                     if selected_chome and selected_chome != "選択なし":
@@ -1041,23 +3802,69 @@ def main():
             # 地番入力
             chiban = st.text_input("地番を入力", value="1174")
             
-            # 検索範囲を固定値に設定
-            range_m = 61
+            # 検索範囲の形と距離（カンマ区切りで複数指定すると、周辺筆に最も内側の範囲を付ける）
+            search_shape = st.selectbox(
+                "検索範囲の形", list(SEARCH_SHAPES), format_func=SEARCH_SHAPES.get,
+                help="正方形・円は対象筆ごとにその中心から、境界からの距離は筆の境界から測ります（対象筆が複数ある場合は全ての対象筆の範囲を抽出）"
+            )
+            range_m = [DEFAULT_RANGE_M]
+            search_polygon = None
+            nearest_count = None
+            range_error = None
+            if search_shape == 'nearest':
+                col_count, col_distance = st.columns(2)
+                with col_count:
+                    nearest_count = int(st.number_input("筆の数", min_value=1, max_value=500, value=DEFAULT_NEAREST_COUNT, step=1))
+                with col_distance:
+                    max_distance = st.number_input(
+                        "最大距離（m）", min_value=1.0, value=float(DEFAULT_NEAREST_MAX_DISTANCE_M), step=10.0,
+                        help="筆の境界どうしの距離がこの距離までの筆から、近い順に指定した数の筆を抽出します"
+                    )
+                range_m = [max_distance]
+                range_text = f"近い順 {nearest_count}筆（最大{format_range_tier(max_distance)}）"
+            elif search_shape == 'polygon':
+                polygon_text = st.text_area(
+                    "検索範囲の多角形（緯度経度のGeoJSONまたはWKT）",
+                    placeholder="POLYGON((127.72 26.19, 127.73 26.19, 127.73 26.20, 127.72 26.20, 127.72 26.19))"
+                )
+                range_text = "任意の多角形"
+                if polygon_text.strip():
+                    try:
+                        search_polygon = parse_search_polygon(polygon_text, dataset.crs)
+                    except Exception as e:
+                        range_error = str(e)
+                else:
+                    range_error = "検索範囲の多角形を入力してください"
+            else:
+                range_input = st.text_input(
+                    "検索範囲（m）", value=str(DEFAULT_RANGE_M),
+                    help="「30, 61, 100」のようにカンマ区切りで複数の距離を指定できます"
+                )
+                try:
+                    range_m = sorted({float(value) for value in re.split(r'[,、\s]+', unicodedata.normalize('NFKC', range_input).strip()) if value})
+                except ValueError:
+                    range_m = []
+                if not range_m or min(range_m) <= 0:
+                    range_error = "検索範囲には正の数値を入力してください"
+                range_text = f"{SEARCH_SHAPES[search_shape]} {' / '.join(format_range_tier(r) for r in range_m)}"
             
             # 抽出ボタン
             if st.button("🚀 データ抽出", type="primary", use_container_width=True):
-                if selected_oaza and chiban:
+                if range_error:
+                    st.error(f"❌ {range_error}")
+                elif selected_oaza and chiban:
                     # 必要な列が存在するかチェック
                     required_columns = ['大字名', '地番']
-                    missing_columns = [col for col in required_columns if col not in st.session_state.gdf.columns]
+                    missing_columns = [col for col in required_columns if col not in gdf.columns]
                     
                     if missing_columns:
                         st.error(f"❌ 必要な列が見つかりません: {missing_columns}")
-                        st.write("**利用可能な列:**", list(st.session_state.gdf.columns))
+                        st.write("**利用可能な列:**", list(gdf.columns))
                     else:
                         with st.spinner("データ抽出中..."):
                             target_gdf, overlay_gdf, message = extractor.extract_data(
-                                st.session_state.gdf, selected_oaza, selected_chome, selected_koaza, chiban, range_m
+                                dataset, selected_oaza, selected_chome, selected_koaza, chiban, range_m,
+                                shape=search_shape, polygon=search_polygon, k=nearest_count
                             )
                         
                         st.info(message)
@@ -1076,10 +3883,52 @@ def main():
                             file_name_parts.append(chiban)
                             
                             st.session_state.file_name = "_".join(file_name_parts)
+                            st.session_state.result_id = extractor.result_id(
+                                dataset, selected_oaza, selected_chome, selected_koaza, chiban, range_m,
+                                shape=search_shape, polygon=search_polygon, k=nearest_count
+                            )
+                            st.session_state.range_text = range_text
                 elif not selected_oaza:
                     st.error("大字名を選択してください")
                 else:
                     st.error("地番を入力してください")
+            
+            # 一括抽出（CSV/Excelの依頼一覧をまとめて処理）
+            with st.expander("📑 一括抽出（CSV/Excel）"):
+                st.write("大字名・地番の列（任意で丁目名・小字名・検索範囲）を持つ依頼一覧をまとめて抽出します。")
+                template_csv = pd.DataFrame(
+                    columns=['依頼番号', '大字名', '丁目名', '小字名', '地番', '検索範囲']
+                ).to_csv(index=False, encoding='shift-jis')
+                st.download_button(
+                    "📄 依頼一覧のひな形CSV",
+                    data=template_csv,
+                    file_name="一括抽出_依頼一覧.csv",
+                    mime="text/csv",
+                    use_container_width=True
+                )
+                batch_file = st.file_uploader("依頼一覧ファイル", type=['csv', 'xlsx', 'xls'], key="batch_file")
+                
+                if batch_file is not None and st.button("📑 一括抽出を実行", use_container_width=True):
+                    try:
+                        requests_df = read_batch_requests(batch_file, batch_file.name)
+                        batch_name = os.path.splitext(batch_file.name)[0]
+                        with st.spinner(f"{len(requests_df)}件を一括抽出中..."):
+                            batch_status, batch_target_gdf, batch_overlay_gdf = extractor.extract_batch(dataset, requests_df)
+                        
+                        st.session_state.batch_result = {
+                            'id': uuid.uuid4().hex,
+                            'status': batch_status,
+                            'files': build_batch_downloads(
+                                extractor, batch_name, batch_status, batch_target_gdf, batch_overlay_gdf
+                            ),
+                            'layers': {'対象筆': batch_target_gdf, '周辺筆': batch_overlay_gdf},
+                            'name': batch_name
+                        }
+                    except Exception as e:
+                        st.error(f"❌ 一括抽出エラー: {str(e)}")
+                
+                if 'batch_result' in st.session_state:
+                    show_batch_result(extractor, st.session_state.batch_result, key="batch")
         
         with col2:
             st.header("📊 データ一覧")
@@ -1088,6 +3937,8 @@ def main():
             if 'data_source' in st.session_state:
                 with st.expander("ℹ️ 現在のデータ情報"):
                     st.write(f"**データソース**: {st.session_state.data_source}")
+                    if st.session_state.get('dataset_name'):
+                        st.write(f"**データセット**: {st.session_state.dataset_name}")
                     if 'current_preset' in st.session_state:
                         st.write(f"**プリセット**: {st.session_state.current_preset}")
                     if 'file_info' in st.session_state:
@@ -1095,22 +3946,45 @@ def main():
                     if 'current_folder_url' in st.session_state:
                         st.write(f"**フォルダURL**: {st.session_state.current_folder_url}")
                     
-                    if st.session_state.gdf is not None:
-                        st.write(f"**レコード数**: {len(st.session_state.gdf):,}件")
-                        st.write(f"**カラム数**: {len(st.session_state.gdf.columns)}個")
-                        if st.session_state.gdf.crs:
-                            st.write(f"**座標系**: {st.session_state.gdf.crs}")
+                    if gdf is not None:
+                        st.write(f"**レコード数**: {len(gdf):,}件")
+                        st.write(f"**カラム数**: {len(gdf.columns)}個")
+                        if dataset.crs:
+                            st.write(f"**座標系**: {dataset.crs}")
                         
                         # 丁目・小字データの有無を表示
-                        if '丁目名' in st.session_state.gdf.columns:
-                            chome_count = st.session_state.gdf['丁目名'].notna().sum()
-                            total_count = len(st.session_state.gdf)
+                        if '丁目名' in gdf.columns:
+                            chome_count = gdf['丁目名'].notna().sum()
+                            total_count = len(gdf)
                             st.write(f"**丁目データ**: {chome_count}/{total_count}件 ({chome_count/total_count*100:.1f}%)")
                         
-                        if '小字名' in st.session_state.gdf.columns:
-                            koaza_count = st.session_state.gdf['小字名'].notna().sum()
-                            total_count = len(st.session_state.gdf)
+                        if '小字名' in gdf.columns:
+                            koaza_count = gdf['小字名'].notna().sum()
+                            total_count = len(gdf)
                             st.write(f"**小字データ**: {koaza_count}/{total_count}件 ({koaza_count/total_count*100:.1f}%)")
+                        
+                        if dataset.memory_report is not None:
+                            st.write(
+                                f"**属性メモリ**: {dataset.memory_report['before'] / 1024 / 1024:.1f}MB → "
+                                f"{dataset.memory_report['after'] / 1024 / 1024:.1f}MB（カテゴリ型化・文字列の共有後）"
+                            )
+                            for note in dataset.memory_report['notes']:
+                                st.caption(f"ℹ️ {note}")
+                        
+                        # 全セッションで共有しているデータセットのメモリ使用状況
+                        shared_datasets = extractor.registry.summary()
+                        shared_mb = sum(item['nbytes'] for item in shared_datasets) / 1024 / 1024
+                        st.write(f"**共有メモリ**: {shared_mb:.1f}/{DATASET_MEMORY_LIMIT_MB}MB ({len(shared_datasets)}データセット)")
+                        
+                        # 全セッションで共有している抽出結果キャッシュの利用状況
+                        cache_stats = extractor.result_cache.stats()
+                        lookups = cache_stats['hits'] + cache_stats['misses']
+                        hit_rate = cache_stats['hits'] / lookups * 100 if lookups else 0
+                        st.write(
+                            f"**抽出結果キャッシュ**: ヒット {cache_stats['hits']}件 / ミス {cache_stats['misses']}件 "
+                            f"(ヒット率 {hit_rate:.1f}%), {cache_stats['entries']}件 "
+                            f"{cache_stats['nbytes'] / 1024 / 1024:.1f}/{RESULT_CACHE_MEMORY_MB}MB"
+                        )
             
             # Webフォルダから取得したファイル一覧の表示
             if 'current_web_files' in st.session_state and st.session_state.current_web_files:
@@ -1147,25 +4021,25 @@ def main():
             # 大字名・丁目名・小字名のサマリー
             if st.checkbox("大字名・丁目名・小字名一覧を表示"):
                 try:
-                    if '大字名' in st.session_state.gdf.columns:
+                    if '大字名' in gdf.columns:
                         # NULL値を除外して集計
-                        oaza_clean = st.session_state.gdf['大字名'].dropna()
+                        oaza_clean = gdf['大字名'].dropna()
                         if len(oaza_clean) > 0:
                             st.write("**大字名別集計:**")
                             oaza_summary = oaza_clean.value_counts()
                             st.dataframe(oaza_summary.head(20), use_container_width=True)
                             
                             # 丁目名の集計も表示
-                            if '丁目名' in st.session_state.gdf.columns:
-                                chome_clean = st.session_state.gdf['丁目名'].dropna()
+                            if '丁目名' in gdf.columns:
+                                chome_clean = gdf['丁目名'].dropna()
                                 if len(chome_clean) > 0:
                                     st.write("**丁目名別集計:**")
                                     chome_summary = chome_clean.value_counts()
                                     st.dataframe(chome_summary.head(20), use_container_width=True)
                             
                             # 小字名の集計も表示
-                            if '小字名' in st.session_state.gdf.columns:
-                                koaza_clean = st.session_state.gdf['小字名'].dropna()
+                            if '小字名' in gdf.columns:
+                                koaza_clean = gdf['小字名'].dropna()
                                 if len(koaza_clean) > 0:
                                     st.write("**小字名別集計:**")
                                     koaza_summary = koaza_clean.value_counts()
@@ -1173,14 +4047,14 @@ def main():
                             
                             # 大字名×丁目名×小字名のクロス集計
                             cross_columns = ['大字名']
-                            if '丁目名' in st.session_state.gdf.columns:
+                            if '丁目名' in gdf.columns:
                                 cross_columns.append('丁目名')
-                            if '小字名' in st.session_state.gdf.columns:
+                            if '小字名' in gdf.columns:
                                 cross_columns.append('小字名')
                             
                             if len(cross_columns) > 1:
                                 st.write(f"**{' × '.join(cross_columns)}の組み合わせ:**")
-                                cross_data = st.session_state.gdf.copy()
+                                cross_data = gdf.copy()
                                 
                                 # 各列がNULLでないデータのみ抽出
                                 for col in cross_columns:
@@ -1194,8 +4068,8 @@ def main():
                             # NULL値の情報も表示
                             null_info = []
                             for col in ['大字名', '丁目名', '小字名']:
-                                if col in st.session_state.gdf.columns:
-                                    null_count = st.session_state.gdf[col].isnull().sum()
+                                if col in gdf.columns:
+                                    null_count = gdf[col].isnull().sum()
                                     if null_count > 0:
                                         null_info.append(f"{col}: {null_count}件")
                             
@@ -1210,35 +4084,39 @@ def main():
             
             # 地番検索（改良版）
             if st.checkbox("地番検索"):
-                search_term = st.text_input("地番を検索", placeholder="例: 1174")
+                search_term = st.text_input("地番を検索", placeholder="例: 1174 / 範囲の場合 1174〜1180-3").strip()
+                # 索引の地番と同じく正規化して照合（全角数字・ハイフンの違いを同一視）
+                search_term = normalize_address_key(search_term, chiban=True) if search_term else search_term
                 
                 # 検索オプション
                 col_search1, col_search2 = st.columns(2)
                 with col_search1:
-                    exact_match = st.checkbox("完全一致", value=False, help="チェックすると完全一致で検索します")
+                    search_mode = st.radio(
+                        "検索方法", ["部分一致", "前方一致", "完全一致", "範囲"], horizontal=True,
+                        help="範囲は「1174〜1180-3」のように本番-枝番で指定します（数値の順で検索）"
+                    )
                 with col_search2:
                     show_geometry = st.checkbox("座標情報を表示", value=False, help="検索結果に座標情報を含めます")
                 
                 if search_term:
                     try:
-                        if '地番' in st.session_state.gdf.columns:
-                            # 地番をstring型に変換してから検索（NULL値も考慮）
-                            chiban_str = st.session_state.gdf['地番'].astype(str)
-                            
-                            if exact_match:
-                                # 完全一致検索
-                                filtered = st.session_state.gdf[
-                                    (chiban_str == search_term) & 
-                                    (chiban_str != 'nan') & 
-                                    (st.session_state.gdf['地番'].notna())
-                                ]
+                        if '地番' in gdf.columns:
+                            # 地番の索引から該当する行位置を引く（全件の文字列変換・走査は行わない）
+                            chiban_index = dataset.chiban_index
+                            if search_mode == "完全一致":
+                                positions = chiban_index.exact(search_term)
+                            elif search_mode == "前方一致":
+                                positions = chiban_index.prefix(search_term)
+                            elif search_mode == "範囲":
+                                chiban_range = parse_chiban_range(search_term)
+                                if chiban_range is None:
+                                    st.warning("範囲は「1174〜1180-3」のように「〜」でつないで入力してください")
+                                    positions = np.array([], dtype=np.intp)
+                                else:
+                                    positions = chiban_index.range(*chiban_range)
                             else:
-                                # 部分一致検索
-                                filtered = st.session_state.gdf[
-                                    (chiban_str.str.contains(search_term, na=False)) & 
-                                    (chiban_str != 'nan') & 
-                                    (st.session_state.gdf['地番'].notna())
-                                ]
+                                positions = chiban_index.substring(search_term)
+                            filtered = gdf.iloc[positions]
                             
                             # 表示用の列を選択
                             display_columns = []
@@ -1246,11 +4124,12 @@ def main():
                                 if col in filtered.columns:
                                     display_columns.append(col)
                             
-                            # 座標情報を追加する場合
-                            if show_geometry and 'geometry' in filtered.columns:
+                            # 座標情報を追加する場合（該当筆のジオメトリのみ読み込み）
+                            if show_geometry:
                                 filtered_with_coords = filtered.copy()
-                                filtered_with_coords['中心X座標'] = filtered_with_coords['geometry'].centroid.x
-                                filtered_with_coords['中心Y座標'] = filtered_with_coords['geometry'].centroid.y
+                                centroids = dataset.geometries(filtered.index).centroid
+                                filtered_with_coords['中心X座標'] = centroids.x
+                                filtered_with_coords['中心Y座標'] = centroids.y
                                 display_columns.extend(['中心X座標', '中心Y座標'])
                                 filtered = filtered_with_coords
                             
@@ -1274,24 +4153,24 @@ def main():
                     except Exception as e:
                         st.error(f"検索エラー: {str(e)}")
                         # デバッグ情報
-                        st.write("地番列のデータ型:", st.session_state.gdf['地番'].dtype)
-                        st.write("地番列のNULL数:", st.session_state.gdf['地番'].isnull().sum())
+                        st.write("地番列のデータ型:", gdf['地番'].dtype)
+                        st.write("地番列のNULL数:", gdf['地番'].isnull().sum())
             
             # データ構造の確認
             if st.checkbox("📋 データ構造を確認"):
                 try:
                     st.write("**カラム一覧:**")
                     col_info = pd.DataFrame({
-                        'カラム名': st.session_state.gdf.columns,
-                        'データ型': st.session_state.gdf.dtypes.astype(str),
-                        '非NULL数': st.session_state.gdf.count(),
-                        'NULL数': st.session_state.gdf.isnull().sum()
+                        'カラム名': gdf.columns,
+                        'データ型': gdf.dtypes.astype(str),
+                        '非NULL数': gdf.count(),
+                        'NULL数': gdf.isnull().sum()
                     })
-                    col_info['NULL率(%)'] = (col_info['NULL数'] / len(st.session_state.gdf) * 100).round(1)
+                    col_info['NULL率(%)'] = (col_info['NULL数'] / len(gdf) * 100).round(1)
                     st.dataframe(col_info, use_container_width=True)
                     
                     st.write("**データサンプル (最初の5行):**")
-                    display_df = st.session_state.gdf.head()
+                    display_df = gdf.head()
                     if 'geometry' in display_df.columns:
                         display_df = display_df.drop(columns=['geometry'])
                     st.dataframe(display_df, use_container_width=True)
@@ -1299,19 +4178,19 @@ def main():
                     # 統計情報の表示
                     st.write("**基本統計:**")
                     stats_info = {
-                        '総レコード数': len(st.session_state.gdf),
-                        '座標系': str(st.session_state.gdf.crs) if st.session_state.gdf.crs else '不明',
-                        '大字名の種類数': st.session_state.gdf['大字名'].nunique() if '大字名' in st.session_state.gdf.columns else 'なし',
-                        '地番の種類数': st.session_state.gdf['地番'].nunique() if '地番' in st.session_state.gdf.columns else 'なし'
+                        '総レコード数': len(gdf),
+                        '座標系': str(dataset.crs) if dataset.crs else '不明',
+                        '大字名の種類数': gdf['大字名'].nunique() if '大字名' in gdf.columns else 'なし',
+                        '地番の種類数': gdf['地番'].nunique() if '地番' in gdf.columns else 'なし'
                     }
                     
-                    if '丁目名' in st.session_state.gdf.columns:
-                        stats_info['丁目名の種類数'] = st.session_state.gdf['丁目名'].nunique()
-                        stats_info['丁目データ有り'] = st.session_state.gdf['丁目名'].notna().sum()
+                    if '丁目名' in gdf.columns:
+                        stats_info['丁目名の種類数'] = gdf['丁目名'].nunique()
+                        stats_info['丁目データ有り'] = gdf['丁目名'].notna().sum()
                     
-                    if '小字名' in st.session_state.gdf.columns:
-                        stats_info['小字名の種類数'] = st.session_state.gdf['小字名'].nunique()
-                        stats_info['小字データ有り'] = st.session_state.gdf['小字名'].notna().sum()
+                    if '小字名' in gdf.columns:
+                        stats_info['小字名の種類数'] = gdf['小字名'].nunique()
+                        stats_info['小字データ有り'] = gdf['小字名'].notna().sum()
                     
                     for key, value in stats_info.items():
                         st.write(f"- **{key}**: {value}")
@@ -1324,54 +4203,54 @@ def main():
             st.markdown("---")
             st.header("📥 ダウンロード")
             
+            # ファイルは再描画のたびに作らず、ボタンが押された時点で作成して抽出結果ごとに再利用
+            result_id = st.session_state.result_id
+            file_name = st.session_state.file_name
+            target_gdf = st.session_state.target_gdf
+            overlay_gdf = st.session_state.overlay_gdf
+            
             col3, col4, col5 = st.columns(3)
             
             with col3:
                 st.subheader("🎯 対象筆")
-                target_kml = extractor.create_kml_from_geodataframe(
-                    st.session_state.target_gdf, 
-                    f"{st.session_state.file_name}_対象筆"
+                lazy_download_button(
+                    extractor, (result_id, 'target_kml'),
+                    "📄 対象筆KMLダウンロード",
+                    lambda: extractor.create_kml_export(target_gdf, f"{file_name}_対象筆"),
+                    file_name=f"{file_name}_対象筆.kml",
+                    mime="application/vnd.google-earth.kml+xml",
+                    key="download_target_kml"
                 )
-                if target_kml:
-                    st.download_button(
-                        "📄 対象筆KMLダウンロード",
-                        data=target_kml,
-                        file_name=f"{st.session_state.file_name}_対象筆.kml",
-                        mime="application/vnd.google-earth.kml+xml",
-                        use_container_width=True
-                    )
             
             with col4:
                 st.subheader("🏘️ 周辺筆")
-                overlay_kml = extractor.create_kml_from_geodataframe(
-                    st.session_state.overlay_gdf,
-                    f"{st.session_state.file_name}_周辺筆"
+                lazy_download_button(
+                    extractor, (result_id, 'overlay_kml'),
+                    "📄 周辺筆KMLダウンロード",
+                    lambda: extractor.create_kml_export(overlay_gdf, f"{file_name}_周辺筆"),
+                    file_name=f"{file_name}_周辺筆.kml",
+                    mime="application/vnd.google-earth.kml+xml",
+                    key="download_overlay_kml"
                 )
-                if overlay_kml:
-                    st.download_button(
-                        "📄 周辺筆KMLダウンロード",
-                        data=overlay_kml,
-                        file_name=f"{st.session_state.file_name}_周辺筆.kml",
-                        mime="application/vnd.google-earth.kml+xml",
-                        use_container_width=True
-                    )
             
             with col5:
                 st.subheader("📊 CSV出力")
                 # 座標情報付きCSV
-                csv_data = st.session_state.overlay_gdf.copy()
-                csv_data['中心X座標'] = csv_data['geometry'].centroid.x
-                csv_data['中心Y座標'] = csv_data['geometry'].centroid.y
-                csv_export = csv_data.drop(columns=['geometry']).to_csv(index=False, encoding='shift-jis')
-                
-                st.download_button(
+                lazy_download_button(
+                    extractor, (result_id, 'overlay_csv'),
                     "📊 周辺筆CSVダウンロード",
-                    data=csv_export,
-                    file_name=f"{st.session_state.file_name}_周辺筆.csv",
+                    lambda: create_centroid_csv(overlay_gdf),
+                    file_name=f"{file_name}_周辺筆.csv",
                     mime="text/csv",
-                    use_container_width=True
+                    key="download_overlay_csv"
                 )
             
+            # GIS用の形式（KMZ・GeoJSON・GeoPackage・FlatGeobuf・GeoParquet）をまとめたZIP
+            st.subheader("📦 その他の形式")
+            show_export_bundle(
+                extractor, result_id, {'対象筆': target_gdf, '周辺筆': overlay_gdf}, file_name, key="result"
+            )
+            
             # 結果プレビュー
             st.markdown("---")
             st.header("👀 結果プレビュー")
@@ -1423,7 +4302,7 @@ def main():
                 search_conditions = {
                     '大字名': selected_oaza if 'selected_oaza' in locals() else '不明',
                     '地番': chiban if 'chiban' in locals() else '不明',
-                    '検索範囲': "61m（固定）"
+                    '検索範囲': st.session_state.get('range_text', format_range_tier(DEFAULT_RANGE_M))
                 }
                 
                 if 'selected_chome' in locals() and selected_chome and selected_chome != "選択なし":
@@ -1469,6 +4348,13 @@ def main():
             3. 取得されたファイル一覧から**目的のファイルを選択**
             4. **「選択ファイルを読み込み」**ボタンでデータを読み込み
             
+            **県全体検索** 🗾
+            - **「全ファイルを統合して県全体で検索」**で一覧の全ファイルを市区町村コードごとに統合
+            - 市区町村をまたいで大字名・地番を検索し、該当する市区町村をそのまま読み込み可能
+            - 座標系（公共座標15系/16系/17系）は市区町村ごとの元の座標系のまま扱います
+            - **「県全体の一括抽出」**では依頼一覧を市区町村ごとに振り分け、CPUコア数のワーカープロセスで並列に抽出
+              （市区町村列を指定しない依頼は大字名・地番から振り分け、座標系が混在する結果は緯度経度にまとめます）
+            
             ### 📋 データソース（従来機能）
             **1. 固定プリセット** 📋
             - 事前設定されたサンプルファイル
@@ -1492,10 +4378,18 @@ def main():
             4. **小字名**を選択（小字データがある場合のみ表示）
                - 小字を指定したくない場合は「選択なし」のまま
             5. **地番**を入力
-            6. **検索範囲**を設定（デフォルト: 61m）
+            6. **検索範囲**の形と距離を設定（デフォルト: 正方形 61m）
+               - 形: 正方形・円（対象筆の中心から）、筆の境界からの距離、任意の多角形（緯度経度のGeoJSON/WKT）
+               - 「30, 61, 100」のように複数の距離を指定すると、周辺筆に最も内側の範囲（検索範囲列）が付きます
+               - 近い順: 筆の境界どうしの距離が近い順に指定した数の筆を、距離(m)・順位の列付きで抽出します（切り抜きなし）
             7. **データ抽出**ボタンをクリック
             8. **KMLファイル**をダウンロード
             
+            ### 📑 一括抽出
+            - **「一括抽出（CSV/Excel）」**に依頼一覧をアップロードすると、全件をまとめて抽出
+            - 列: 大字名・地番（必須）、依頼番号・丁目名・小字名・検索範囲（任意、検索範囲の空欄は61m）
+            - 依頼ごとの処理結果CSVと、依頼番号付きの対象筆・周辺筆KML/CSVをダウンロード可能
+            
             ### 🏘️ 丁目・小字機能について
             - データに「丁目名」「小字名」列が含まれている場合、それぞれでの絞り込みが可能
             - 大字名を選択すると、その大字に対応する丁目・小字のみが表示されます
@@ -1506,6 +4400,7 @@ def main():
             - **対象筆KML**: 指定した筆のKMLファイル
             - **周辺筆KML**: 周辺筆のKMLファイル
             - **CSV**: 座標情報付きのCSVファイル
+            - **ZIP（その他の形式）**: KMZ・GeoJSON・GeoPackage・FlatGeobuf・GeoParquet・CSVから選んで、対象筆・周辺筆をまとめてダウンロード
             
             ### 🗺️ 対応ソフトウェア
             - Google Earth
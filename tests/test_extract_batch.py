@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""一括抽出（extract_batch）の対象筆が複数ある依頼のテスト"""
+
+import os
+import sys
+import tempfile
+
+import geopandas as gpd
+import pandas as pd
+from shapely.geometry import box
+
+os.environ.setdefault('KOJI_CACHE_DIR', tempfile.mkdtemp(prefix='koji-test-'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import koji_web_app  # noqa: E402
+
+
+def make_parcels():
+    """10m四方の筆を東西に並べ、同じ所在（字A 1174）の筆を西端と東端に置いたデータ"""
+    rows = []
+    for i in range(30):
+        chiban = '1174' if i in (0, 29) else str(2000 + i)
+        rows.append({'大字名': '字A', '丁目名': None, '小字名': None, '地番': chiban, 'geometry': box(i * 10, 0, i * 10 + 10, 10)})
+    return gpd.GeoDataFrame(rows, geometry='geometry', crs='EPSG:6677')
+
+
+def test_batch_extracts_every_matching_target():
+    gdf = make_parcels()
+    extractor = koji_web_app.KojiWebExtractor()
+    requests_df = koji_web_app.normalize_batch_requests(
+        pd.DataFrame({'大字名': ['字A'], '地番': ['1174'], '検索範囲': [25]})
+    )
+
+    status, target_gdf, overlay_gdf = extractor.extract_batch(gdf, requests_df)
+    expected_targets, expected_overlay, _ = extractor.extract_data(gdf, '字A', None, None, '1174', 25)
+
+    assert status.loc[0, '状態'] == '抽出完了'
+    assert list(target_gdf['対象筆番号']) == ['1', '2']
+    assert list(expected_targets['対象筆番号']) == ['1', '2']
+    assert len(target_gdf) == len(expected_targets) == 2
+
+    # 両端の対象筆それぞれの周辺筆を抽出し、extract_dataと同じ筆・対象筆番号になる
+    assert len(overlay_gdf) == len(expected_overlay)
+    assert sorted(overlay_gdf['地番']) == sorted(expected_overlay['地番'])
+    assert set(overlay_gdf['依頼番号']) == {1}
+    assert list(overlay_gdf['対象筆番号']) == list(expected_overlay['対象筆番号'])
+    assert set(overlay_gdf['対象筆番号']) == {'1', '2'}
+    assert (overlay_gdf['地番'] == '1174').sum() == 2
+    assert status.loc[0, '周辺筆件数'] == len(overlay_gdf)